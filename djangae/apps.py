@@ -13,7 +13,15 @@ class DjangaeConfig(AppConfig):
         models.patch()
 
         from djangae.db.backends.appengine.caching import reset_context
+        from djangae.db.backends.appengine.futures import wait_for_pending
         from django.core.signals import request_finished, request_started
 
+        # Outstanding writes have to finish (and be cached) before the context is reset
+        request_finished.connect(wait_for_pending, dispatch_uid="request_finished_wait_for_pending_writes")
         request_finished.connect(reset_context, dispatch_uid="request_finished_context_reset")
         request_started.connect(reset_context, dispatch_uid="request_started_context_reset")
+
+        from djangae.db.backends.appengine import query_log
+
+        request_finished.connect(query_log.request_finished, dispatch_uid="request_finished_query_log")
+        request_started.connect(query_log.reset, dispatch_uid="request_started_query_log_reset")
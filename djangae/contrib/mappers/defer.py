@@ -1,13 +1,15 @@
 from google.appengine.ext.deferred import defer
 from google.appengine.runtime import DeadlineExceededError
 
+from djangae.db.models import get_cursor, set_cursors
+
 
 def _process_shard(model, instance_ids, callback):
     for instance in model.objects.filter(pk__in=instance_ids):
         callback(instance)
 
 
-def _shard(model, query, callback, shard_size, queue, offset=0):
+def _shard(model, query, callback, shard_size, queue, offset=0, cursor=None):
     keys_queryset = model.objects.all()
     keys_queryset.query = query
     keys_queryset = keys_queryset.values_list("pk", flat=True)
@@ -15,7 +17,13 @@ def _shard(model, query, callback, shard_size, queue, offset=0):
     # Keep iterating until we are done, or we only have 10 seconds to spare!
     while True:
         try:
-            ids = list(keys_queryset.all()[offset:offset+shard_size])
+            # Continue from the cursor if we have one, otherwise fall back to the offset
+            if cursor:
+                qs = set_cursors(keys_queryset, start=cursor)[:shard_size]
+            else:
+                qs = keys_queryset.all()[offset:offset+shard_size]
+
+            ids = list(qs)
             if not ids:
                 # We're done!
                 return
@@ -23,10 +31,11 @@ def _shard(model, query, callback, shard_size, queue, offset=0):
             # Fire off the first shard
             defer(_process_shard, model, ids, callback, _queue=queue)
 
-            # Increment the offset
+            # Move on to the next shard
             offset += shard_size
+            cursor = get_cursor(qs)
         except DeadlineExceededError:
-            # If we run out of time, then defer this function again, continuing from the offset
+            # If we run out of time, then defer this function again, continuing from where we got to
             defer(
                 _shard,
                 model,
@@ -35,8 +44,10 @@ def _shard(model, query, callback, shard_size, queue, offset=0):
                 shard_size,
                 queue,
                 offset=offset,
+                cursor=cursor,
                 _queue=queue
             )
+            return
 
 
 def defer_iteration(queryset, callback, shard_size=500, _queue="default"):
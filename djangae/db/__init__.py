@@ -1 +1,4 @@
-
+def batch_writes(*args, **kwargs):
+    """ See djangae.db.batching.BatchWritesDecorator """
+    from djangae.db.batching import batch_writes
+    return batch_writes(*args, **kwargs)
@@ -85,12 +85,14 @@ class Cursor(object):
         self.rowcount = -1
         self.last_select_command = None
         self.last_delete_command = None
+        self._build_row = None
 
     def execute(self, sql, *params):
         if isinstance(sql, SelectCommand):
             # Also catches subclasses of SelectCommand (e.g Update)
             self.last_select_command = sql
             self.rowcount = self.last_select_command.execute() or -1
+            self._build_row = self._row_builder(sql.query)
         elif isinstance(sql, FlushCommand):
             sql.execute()
         elif isinstance(sql, UpdateCommand):
@@ -103,6 +105,31 @@ class Cursor(object):
         else:
             raise Database.CouldBeSupportedError("Can't execute traditional SQL: '%s' (although perhaps we could make GQL work)", sql)
 
+    def _row_builder(self, query):
+        """
+            Returns a function which builds a row from a result. The columns (and for
+            Django 1.7, the fields to convert their values) are looked up once per query.
+        """
+        # Extra select values are prepended to the resulting row
+        columns = [ col for col, select in query.extra_selects ] + list(query.init_list)
+
+        if django.VERSION[1] < 8:
+            # For 1.7 support
+            ops = self.connection.ops
+            extra_count = len(query.extra_selects)
+            fields = [ None ] * extra_count + [
+                get_field_from_column(query.model, col) for col in query.init_list
+            ]
+
+            def build_row(result):
+                return [
+                    result.get(col) if i < extra_count else ops.convert_values(result.get(col), fields[i])
+                    for i, col in enumerate(columns)
+                ]
+            return build_row
+
+        return lambda result: [ result.get(col) for col in columns ]
+
     def next(self):
         row = self.fetchone()
         if row is None:
@@ -110,38 +137,16 @@ class Cursor(object):
         return row
 
     def fetchone(self, delete_flag=False):
-        def convert_values(value, field):
-            """ For 1.7 support """
-            ops = self.connection.ops
-
-            if django.VERSION[1] < 8:
-                return ops.convert_values(value, field)
-            else:
-                return value
-
         try:
             result = self.last_select_command.results.next()
-
-            if isinstance(result, (int, long)):
-                return (result,)
-
-            query = self.last_select_command.query
-
-            row = []
-
-            # Prepend extra select values to the resulting row
-            for col, select in query.extra_selects:
-                row.append(result.get(col))
-
-            for col in self.last_select_command.query.init_list:
-                field = get_field_from_column(query.model, col)
-                row.append(convert_values(result.get(col), field))
-
-            self.returned_ids.append(result.key().id_or_name())
-            return row
         except StopIteration:
             return None
 
+        if isinstance(result, (int, long)):
+            return (result,)
+
+        return self._build_row(result)
+
     def fetchmany(self, size, delete_flag=False):
         if not self.last_select_command.results:
             return []
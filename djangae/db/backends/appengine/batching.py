@@ -0,0 +1,161 @@
+"""
+    Queues up writes so that they can be sent to the datastore together, see
+    djangae.db.batching.batch_writes.
+
+    Only writes which can't fail because of what's already in the datastore are queued: inserts
+    which the datastore allocates an id for, and deletes, for models which have no unique markers
+    to acquire or release. Ids are allocated up front (in blocks) so the pk of a queued insert is
+    known straight away. Everything else flushes the queue before it runs, so writes always
+    happen in the order they were made.
+
+    Queued writes are flushed outside of transactions, and don't touch the caches until they have
+    been sent. Until then, reads don't see them.
+"""
+
+import collections
+import threading
+
+from django.conf import settings
+from google.appengine.api import datastore
+from google.appengine.ext import db
+
+from djangae.db.backends.appengine import caching
+
+# The queue is flushed once it holds this many writes, the datastore accepts at most 500
+# entities or keys in each Put or Delete
+BATCH_WRITES_MAX_SIZE = min(getattr(settings, "DJANGAE_BATCH_WRITES_MAX_SIZE", 500), 500)
+
+# How many ids are allocated at a time for queued inserts
+IDS_PER_ALLOCATION = 100
+
+_local = threading.local()
+
+
+def _with_key(entity, key):
+    """ Returns a copy of the entity with the given key """
+    new_entity = datastore.Entity(
+        key.kind(),
+        parent=key.parent(),
+        id=key.id(),
+        namespace=key.namespace(),
+        unindexed_properties=entity.unindexed_properties()
+    )
+    new_entity.update(entity)
+    return new_entity
+
+
+def _chunks(items, size):
+    return [ items[i:i + size] for i in xrange(0, len(items), size) ]
+
+
+class WriteBatch(object):
+    def __init__(self):
+        self._puts = collections.OrderedDict() # key -> (model, entity)
+        self._deletes = collections.OrderedDict() # key -> model
+        self._ids = {}
+
+    def __len__(self):
+        return len(self._puts) + len(self._deletes)
+
+    def _allocate_key(self, key):
+        """ Returns a complete version of the incomplete key """
+        pool_key = (key.kind(), key.parent(), key.namespace())
+        ids = self._ids.get(pool_key)
+        if not ids:
+            start, end = datastore.AllocateIds(key, size=IDS_PER_ALLOCATION)
+            ids = self._ids[pool_key] = collections.deque(xrange(start, end + 1))
+
+        return datastore.Key.from_path(key.kind(), ids.popleft(), parent=key.parent(), namespace=key.namespace())
+
+    def put(self, model, entities):
+        """
+            Queues the entities to be put, and returns their keys. Entities without an id are
+            given one, so the returned keys are always complete.
+        """
+        keys = []
+        for entity in entities:
+            if not entity.key().has_id_or_name():
+                entity = _with_key(entity, self._allocate_key(entity.key()))
+
+            key = entity.key()
+            self._deletes.pop(key, None)
+            self._puts[key] = (model, entity)
+            keys.append(key)
+
+        if len(self) >= BATCH_WRITES_MAX_SIZE:
+            self.flush()
+
+        return keys
+
+    def delete(self, model, keys):
+        """ Queues the keys to be deleted, they are removed from the caches straight away """
+        caching.remove_entities_from_cache_by_key(keys)
+
+        for key in keys:
+            self._puts.pop(key, None)
+            self._deletes[key] = model
+
+        if len(self) >= BATCH_WRITES_MAX_SIZE:
+            self.flush()
+
+    @db.non_transactional
+    def flush(self):
+        """
+            Sends all of the queued writes, with an RPC per kind, and waits for them. The writes
+            are never part of the caller's transaction, even one started with db.transactional
+        """
+        puts, self._puts = self._puts, collections.OrderedDict()
+        deletes, self._deletes = self._deletes, collections.OrderedDict()
+
+        entities_by_model = collections.OrderedDict()
+        for model, entity in puts.values():
+            entities_by_model.setdefault(model, []).append(entity)
+
+        keys_by_model = collections.OrderedDict()
+        for key, model in deletes.items():
+            keys_by_model.setdefault(model, []).append(key)
+
+        rpcs = []
+        for entities in entities_by_model.values():
+            rpcs.extend(datastore.PutAsync(x) for x in _chunks(entities, BATCH_WRITES_MAX_SIZE))
+
+        for keys in keys_by_model.values():
+            rpcs.extend(datastore.DeleteAsync(x) for x in _chunks(keys, BATCH_WRITES_MAX_SIZE))
+
+        for rpc in rpcs:
+            rpc.get_result()
+
+        for model, entities in entities_by_model.items():
+            caching.add_entities_to_cache(model, entities, caching.CachingSituation.DATASTORE_PUT)
+
+        if deletes:
+            # Anything read from the datastore since the delete was queued may have been cached
+            caching.remove_entities_from_cache_by_key(deletes.keys())
+
+
+def get_batch():
+    """ Returns the WriteBatch for the current thread, or None if writes aren't being batched """
+    return getattr(_local, "batch", None)
+
+
+def begin():
+    depth = getattr(_local, "depth", 0)
+    if not depth:
+        _local.batch = WriteBatch()
+    _local.depth = depth + 1
+
+
+def end():
+    try:
+        _local.batch.flush()
+    finally:
+        _local.depth -= 1
+        if not _local.depth:
+            _local.batch = None
+
+
+def flush():
+    """ Sends any queued writes, this is called before any write which can't be queued """
+    batch = get_batch()
+    if batch is not None and len(batch):
+        batch.flush()
@@ -1,8 +1,12 @@
 import logging
 import threading
 import itertools
+import time
+import uuid
+import zlib
 
 from google.appengine.api import datastore
+from google.appengine.datastore import entity_pb
 
 from django.conf import settings
 from django.core.cache import cache
@@ -11,6 +15,7 @@ from django.dispatch import receiver
 from djangae.db import utils
 from djangae.db.unique_utils import unique_identifiers_from_entity, _format_value_for_identifier
 from djangae.db.backends.appengine.context import ContextStack
+from djangae.db.backends.appengine import process_cache
 
 logger = logging.getLogger("djangae")
 
@@ -28,6 +33,41 @@ def get_context():
 CACHE_TIMEOUT_SECONDS = getattr(settings, "DJANGAE_CACHE_TIMEOUT_SECONDS", 60 * 60)
 CACHE_ENABLED = getattr(settings, "DJANGAE_CACHE_ENABLED", True)
 
+# Tombstones record that nothing exists for an identifier, they are only kept briefly
+CACHE_TOMBSTONE_TIMEOUT_SECONDS = getattr(settings, "DJANGAE_CACHE_TOMBSTONE_TIMEOUT_SECONDS", 10)
+
+# When an entity is missing from memcache, the first request to look for it takes a lease and refills
+# the cache, other requests wait up to CACHE_LEASE_WAIT_SECONDS for it rather than all hitting the datastore.
+# A lease expires after CACHE_LEASE_TIMEOUT_SECONDS in case the request holding it dies.
+CACHE_LEASE_TIMEOUT_SECONDS = getattr(settings, "DJANGAE_CACHE_LEASE_TIMEOUT_SECONDS", 3)
+CACHE_LEASE_WAIT_SECONDS = getattr(settings, "DJANGAE_CACHE_LEASE_WAIT_SECONDS", 0.5)
+_LEASE_POLL_INTERVAL_SECONDS = 0.05
+
+# Encoded entities larger than this are zlib compressed before going into memcache
+CACHE_COMPRESSION_THRESHOLD = getattr(settings, "DJANGAE_CACHE_COMPRESSION_THRESHOLD", 10 * 1024)
+
+# Memcache values are limited to 1MB (including the key), anything larger than this is
+# split across several memcache keys
+MAX_MEMCACHE_VALUE_SIZE = 1000 * 1000 - 2048
+
+# The first byte of each value we store in memcache says how to decode the rest of it
+_ENTITY_PREFIX = "E" # An encoded entity protobuf
+_COMPRESSED_ENTITY_PREFIX = "Z" # A zlib compressed entity protobuf
+_KEY_PREFIX = "K" # An encoded datastore key, pointing at the entity stored under its pk identifier
+_CHUNKED_PREFIX = "C" # "<token>:<count>", the value is stored in count chunks under "<identifier>|<token>|<i>"
+_TOMBSTONE_PREFIX = "T" # Nothing exists for this identifier
+
+# Replaces a cache refill lease when it's released
+_RELEASED_LEASE = "released"
+
+
+class _Tombstone(object):
+    def __repr__(self):
+        return "TOMBSTONE"
+
+# Returned by cache lookups (when asked for) if we know that nothing exists for an identifier
+TOMBSTONE = _Tombstone()
+
 
 class CachingSituation:
     DATASTORE_GET = 0
@@ -43,8 +83,245 @@ def ensure_context():
     context.stack = context.stack if hasattr(context, "stack") else ContextStack()
 
 
+def _serialize_for_memcache(value):
+    if isinstance(value, datastore.Key):
+        return _KEY_PREFIX + str(value)
+
+    data = value.ToPb().Encode()
+    if len(data) > CACHE_COMPRESSION_THRESHOLD:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return _COMPRESSED_ENTITY_PREFIX + compressed
+    return _ENTITY_PREFIX + data
+
+
+def _deserialize_from_memcache(data):
+    """
+        Returns the entity, key or TOMBSTONE stored in data, or None if it isn't something
+        we wrote (e.g. a pickled entity written by an older version of Djangae)
+    """
+    if not isinstance(data, str):
+        return None
+
+    prefix, data = data[:1], data[1:]
+
+    try:
+        if prefix == _TOMBSTONE_PREFIX:
+            return TOMBSTONE
+        elif prefix == _KEY_PREFIX:
+            return datastore.Key(data)
+        elif prefix == _COMPRESSED_ENTITY_PREFIX:
+            data = zlib.decompress(data)
+        elif prefix != _ENTITY_PREFIX:
+            # Something else wrote this key, treat it as a miss
+            return None
+
+        return datastore.Entity.FromPb(entity_pb.EntityProto(data))
+    except Exception:
+        logger.warning("Unable to decode a value from memcache, treating it as a cache miss", exc_info=True)
+        return None
+
+
+def _async_memcache_client():
+    """
+        Returns the underlying memcache client if it supports async RPCs (the App Engine one does),
+        otherwise None and we fall back to the synchronous Django cache API
+    """
+    client = getattr(cache, "_cache", None)
+    if hasattr(client, "set_multi_async") and hasattr(client, "delete_multi_async"):
+        return client
+    return None
+
+
+def _wait_for_pending_writes(identifiers):
+    """
+        Waits for any asynchronous memcache writes/deletes which touch the given identifiers. This is called
+        before any read or write of the same keys, so that operations on a key always happen in order.
+    """
+    context = get_context()
+    pending = getattr(context, "pending_rpcs", None)
+    if not pending:
+        return
+
+    identifiers = set(identifiers)
+    to_wait = [ x for x in pending if not x[0].isdisjoint(identifiers) ]
+    if to_wait:
+        context.pending_rpcs = [ x for x in pending if x not in to_wait ]
+        _join_rpcs(to_wait)
+
+
+def wait_for_memcache_writes():
+    """
+        Waits for all outstanding asynchronous memcache writes/deletes made by this thread. This happens at the
+        start and end of each request, and when a transaction is committed.
+    """
+    context = get_context()
+    pending = getattr(context, "pending_rpcs", None)
+    if pending:
+        context.pending_rpcs = []
+        _join_rpcs(pending)
+
+
+def _join_rpcs(pending):
+    for identifiers, rpc in pending:
+        try:
+            rpc.get_result()
+        except Exception:
+            logger.exception("Asynchronous memcache operation failed")
+
+
+def _track_rpc(identifiers, rpc):
+    context = get_context()
+    if not hasattr(context, "pending_rpcs"):
+        context.pending_rpcs = []
+    context.pending_rpcs.append((frozenset(identifiers), rpc))
+
+
+def _chunk_key(identifier, token, i):
+    return "{}|{}|{}".format(identifier, token, i)
+
+
+def _memcache_set_many(mc_key_value_map):
+    """
+        Serializes the entities/keys and writes them to memcache with a single set_many. Values
+        which are too big for a single memcache item are split into chunks.
+    """
+    to_set = {}
+    for identifier, value in mc_key_value_map.items():
+        data = _serialize_for_memcache(value)
+
+        if len(data) > MAX_MEMCACHE_VALUE_SIZE:
+            # Each write of a chunked value gets a new token, so a reader can never
+            # stitch together chunks from different versions of the entity
+            token = uuid.uuid4().hex
+            chunks = [
+                data[i:i + MAX_MEMCACHE_VALUE_SIZE] for i in xrange(0, len(data), MAX_MEMCACHE_VALUE_SIZE)
+            ]
+            for i, chunk in enumerate(chunks):
+                to_set[_chunk_key(identifier, token, i)] = chunk
+
+            data = "{}{}:{}".format(_CHUNKED_PREFIX, token, len(chunks))
+
+        to_set[identifier] = data
+
+    _wait_for_pending_writes(to_set.keys())
+
+    client = _async_memcache_client()
+    if client:
+        rpc = client.set_multi_async(
+            { cache.make_key(k): v for k, v in to_set.items() },
+            time=cache.get_backend_timeout(CACHE_TIMEOUT_SECONDS)
+        )
+        _track_rpc(to_set.keys(), rpc)
+    else:
+        cache.set_many(to_set, timeout=CACHE_TIMEOUT_SECONDS)
+
+
+def _reassemble_chunks(manifests):
+    """
+        Given a dictionary of identifier -> chunk manifest, fetch all the chunks with a
+        single get_many and return identifier -> data for those which are complete
+    """
+    chunk_keys = {}
+    for identifier, manifest in manifests.items():
+        try:
+            token, count = manifest[1:].split(":")
+            count = int(count)
+        except ValueError:
+            continue # Not a manifest we wrote, so it's a miss
+
+        chunk_keys[identifier] = [ _chunk_key(identifier, token, i) for i in xrange(count) ]
+
+    if not chunk_keys:
+        return {}
+
+    chunks = cache.get_many(list(itertools.chain(*chunk_keys.values())))
+
+    ret = {}
+    for identifier, keys in chunk_keys.items():
+        if all(isinstance(chunks.get(key), str) for key in keys):
+            ret[identifier] = "".join(chunks[key] for key in keys)
+    return ret
+
+
+def _decode_memcache_values(values):
+    # Anything which isn't a string wasn't written by us, and is treated as a miss
+    values = { k: v for k, v in values.items() if isinstance(v, str) }
+    manifests = { k: v for k, v in values.items() if v.startswith(_CHUNKED_PREFIX) }
+    reassembled = _reassemble_chunks(manifests) if manifests else {}
+
+    ret = {}
+    for identifier, data in values.items():
+        if identifier in manifests:
+            data = reassembled.get(identifier) # None if any of the chunks were missing
+
+        if data:
+            value = _deserialize_from_memcache(data)
+            if value is not None:
+                ret[identifier] = value
+    return ret
+
+
+def _memcache_get(identifier):
+    _wait_for_pending_writes([identifier])
+    data = cache.get(identifier)
+    if data is None:
+        return None
+    return _decode_memcache_values({identifier: data}).get(identifier)
+
+
+def _memcache_get_many(identifiers):
+    _wait_for_pending_writes(identifiers)
+    return _decode_memcache_values(cache.get_many(identifiers))
+
+
+def _memcache_add_tombstones(identifiers):
+    # We use add so that we never replace an entity which was cached after we looked for it
+    _wait_for_pending_writes(identifiers)
+
+    client = _async_memcache_client()
+    if client and hasattr(client, "add_multi_async"):
+        rpc = client.add_multi_async(
+            { cache.make_key(x): _TOMBSTONE_PREFIX for x in identifiers },
+            time=cache.get_backend_timeout(CACHE_TOMBSTONE_TIMEOUT_SECONDS)
+        )
+        _track_rpc(identifiers, rpc)
+    else:
+        for identifier in identifiers:
+            cache.add(identifier, _TOMBSTONE_PREFIX, timeout=CACHE_TOMBSTONE_TIMEOUT_SECONDS)
+
+
+def _memcache_delete_many(identifiers):
+    # Any chunks are left to expire, without the manifest nothing will read them
+    _wait_for_pending_writes(identifiers)
+
+    client = _async_memcache_client()
+    if client:
+        rpc = client.delete_multi_async([ cache.make_key(x) for x in identifiers ])
+        _track_rpc(identifiers, rpc)
+    else:
+        cache.delete_many(identifiers)
+
+
 def _add_entity_to_memcache(model, mc_key_entity_map):
-    cache.set_many(mc_key_entity_map, timeout=CACHE_TIMEOUT_SECONDS)
+    _memcache_set_many(mc_key_entity_map)
+
+
+def _build_memcache_entries(model, entities, identifiers):
+    """
+        Each entity is only stored once in memcache, under its pk identifier. The other
+        unique identifiers just store the datastore key, which we follow when reading
+    """
+    mc_key_entity_map = {}
+    for ent_identifiers, entity in zip(identifiers, entities):
+        key = entity.key()
+        pk_identifier, _ = _get_cache_key_and_model_from_datastore_key(key)
+
+        mc_key_entity_map.update({
+            identifier: key for identifier in ent_identifiers if identifier != pk_identifier
+        })
+        mc_key_entity_map[pk_identifier] = entity
+    return mc_key_entity_map
 
 
 def _get_cache_key_and_model_from_datastore_key(key):
@@ -61,38 +338,160 @@ def _get_cache_key_and_model_from_datastore_key(key):
     return (cache_key, model)
 
 
-def _remove_entities_from_memcache_by_key(keys):
+def _remove_entities_from_memcache_by_key(keys, identifiers=None):
     """
-        Note, if the key of the entity got evicted from the cache, it's possible that stale cache
-        entries would be left behind. Remember if you need pure atomicity then use disable_cache() or a
-        transaction.
+        Removes entities from memcache with a single delete_many. We don't need to know the other
+        identifiers of an entity to remove it, as they only point at the pk identifier (and are checked
+        against the entity when read). But we delete the ones we know about, either passed in or in the context
+        cache, so that any tombstones for them are wiped out.
     """
 
-    # Key -> model
-    cache_keys = dict(
-        _get_cache_key_and_model_from_datastore_key(key) for key in keys
-    )
-    entities = cache.get_many(cache_keys.keys())
+    to_delete = set(identifiers or [])
+    for key in keys:
+        pk_identifier, _ = _get_cache_key_and_model_from_datastore_key(key)
+        to_delete.add(pk_identifier)
 
-    if entities:
-        identifiers = [
-            unique_identifiers_from_entity(cache_keys[key], entity)
-            for key, entity in entities.items()
-        ]
-        cache.delete_many(itertools.chain(*identifiers))
+        # Deleting the lease stops any refill which is in progress from caching what it read
+        to_delete.add(_lease_cache_key(pk_identifier))
+
+        for context in get_context().stack.stack:
+            to_delete.update(context.reverse_cache.get(key, []))
+
+    if to_delete:
+        _memcache_delete_many(list(to_delete))
 
 
 def _get_entity_from_memcache(identifier):
-    return cache.get(identifier)
+    ret = _memcache_get(identifier)
+
+    if isinstance(ret, datastore.Key):
+        # This is a pointer to the entity stored under its pk identifier
+        cache_key, model = _get_cache_key_and_model_from_datastore_key(ret)
+        ret = _memcache_get(cache_key)
+
+        # If the entity has changed (or gone) since the pointer was written, then the pointer is stale
+        if not isinstance(ret, datastore.Entity) or identifier not in unique_identifiers_from_entity(model, ret):
+            ret = None
+
+    return ret
 
 
 def _get_entity_from_memcache_by_key(key):
     # We build the cache key for the ID of the instance
     cache_key, _ = _get_cache_key_and_model_from_datastore_key(key)
-    return cache.get(cache_key)
+    return _memcache_get(cache_key)
+
+
+def _get_entities_from_memcache_by_key(keys):
+    """
+        Returns a dictionary of key -> entity (or TOMBSTONE) for the keys which were found in
+        memcache, using a single get_many
+    """
+    cache_keys = dict(
+        (_get_cache_key_and_model_from_datastore_key(key)[0], key) for key in keys
+    )
+    entities = _memcache_get_many(cache_keys.keys())
+    return dict(
+        (cache_keys[cache_key], entity) for cache_key, entity in entities.items()
+        if isinstance(entity, datastore.Entity) or entity is TOMBSTONE
+    )
+
+
+def _lease_cache_key(pk_identifier):
+    return pk_identifier + "|lease"
+
+
+def acquire_lease(key):
+    """
+        Called on a cache miss for a single key, before hitting the datastore. Returns a tuple of
+        (entity, lease). If another request is already refilling the cache for this key we wait
+        briefly for it, and return what it cached (which may be TOMBSTONE). Otherwise entity is None and
+        lease is a token which should be passed to add_entities_to_cache or add_tombstones_to_cache,
+        which release it (or to release_lease if nothing is cached).
+    """
+
+    ensure_context()
 
+    if not CACHE_ENABLED or not _context.memcache_enabled or datastore.IsInTransaction():
+        return None, None
 
-def add_entities_to_cache(model, entities, situation, skip_memcache=False):
+    pk_identifier, _ = _get_cache_key_and_model_from_datastore_key(key)
+    lease = uuid.uuid4().hex
+
+    _wait_for_pending_writes([_lease_cache_key(pk_identifier)])
+    if cache.add(_lease_cache_key(pk_identifier), lease, timeout=CACHE_LEASE_TIMEOUT_SECONDS):
+        return None, lease
+
+    # Someone else is refilling, wait for them
+    deadline = time.time() + CACHE_LEASE_WAIT_SECONDS
+    while time.time() < deadline:
+        time.sleep(_LEASE_POLL_INTERVAL_SECONDS)
+
+        entity = _memcache_get(pk_identifier)
+        if entity is not None:
+            return entity, None
+
+    # The lease holder is taking too long, give up and go to the datastore
+    return None, None
+
+
+def _cas_memcache_client():
+    """ Returns the underlying memcache client if it supports gets/cas (the App Engine one does) """
+    client = getattr(cache, "_cache", None)
+    if hasattr(client, "gets") and hasattr(client, "cas"):
+        return client
+    return None
+
+
+def _release_lease(pk_identifier, lease):
+    """
+        Releases the lease if we still hold it, and returns whether we did. If the client
+        supports it, the check and the release are a single compare-and-set, so we can never
+        release a lease which another request has just taken.
+    """
+    lease_key = _lease_cache_key(pk_identifier)
+    _wait_for_pending_writes([lease_key])
+
+    client = _cas_memcache_client()
+    if client:
+        mc_key = cache.make_key(lease_key)
+        if client.gets(mc_key) != lease:
+            return False
+
+        # There's no compare-and-delete, so the lease is replaced with a value which
+        # expires almost straight away. Anyone waiting finds what we cached.
+        return bool(client.cas(mc_key, _RELEASED_LEASE, time=1))
+
+    if cache.get(lease_key) != lease:
+        return False
+
+    cache.delete(lease_key)
+    return True
+
+
+def release_lease(key, lease):
+    pk_identifier, _ = _get_cache_key_and_model_from_datastore_key(key)
+    _release_lease(pk_identifier, lease)
+
+
+def _release_lease_or_uncache(pk_identifier, lease, identifiers):
+    """
+        Called once what was read under a lease has been written to memcache. If the lease
+        was invalidated while we were reading, then what we wrote may be stale, so it's removed.
+    """
+    # Our writes have to land first, so that an invalidation after the check wipes them out
+    _wait_for_pending_writes(identifiers)
+
+    if not _release_lease(pk_identifier, lease):
+        _memcache_delete_many(list(identifiers))
+
+
+def add_entities_to_cache(model, entities, situation, skip_memcache=False, lease=None):
+    """
+        If lease is passed, the entities are only left in memcache if the lease is still held
+        once they have been written (if the entity was written since we took it, then what we
+        have may be stale). The lease is released.
+    """
     ensure_context()
 
     # Don't cache on Get if we are inside a transaction, even in the context
@@ -101,87 +500,244 @@ def add_entities_to_cache(model, entities, situation, skip_memcache=False):
     if situation == CachingSituation.DATASTORE_GET and datastore.IsInTransaction():
         return
 
-    if situation in (CachingSituation.DATASTORE_PUT, CachingSituation.DATASTORE_GET_PUT) and datastore.IsInTransaction():
-        # We have to wipe the entity from memcache
-        _remove_entities_from_memcache_by_key([entity.key() for entity in entities if entity.key()])
-
     identifiers = [
         unique_identifiers_from_entity(model, entity) for entity in entities
     ]
 
+    if situation in (CachingSituation.DATASTORE_PUT, CachingSituation.DATASTORE_GET_PUT) and datastore.IsInTransaction():
+        # We have to wipe the entity (and any tombstones for its identifiers) from memcache
+        _remove_entities_from_memcache_by_key(
+            [entity.key() for entity in entities if entity.key()],
+            identifiers=itertools.chain(*identifiers)
+        )
+
     for ent_identifiers, entity in zip(identifiers, entities):
         get_context().stack.top.cache_entity(ent_identifiers, entity, situation)
 
+    if process_cache.process_cache_enabled(model) and situation == CachingSituation.DATASTORE_GET:
+        if _context.memcache_enabled:
+            process_cache.entity_cache.add(entities, identifiers)
+
     # Only cache in memcache of we are doing a GET (outside a transaction) or PUT (outside a transaction)
     # the exception is GET_PUT - which we do in our own transaction so we have to ignore that!
     if (not datastore.IsInTransaction() and situation in (CachingSituation.DATASTORE_GET, CachingSituation.DATASTORE_PUT)) or \
             situation == CachingSituation.DATASTORE_GET_PUT:
 
         if not skip_memcache:
-
-            mc_key_entity_map = {}
-            for ent_identifiers, entity in zip(identifiers, entities):
-                mc_key_entity_map.update({
-                    identifier: entity for identifier in ent_identifiers
-                })
+            mc_key_entity_map = _build_memcache_entries(model, entities, identifiers)
             _add_entity_to_memcache(model, mc_key_entity_map)
 
+            if lease is not None:
+                pk_identifier, _ = _get_cache_key_and_model_from_datastore_key(entities[0].key())
+                _release_lease_or_uncache(pk_identifier, lease, mc_key_entity_map.keys())
+
+    if situation != CachingSituation.DATASTORE_GET:
+        _invalidate_process_cache([entity.key() for entity in entities if entity.key()])
+
+
+def _invalidate_process_cache(keys):
+    """
+        Removes the keys from this instance's process cache, and replaces the generation of their
+        kinds so that other instances drop them too. That only happens once memcache is up to
+        date, and outside of transactions. A transaction started by atomic() does it when it's
+        applied, when the keys are removed from memcache again.
+    """
+    keys = [ key for key in keys if process_cache.process_cache_enabled(utils.get_model_from_db_table(key.kind())) ]
+    if not keys:
+        return
+
+    process_cache.entity_cache.discard(keys)
+
+    if datastore.IsInTransaction() and get_context().stack.size > 1:
+        get_context().stack.top.process_cache_keys.update(keys)
+        return
+
+    # Anyone who reads the new generation must not find the old entity in memcache
+    wait_for_memcache_writes()
+    process_cache.new_generations(set(key.kind() for key in keys))
+
+
+def add_tombstones_to_cache(identifiers, lease=None):
+    """
+        Records that nothing exists for the given identifiers. Tombstones should only be
+        written after a strongly consistent Get, and are only written outside transactions
+        (a transaction doesn't see the current state of the datastore). They are wiped out
+        when an entity is cached under the same identifier.
+
+        If lease is passed, the tombstones are only left in memcache if the lease (for the
+        first identifier) is still held, as with add_entities_to_cache.
+    """
+    ensure_context()
+
+    if not CACHE_ENABLED or datastore.IsInTransaction():
+        return
+
+    identifiers = list(identifiers)
+    if not identifiers:
+        return
+
+    if _context.context_enabled:
+        _context.stack.top.cache_tombstones(identifiers, CACHE_TOMBSTONE_TIMEOUT_SECONDS)
+
+    if _context.memcache_enabled:
+        _memcache_add_tombstones(identifiers)
+
+        if lease is not None:
+            _release_lease_or_uncache(identifiers[0], lease, identifiers)
+
+
+def add_tombstones_to_cache_by_key(keys, lease=None):
+    add_tombstones_to_cache(
+        [ _get_cache_key_and_model_from_datastore_key(key)[0] for key in keys ], lease=lease
+    )
+
 
 def remove_entities_from_cache(entities):
-    keys = [entity.key() for entity in entities if entity.key()]
-    remove_entities_from_cache_by_key(keys)
+    entities = [ entity for entity in entities if entity.key() ]
+    identifiers = itertools.chain(*[
+        unique_identifiers_from_entity(utils.get_model_from_db_table(entity.key().kind()), entity)
+        for entity in entities
+    ])
+    remove_entities_from_cache_by_key([entity.key() for entity in entities], identifiers=identifiers)
 
 
-def remove_entities_from_cache_by_key(keys, memcache_only=False):
+def remove_entities_from_cache_by_key(keys, memcache_only=False, identifiers=None):
     """
         Removes an entity from all caches (both context and memcache)
-        or just memcache if specified
+        or just memcache if specified. Any additional identifiers passed
+        are also removed from memcache.
     """
     ensure_context()
 
     if not memcache_only:
         for key in keys:
-            for identifier in _context.stack.top.reverse_cache.get(key, []):
-                if identifier in _context.stack.top.cache:
-                    del _context.stack.top.cache[identifier]
+            _context.stack.top.uncache_entity(key)
 
-    _remove_entities_from_memcache_by_key(keys)
+    _remove_entities_from_memcache_by_key(keys, identifiers=identifiers)
+    _invalidate_process_cache(keys)
 
 
-def get_from_cache_by_key(key):
+def get_enabled_cache_tiers(model):
+    """
+        Returns the names of the caches which would be checked for entities of the
+        model if they were read now, in the order they would be checked
+    """
+    ensure_context()
+
+    if not CACHE_ENABLED:
+        return []
+
+    tiers = []
+    if _context.context_enabled:
+        tiers.append("context")
+
+    if _context.memcache_enabled and not datastore.IsInTransaction():
+        if process_cache.process_cache_enabled(model):
+            tiers.append("process")
+        tiers.append("memcache")
+
+    return tiers
+
+
+def get_from_cache_by_key(key, include_tombstones=False):
     """
         Return an entity from the context cache, falling back to memcache when possible
     """
+    return get_from_cache_by_keys([key], include_tombstones=include_tombstones).get(key)
+
+
+def get_from_cache_by_keys(keys, include_tombstones=False):
+    """
+        Return a dictionary of key -> entity for each of the keys which could be found
+        in the context cache, or in memcache. Memcache is only hit once for all of the keys
+        that weren't in the context cache, missing keys are not in the returned dictionary.
+
+        If include_tombstones is True, then keys which we know don't exist map to TOMBSTONE.
+    """
 
     ensure_context()
 
     if not CACHE_ENABLED:
-        return None
+        return {}
 
-    ret = None
+    ret = {}
     if _context.context_enabled:
         # It's safe to hit the context cache, because a new one was pushed on the stack at the start of the transaction
-        ret = _context.stack.top.get_entity_by_key(key)
-        if ret is None and not datastore.IsInTransaction():
-            if _context.memcache_enabled:
-                ret = _get_entity_from_memcache_by_key(key)
-                if ret:
-                    # Add back into the context cache
-                    add_entities_to_cache(
-                        utils.get_model_from_db_table(ret.key().kind()),
-                        [ret],
-                        CachingSituation.DATASTORE_GET,
-                        skip_memcache=True # Don't put in memcache, we just got it from there!
-                    )
-    elif _context.memcache_enabled and not datastore.IsInTransaction():
-        ret = _get_entity_from_memcache_by_key(key)
+        for key in keys:
+            entity = _context.stack.top.get_entity_by_key(key)
+            if entity is not None:
+                ret[key] = entity
+            elif _context.stack.top.has_tombstone(_get_cache_key_and_model_from_datastore_key(key)[0]):
+                ret[key] = TOMBSTONE
+
+    missing = [ key for key in keys if key not in ret ]
+    if missing and _context.memcache_enabled and not datastore.IsInTransaction():
+        # Try the process cache for models which use it
+        for key in missing:
+            if not process_cache.process_cache_enabled(utils.get_model_from_db_table(key.kind())):
+                continue
+
+            result = process_cache.entity_cache.get(key)
+            if result is not None:
+                entity, identifiers = result
+                if _context.context_enabled:
+                    _context.stack.top.cache_entity(identifiers, entity, CachingSituation.DATASTORE_GET)
+                ret[key] = entity
+
+        missing = [ key for key in missing if key not in ret ]
+
+    if missing and _context.memcache_enabled and not datastore.IsInTransaction():
+        from_memcache = _get_entities_from_memcache_by_key(missing)
+
+        if _context.context_enabled:
+            # Add back into the context cache
+            by_kind = {}
+            tombstones = []
+            for key, entity in from_memcache.items():
+                if entity is TOMBSTONE:
+                    tombstones.append(_get_cache_key_and_model_from_datastore_key(key)[0])
+                else:
+                    by_kind.setdefault(entity.key().kind(), []).append(entity)
+
+            for kind, entities in by_kind.items():
+                add_entities_to_cache(
+                    utils.get_model_from_db_table(kind),
+                    entities,
+                    CachingSituation.DATASTORE_GET,
+                    skip_memcache=True # Don't put in memcache, we just got it from there!
+                )
+
+            _context.stack.top.cache_tombstones(tombstones, CACHE_TOMBSTONE_TIMEOUT_SECONDS)
+
+        ret.update(from_memcache)
+
+    if not include_tombstones:
+        ret = { k: v for k, v in ret.items() if v is not TOMBSTONE }
 
     return ret
 
 
-def get_from_cache(unique_identifier):
+def _get_entity_from_process_cache(unique_identifier):
+    model = utils.get_model_from_db_table(unique_identifier.split("|", 1)[0])
+    if not process_cache.process_cache_enabled(model):
+        return None
+
+    result = process_cache.entity_cache.get_by_identifier(unique_identifier, model._meta.db_table)
+    if result is None:
+        return None
+
+    entity, identifiers = result
+    if _context.context_enabled:
+        _context.stack.top.cache_entity(identifiers, entity, CachingSituation.DATASTORE_GET)
+    return entity
+
+
+def get_from_cache(unique_identifier, include_tombstones=False):
     """
-        Return an entity from the context cache, falling back to memcache when possible
+        Return an entity from the context cache, falling back to memcache when possible.
+
+        If include_tombstones is True, then TOMBSTONE is returned if we know that nothing
+        exists for the identifier.
     """
 
     ensure_context()
@@ -194,10 +750,18 @@ def get_from_cache(unique_identifier):
     if context.context_enabled:
         # It's safe to hit the context cache, because a new one was pushed on the stack at the start of the transaction
         ret = context.stack.top.get_entity(unique_identifier)
-        if ret is None and not datastore.IsInTransaction():
+        if ret is None and context.stack.top.has_tombstone(unique_identifier):
+            ret = TOMBSTONE
+        elif ret is None and not datastore.IsInTransaction():
             if context.memcache_enabled:
+                ret = _get_entity_from_process_cache(unique_identifier)
+                if ret is not None:
+                    return ret
+
                 ret = _get_entity_from_memcache(unique_identifier)
-                if ret:
+                if ret is TOMBSTONE:
+                    context.stack.top.cache_tombstones([unique_identifier], CACHE_TOMBSTONE_TIMEOUT_SECONDS)
+                elif ret:
                     # Add back into the context cache
                     add_entities_to_cache(
                         utils.get_model_from_db_table(ret.key().kind()),
@@ -207,7 +771,10 @@ def get_from_cache(unique_identifier):
                     )
 
     elif context.memcache_enabled and not datastore.IsInTransaction():
-        ret = _get_entity_from_memcache(unique_identifier)
+        ret = _get_entity_from_process_cache(unique_identifier) or _get_entity_from_memcache(unique_identifier)
+
+    if ret is TOMBSTONE and not include_tombstones:
+        ret = None
 
     return ret
 
@@ -221,6 +788,8 @@ def reset_context(keep_disabled_flags=False, *args, **kwargs):
 
     context = get_context()
 
+    wait_for_memcache_writes()
+
     memcache_enabled = getattr(context, "memcache_enabled", True)
     context_enabled = getattr(context, "context_enabled", True)
 
@@ -228,6 +797,8 @@ def reset_context(keep_disabled_flags=False, *args, **kwargs):
     context.context_enabled = True
     context.stack = ContextStack()
 
+    process_cache.reset()
+
     if keep_disabled_flags:
         context.memcache_enabled = memcache_enabled
         context.context_enabled = context_enabled
@@ -4,11 +4,15 @@ import logging
 import copy
 import decimal
 import json
-from functools import partial
+import Queue
+import sys
+import threading
+import time
 from itertools import chain, groupby
 
 #LIBRARIES
 import django
+from django.conf import settings
 from django.db import DatabaseError
 from django.core.cache import cache
 from django.db import IntegrityError
@@ -29,7 +33,9 @@ from djangae.db.utils import (
 
 from djangae.db.backends.appengine import POLYMODEL_CLASS_ATTRIBUTE
 from djangae.db import constraints, utils
-from djangae.db.backends.appengine import caching
+from djangae.db.backends.appengine import batching, caching, query_log
+from djangae.db.backends.appengine.futures import WriteFuture
+from djangae.db.backends.appengine.multiquery import ParallelMultiQuery, make_ordering_key
 from djangae.db.unique_utils import query_is_unique
 from djangae.db.backends.appengine import transforms
 from djangae.db.caching import clear_context_cache
@@ -45,6 +51,15 @@ DATE_TRANSFORMS = {
 
 DJANGAE_LOG = logging.getLogger("djangae")
 
+# Bulk writes run their per-entity transactions in this many threads at once
+MAX_CONCURRENT_TRANSACTIONS = getattr(settings, "DJANGAE_MAX_CONCURRENT_TRANSACTIONS", 10)
+
+# The most entity groups that a cross-group transaction can touch
+MAX_ENTITY_GROUPS_PER_TRANSACTION = 25
+
+# The most keys we send in a single Delete RPC
+MAX_KEYS_PER_DELETE = 500
+
 OPERATORS_MAP = {
     'exact': '=',
     'gt': '>',
@@ -170,6 +185,18 @@ def _convert_entity_based_on_query_options(entity, opts):
     return entity
 
 
+# The datastore options which apply to Gets as well as queries
+GET_OPTIONS = frozenset(["read_policy", "deadline"])
+
+
+def get_options(options):
+    return { k: v for k, v in options.iteritems() if k in GET_OPTIONS }
+
+
+def is_eventual_read(options):
+    return options.get("read_policy") == datastore.EVENTUAL_CONSISTENCY
+
+
 class QueryByKeys(object):
     def __init__(self, model, queries, ordering):
         def _get_key(query):
@@ -181,37 +208,54 @@ class QueryByKeys(object):
         # groupby requires that the iterable is sorted by the given key before grouping
         self.queries = sorted(queries, key=_get_key)
         self.queries_by_key = { a: list(b) for a, b in groupby(self.queries, _get_key) }
+        self.matchers_by_key = {
+            key: [ utils.compile_entity_matcher(x) for x in key_queries ]
+            for key, key_queries in self.queries_by_key.iteritems()
+        }
 
         self.ordering = ordering
         self._Query__kind = queries[0]._Query__kind
 
-    def Run(self, limit=None, offset=None):
+    def Run(self, limit=None, offset=None, **kwargs):
         """
             Here are the options:
 
-            1. Single key, hit memcache
-            2. Multikey projection, async MultiQueries with ancestors chained
-            3. Full select, datastore get
+            1. Look up the keys in the context cache and memcache
+            2. Multikey projection of the remaining keys, async MultiQueries with ancestors chained
+            3. Full select of the remaining keys, datastore get
+
+            Any kwargs are datastore options (e.g. read_policy, deadline) for the RPCs
         """
 
         opts = self.queries[0]._Query__query_options
-        key_count = len(self.queries_by_key)
+        keys = self.queries_by_key.keys()
+
+        # Eventually consistent reads may be stale, so they mustn't be used to fill the cache
+        eventual = is_eventual_read(kwargs)
 
-        cache = True
+        cached = caching.get_from_cache_by_keys(keys, include_tombstones=True)
+        missing = [ key for key in keys if key not in cached ]
 
-        results = None
-        if key_count == 1:
-            # FIXME: Potentially could use get_multi in memcache and the make a query
-            # for whatever remains
-            key = self.queries_by_key.keys()[0]
-            result = caching.get_from_cache_by_key(key)
-            if result is not None:
-                results = [ result ]
-                cache = False # Don't update cache, we just got it from there
+        results = [ cached[key] for key in keys if cached.get(key, caching.TOMBSTONE) is not caching.TOMBSTONE ]
 
-        if results is None:
+        lease = None
+        if len(missing) == 1 and not opts.projection and not eventual:
+            # Only one request should refill the cache for a popular entity, if someone
+            # else is already doing that we wait for them
+            entity, lease = caching.acquire_lease(missing[0])
+            if entity is not None:
+                if entity is not caching.TOMBSTONE:
+                    results.append(entity)
+
+                    # Someone else read this from the datastore, it came to us from memcache
+                    caching.add_entities_to_cache(
+                        self.model, [entity], caching.CachingSituation.DATASTORE_GET, skip_memcache=True
+                    )
+                missing = []
+
+        if missing:
             if opts.projection:
-                cache = False # Don't cache projection results!
+                # Don't cache projection results!
 
                 # Assumes projection ancestor queries are faster than a datastore Get
                 # due to lower traffic over the RPC. This should be faster for queries with
@@ -223,11 +267,10 @@ class QueryByKeys(object):
                 to_fetch = (offset or 0) + limit if limit else None
                 additional_cols = set([ x[0] for x in self.ordering if x[0] not in opts.projection])
 
-                multi_query = []
-                final_queries = []
+                ancestor_queries = []
                 orderings = self.queries[0]._Query__orderings
-                for key, queries in self.queries_by_key.iteritems():
-                    for query in queries:
+                for key in missing:
+                    for query in self.queries_by_key[key]:
                         if additional_cols:
                             # We need to include additional orderings in the projection so that we can
                             # sort them in memory. Annoyingly that means reinstantiating the queries
@@ -238,58 +281,91 @@ class QueryByKeys(object):
                             )
 
                         query.Ancestor(key) # Make this an ancestor query
-                        multi_query.append(query)
-                        if len(multi_query) == 30:
-                            final_queries.append(datastore.MultiQuery(multi_query, orderings).Run(limit=to_fetch))
-                            multi_query = []
-                else:
-                    if len(multi_query) == 1:
-                        final_queries.append(multi_query[0].Run(limit=to_fetch))
-                    elif multi_query:
-                        final_queries.append(datastore.MultiQuery(multi_query, orderings).Run(limit=to_fetch))
+                        ancestor_queries.append(query)
 
-                results = chain(*final_queries)
+                if len(ancestor_queries) == 1:
+                    results.extend(ancestor_queries[0].Run(limit=to_fetch, **kwargs))
+                else:
+                    # All the ancestor queries run concurrently
+                    results.extend(ParallelMultiQuery(ancestor_queries, orderings).Run(limit=to_fetch, **kwargs))
             else:
-                results = datastore.Get(self.queries_by_key.keys())
+                try:
+                    fetched = datastore.Get(missing, **get_options(kwargs))
+                except Exception:
+                    if lease:
+                        caching.release_lease(missing[0], lease)
+                    raise
+
+                to_cache = [ x for x in fetched if x is not None ]
+                results.extend(to_cache)
+
+                if not eventual:
+                    # Only entities which came from the datastore need caching
+                    if to_cache:
+                        caching.add_entities_to_cache(
+                            self.model, to_cache, caching.CachingSituation.DATASTORE_GET, lease=lease
+                        )
+
+                    # Remember the keys which don't exist, so we don't keep looking for them. If
+                    # we have a lease, one of these releases it
+                    caching.add_tombstones_to_cache_by_key(
+                        [ key for key, result in zip(missing, fetched) if result is None ], lease=lease
+                    )
 
         def iter_results(results):
             returned = 0
+            start = time.time()
             # This is safe, because Django is fetching all results any way :(
-            sorted_results = sorted(results, cmp=partial(utils.django_ordering_comparison, self.ordering))
-            sorted_results = [result for result in sorted_results if result is not None]
-            if cache and sorted_results:
-                caching.add_entities_to_cache(self.model, sorted_results, caching.CachingSituation.DATASTORE_GET)
+            sorted_results = sorted(
+                (result for result in results if result is not None),
+                key=make_ordering_key(self.ordering)
+            )
+            if len(sorted_results) > 1:
+                query_log.record(
+                    query_log.PYTHON_SORT, self._Query__kind,
+                    duration=time.time() - start, result_count=len(sorted_results)
+                )
+
+            start = time.time()
+            rejected = 0
+            try:
+                for result in sorted_results:
 
-            for result in sorted_results:
+                    if not any(matches(result) for matches in self.matchers_by_key[result.key()]):
+                        rejected += 1
+                        continue
 
-                if not any([ utils.entity_matches_query(result, qry) for qry in self.queries_by_key[result.key()]]):
-                    continue
+                    if offset and returned < offset:
+                        # Skip entities based on offset
+                        returned += 1
+                        continue
+                    else:
 
-                if offset and returned < offset:
-                    # Skip entities based on offset
-                    returned += 1
-                    continue
-                else:
+                        yield _convert_entity_based_on_query_options(result, opts)
 
-                    yield _convert_entity_based_on_query_options(result, opts)
+                        returned += 1
 
-                    returned += 1
-
-                    # If there is a limit, we might be done!
-                    if limit is not None and returned == (offset or 0) + limit:
-                        break
+                        # If there is a limit, we might be done!
+                        if limit is not None and returned == (offset or 0) + limit:
+                            break
+            finally:
+                if rejected:
+                    query_log.record(
+                        query_log.PYTHON_FILTER, self._Query__kind,
+                        duration=time.time() - start, result_count=rejected
+                    )
 
         return iter_results(results)
 
-    def Count(self, limit, offset):
-        return len([ x for x in self.Run(limit, offset) ])
+    def Count(self, limit, offset, **kwargs):
+        return len([ x for x in self.Run(limit, offset, **kwargs) ])
 
 
 class NoOpQuery(object):
-    def Run(self, limit, offset):
+    def Run(self, limit, offset, **kwargs):
         return []
 
-    def Count(self, limit, offset):
+    def Count(self, limit, offset, **kwargs):
         return 0
 
 
@@ -302,6 +378,7 @@ class UniqueQuery(object):
         self._identifier = unique_identifier
         self._gae_query = gae_query
         self._model = model
+        self._matches = utils.compile_entity_matcher(gae_query)
 
         self._Query__kind = gae_query._Query__kind
 
@@ -311,35 +388,49 @@ class UniqueQuery(object):
     def keys(self):
         return self._gae_query.keys()
 
-    def Run(self, limit, offset):
+    def Run(self, limit, offset, **kwargs):
         opts = self._gae_query._Query__query_options
         if opts.keys_only or opts.projection:
-            return self._gae_query.Run(limit=limit, offset=offset)
+            return self._gae_query.Run(limit=limit, offset=offset, **kwargs)
+
+        eventual = is_eventual_read(kwargs)
+
+        ret = caching.get_from_cache(self._identifier, include_tombstones=True)
+        if ret is caching.TOMBSTONE:
+            # We know there's nothing with this unique combination
+            return iter([])
 
-        ret = caching.get_from_cache(self._identifier)
-        if ret is not None and not utils.entity_matches_query(ret, self._gae_query):
+        if ret is not None and not self._matches(ret):
             ret = None
 
         if ret is None:
             # We do a fast keys_only query to get the result
             keys_query = Query(self._gae_query._Query__kind, keys_only=True)
             keys_query.update(self._gae_query)
-            keys = keys_query.Run(limit=limit, offset=offset)
+            keys = keys_query.Run(limit=limit, offset=offset, **kwargs)
 
             # Do a consistent get so we don't cache stale data, and recheck the result matches the query
-            ret = [ x for x in datastore.Get(keys) if x and utils.entity_matches_query(x, self._gae_query) ]
-            if len(ret) == 1:
+            keys = list(keys)
+            ret = [
+                x for x in datastore.Get(keys, **get_options(kwargs))
+                if x and self._matches(x)
+            ] if keys else []
+
+            # Eventually consistent reads may be stale, so we don't cache them. We never write a
+            # tombstone here, the keys query is eventually consistent so an empty result doesn't
+            # mean that nothing exists
+            if not eventual and len(ret) == 1:
                 caching.add_entities_to_cache(self._model, [ret[0]], caching.CachingSituation.DATASTORE_GET)
             return iter(ret)
 
         return iter([ ret ])
 
-    def Count(self, limit, offset):
-        return sum(1 for x in self.Run(limit, offset))
+    def Count(self, limit, offset, **kwargs):
+        return sum(1 for x in self.Run(limit, offset, **kwargs))
 
 
 from djangae.db.backends.appengine.query import transform_query
-from djangae.db.backends.appengine.dnf import normalize_query
+from djangae.db.backends.appengine.plan_cache import query_plan_cache
 
 def convert_django_ordering_to_gae(ordering):
     result = []
@@ -351,11 +442,53 @@ def convert_django_ordering_to_gae(ordering):
             result.append((column, datastore.Query.ASCENDING))
     return result
 
-def wrap_result_with_functor(results, func):
-    for result in results:
-        result = func(result)
-        if result is not None:
-            yield result
+class FakeEntity(dict):
+    """ Stands in for an entity when a keys only query only gives us the key """
+    def __init__(self, key):
+        self._key = key
+
+    def key(self):
+        return self._key
+
+
+EXTRA_SELECT_DATE_FORMATS = ("%Y-%m-%d", "%Y-%m-%d %H:%M:%S")
+
+
+def _compile_extra_select_arg(arg, model_columns):
+    """
+        Returns a function which takes a result and returns the value of
+        the extra select argument for it
+    """
+    if arg.startswith("'") and arg.endswith("'"):
+        # String literal
+        value = arg.strip("'")
+        # Check to see if this is a date
+        for date_format in EXTRA_SELECT_DATE_FORMATS:
+            try:
+                value = datetime.strptime(value, date_format)
+                break
+            except ValueError:
+                continue
+        return lambda result: value
+    elif arg in model_columns:
+        # Column value
+        return lambda result: result.get(arg)
+
+    # Handle NULL
+    if arg.lower() == 'null':
+        value = None
+    elif arg.lower() == 'true':
+        value = True
+    elif arg.lower() == 'false':
+        value = False
+    else:
+        # See if it's an integer, otherwise it's just a plain old literal
+        try:
+            value = int(arg)
+        except (TypeError, ValueError):
+            value = arg
+
+    return lambda result: value
 
 
 def can_perform_datastore_get(normalized_query):
@@ -390,18 +523,18 @@ class SelectCommand(object):
         self.connection = connection
 
         self.query = transform_query(connection, query)
-        self.query.prepare()
-        self.query = normalize_query(self.query)
+        self.query = query_plan_cache.prepare_and_normalize(self.query)
 
         self.original_query = query
         self.keys_only = (keys_only or [x.field for x in query.select] == [ query.model._meta.pk ])
-
-        # MultiQuery doesn't support keys_only
-        if self.query.where and len(self.query.where.children) > 1:
-            self.keys_only = False
-
         self.excluded_pks = self.query.excluded_pks
 
+        # Cursors are passed down from the queryset in the query context (see djangae.db.models)
+        context = getattr(query, "context", None) or {}
+        self.start_cursor = context.get("datastore_start_cursor")
+        self.end_cursor = context.get("datastore_end_cursor")
+        self.datastore_options = context.get("datastore_options") or {}
+
     def __eq__(self, other):
         return (isinstance(other, self.__class__)
             and self.query.serialize() == other.query.serialize())
@@ -425,6 +558,29 @@ class SelectCommand(object):
             (opts.pk.column, copts.pk.column)
         ]
 
+    def _branch_query_kwargs(self, query_kwargs, filters, sort_columns):
+        """
+            When several branches are merged we need the sort values of each result. Keys only
+            and projection queries don't return them all, so the missing ones are added to the
+            projection. Columns with an equality filter in the branch can't be projected, but
+            ParallelMultiQuery knows their value from the filter.
+        """
+        projection = query_kwargs["projection"] or []
+        equality_columns = set(x.column for x in filters if x.operator == "=")
+
+        missing = [
+            x for x in sort_columns
+            if x != "__key__" and x not in equality_columns and x not in projection
+        ]
+
+        if not missing:
+            return query_kwargs
+
+        query_kwargs = query_kwargs.copy()
+        query_kwargs["keys_only"] = None
+        query_kwargs["projection"] = projection + missing
+        return query_kwargs
+
     def _build_query(self):
         self._sanity_check()
 
@@ -460,15 +616,24 @@ class SelectCommand(object):
 
         assert self.query.where
 
+        # Keys only and projection branches which need merging may have to include the sort columns
+        sort_columns = None
+        if len(self.query.where.children) > 1 and (self.keys_only or projection):
+            sort_columns = [ x if isinstance(x, basestring) else x[0] for x in ordering ]
+
         # Go through the normalized query tree
         for and_branch in self.query.where.children:
-            query = Query(
-                **query_kwargs
-            )
-
             # This deals with the oddity that the root of the tree may well be a leaf
             filters = [ and_branch ] if and_branch.is_leaf else and_branch.children
 
+            branch_kwargs = query_kwargs
+            if sort_columns:
+                branch_kwargs = self._branch_query_kwargs(query_kwargs, filters, sort_columns)
+
+            query = Query(
+                **branch_kwargs
+            )
+
             for filter_node in filters:
                 lookup = "{} {}".format(filter_node.column, filter_node.operator)
 
@@ -509,6 +674,13 @@ class SelectCommand(object):
                     raise NotSupportedError(e)
             queries.append(query)
 
+        if self.start_cursor or self.end_cursor:
+            # Cursors are a position in a single datastore query, so we can't
+            # use any of the optimizations below
+            if len(queries) > 1:
+                raise NotSupportedError("Cursors are not supported on queries with OR or IN filters")
+            return queries[0]
+
         if can_perform_datastore_get(self.query):
             # Yay for optimizations!
             return QueryByKeys(self.query.model, queries, ordering)
@@ -521,7 +693,7 @@ class SelectCommand(object):
 
             return queries[0]
         else:
-            return datastore.MultiQuery(queries, ordering)
+            return ParallelMultiQuery(queries, ordering, keys_only=self.keys_only)
 
     def _fetch_results(self, query):
         # If we're manually excluding PKs, and we've specified a limit to the results
@@ -540,6 +712,13 @@ class SelectCommand(object):
         limit = None if high_mark is None else (high_mark - (low_mark or 0))
         offset = low_mark or 0
 
+        # Options for the datastore RPCs (see djangae.db.models.set_datastore_options)
+        run_kwargs = dict(self.datastore_options)
+        if self.start_cursor:
+            run_kwargs["start_cursor"] = self.start_cursor
+        if self.end_cursor:
+            run_kwargs["end_cursor"] = self.end_cursor
+
         if self.query.kind == "COUNT":
             if self.excluded_pks:
                 # If we're excluding pks, relying on a traditional count won't work
@@ -550,155 +729,227 @@ class SelectCommand(object):
                 # didn't seem to indicate much of a performance difference, even when doing the pk__in
                 # with GetAsync while the count was running. That might not be true of prod though so
                 # if anyone comes up with a faster idea let me know!
-                count_query = Query(query._Query__kind, keys_only=True)
-                count_query.update(query)
-                resultset = count_query.Run(limit=limit, offset=offset)
+                if isinstance(query, ParallelMultiQuery):
+                    count_query = query.keys_only_query()
+                else:
+                    count_query = Query(query._Query__kind, keys_only=True)
+                    count_query.update(query)
+                start = time.time()
+                resultset = list(count_query.Run(limit=limit, offset=offset, **run_kwargs))
                 self.results = (x for x in [ len([ y for y in resultset if y not in self.excluded_pks]) ])
+                query_log.record(
+                    query_log.EXCLUDED_PK_OVERFETCH, self.query.concrete_model._meta.db_table,
+                    duration=time.time() - start, result_count=len(resultset), counted_keys=True
+                )
             else:
-                self.results = (x for x in [query.Count(limit=limit, offset=offset)])
+                self.results = (x for x in [query.Count(limit=limit, offset=offset, **run_kwargs)])
             return
         elif self.query.kind == "AVERAGE":
             raise ValueError("AVERAGE not yet supported")
         else:
-            self.results = query.Run(limit=limit, offset=offset)
+            self.results = query.Run(limit=limit, offset=offset, **run_kwargs)
 
         # Ensure that the results returned is reset
         self.results_returned = 0
+        self.results = self._iter_results(
+            self.results, record_cursor=isinstance(query, Query), overfetch=excluded_pk_count
+        )
 
-        def increment_returned_results(result):
-            self.results_returned += 1
-            return result
-
-        def convert_key_to_entity(result):
-            class FakeEntity(dict):
-                def __init__(self, key):
-                    self._key = key
+    def _iter_results(self, results, record_cursor, overfetch=0):
+        process = self._build_row_processor()
 
-                def key(self):
-                    return self._key
+        start = time.time()
+        skipped = 0
+        try:
+            for result in results:
+                self.results_returned += 1
 
-            return FakeEntity(result)
+                result = process(result)
+                if result is not None:
+                    yield result
+                else:
+                    skipped += 1
+        finally:
+            if self.excluded_pks:
+                query_log.record(
+                    query_log.EXCLUDED_PK_OVERFETCH, self.query.concrete_model._meta.db_table,
+                    duration=time.time() - start, result_count=self.results_returned,
+                    skipped=skipped, overfetch=overfetch
+                )
+
+        if record_cursor:
+            # Once everything has been read, let the queryset know where we got to
+            # so that it can carry on from there
+            context = getattr(self.original_query, "context", None)
+            if context is not None:
+                context["datastore_cursor"] = self.cursor()
+
+    def _build_row_processor(self):
+        """
+            Returns a function which turns a datastore result into the entity we return, or
+            None if the result should be skipped. Everything that doesn't depend on the result
+            is worked out here, once per query, rather than for every row.
+        """
+        keys_only = self.keys_only
+        excluded_pks = self.query.excluded_pks
+        model_fields = self.query.model._meta.fields
+
+        pk_columns = set([
+            self.query.model._meta.pk.column,
+            self.query.concrete_model._meta.pk.column
+        ])
+
+        datetime_columns = [
+            x.column for x in model_fields
+            if x.get_internal_type() in ("DateTimeField", "DateField", "TimeField")
+        ]
 
-        def rename_pk_field(result):
-            if result is None:
-                return result
+        # We handle extra selects by generating the new columns from each result. We
+        # can handle simple boolean logic and operators.
+        model_columns = set(x.column for x in model_fields)
+        extra_selects = [
+            (col, select[0], [ _compile_extra_select_arg(x, model_columns) for x in select[1] ])
+            for col, select in self.query.extra_selects
+        ]
 
-            value = result.key().id_or_name()
-            result[self.query.model._meta.pk.column] = value
-            result[self.query.concrete_model._meta.pk.column] = value
-            return result
+        # If we had extra selects, and we're distinct, we must deduplicate results
+        distinct_columns = None
+        if self.query.distinct and self.query.extra_selects:
+            # FIXME: This logic can't be right. I think we need to store the distinct fields
+            # somewhere on the query
+            if getattr(self.original_query, "annotation_select", None):
+                columns = self.original_query.annotation_select.keys()
+            else:
+                columns = self.query.columns or []
 
-        def process_extra_selects(result):
-            """
-                We handle extra selects by generating the new columns from
-                each result. We can handle simple boolean logic and operators.
-            """
-            extra_selects = self.query.extra_selects
-            model_fields = self.query.model._meta.fields
-
-            DATE_FORMATS = ("%Y-%m-%d", "%Y-%m-%d %H:%M:%S")
-
-            def process_arg(arg):
-                if arg.startswith("'") and arg.endswith("'"):
-                    # String literal
-                    arg = arg.strip("'")
-                    # Check to see if this is a date
-                    for date in DATE_FORMATS:
-                        try:
-                            value = datetime.strptime(arg, date)
-                            return value
-                        except ValueError:
-                            continue
-                    return arg
-                elif arg in [ x.column for x in model_fields ]:
-                    # Column value
-                    return result.get(arg)
-
-                # Handle NULL
-                if arg.lower() == 'null':
-                    return None
-                elif arg.lower() == 'true':
-                    return True
-                elif arg.lower() == 'false':
-                    return False
+            if columns:
+                distinct_columns = self._exclude_pk(columns)
+        seen = set()
 
-                # See if it's an integer
-                try:
-                    arg = int(arg)
-                except (TypeError, ValueError):
-                    pass
+        def process(result):
+            # If this is a keys only query, we need to generate a fake entity
+            # for each key in the result set
+            if keys_only:
+                result = FakeEntity(result)
 
-                # Just a plain old literal
-                return arg
+            key = result.key()
+            if key in excluded_pks:
+                return None
 
-            for col, select in extra_selects:
-                result[col] = select[0](*[ process_arg(x) for x in select[1] ])
+            for column in datetime_columns:
+                value = result.get(column)
+                if value is not None:
+                    result[column] = ensure_datetime(value)
 
-            return result
+            value = key.id_or_name()
+            for column in pk_columns:
+                result[column] = value
 
-        def convert_datetime_fields(result):
-            fields = [
-                x for x in self.query.model._meta.fields
-                if x.get_internal_type() in ("DateTimeField", "DateField", "TimeField")
-            ]
+            for column, func, args in extra_selects:
+                result[column] = func(*[ arg(result) for arg in args ])
 
-            for field in fields:
-                column = field.column
-                if isinstance(result, dict): # sometimes it's a key!
-                    value = result.get(column)
-                else:
-                    value = None
+            if distinct_columns is not None:
+                distinct_key = tuple([ result[x] for x in distinct_columns if x in result ])
+                if distinct_key in seen:
+                    return None
+                seen.add(distinct_key)
 
-                if value is not None:
-                    result[column] = ensure_datetime(value)
             return result
 
-        def ignore_excluded_pks(result):
-            if result.key() in self.query.excluded_pks:
-                return None
-            return result
+        return process
 
-        self.results = wrap_result_with_functor(self.results, increment_returned_results)
 
-        # If this is a keys only query, we need to generate a fake entity
-        # for each key in the result set
-        if self.keys_only:
-            self.results = wrap_result_with_functor(self.results, convert_key_to_entity)
+    def execute(self):
+        self.gae_query = self._build_query()
+        self._fetch_results(self.gae_query)
 
-        self.results = wrap_result_with_functor(self.results, ignore_excluded_pks)
-        self.results = wrap_result_with_functor(self.results, convert_datetime_fields)
-        self.results = wrap_result_with_functor(self.results, rename_pk_field)
-        self.results = wrap_result_with_functor(self.results, process_extra_selects)
+    def explain(self):
+        """
+            Returns a dictionary describing how the query would be run, without running it:
+
+            - `kind` - The datastore kind which is queried
+            - `strategy` - "get_by_keys", "unique_lookup", "query" or "parallel_multiquery"
+            - `branches` - The filters of each datastore query, one per branch of the normalized where
+            - `ordering`, `keys_only`, `projection` and `distinct` - As passed to the datastore
+            - `caches` - The caches which are checked before going to the datastore, in order
+            - `rpcs` - The most datastore RPCs it takes to get the first batch of results
+            - `post_processing` - The work done on the results in Python, see query_log for
+              what the categories mean
+        """
+        gae_query = self._build_query()
 
-        if self.query.distinct and self.query.extra_selects:
-            # If we had extra selects, and we're distinct, we must deduplicate results
-            def deduper_factory():
-                seen = set()
-
-                def dedupe(result):
-                    # FIXME: This logic can't be right. I think we need to store the distinct fields
-                    # somewhere on the query
-                    if getattr(self.original_query, "annotation_select", None):
-                        columns = self.original_query.annotation_select.keys()
-                    else:
-                        columns = self.query.columns or []
-                    if not columns:
-                        return result
+        if isinstance(gae_query, (QueryByKeys, ParallelMultiQuery)):
+            queries = gae_query.queries
+        elif isinstance(gae_query, UniqueQuery):
+            queries = [ gae_query._gae_query ]
+        else:
+            queries = [ gae_query ]
 
-                    key = tuple([ result[x] for x in self._exclude_pk(columns) if x in result ])
-                    if key in seen:
-                        return None
-                    seen.add(key)
-                    return result
+        opts = queries[0]._Query__query_options
+        projection = list(opts.projection) if opts.projection else None
 
-                return dedupe
+        caches = []
+        post_processing = []
+        if isinstance(gae_query, QueryByKeys):
+            strategy = "get_by_keys"
+            caches = caching.get_enabled_cache_tiers(self.query.model)
 
-            self.results = wrap_result_with_functor(self.results, deduper_factory())
+            # Projections are done with an ancestor query per key, otherwise it's a single Get
+            rpcs = len(queries) if projection else 1
 
+            if len(gae_query.queries_by_key) > 1:
+                post_processing.append(query_log.PYTHON_SORT)
 
-    def execute(self):
-        self.gae_query = self._build_query()
-        self._fetch_results(self.gae_query)
+            if any(lookup != "__key__ =" for query in queries for lookup in query.keys()):
+                post_processing.append(query_log.PYTHON_FILTER)
+        elif isinstance(gae_query, UniqueQuery):
+            strategy = "unique_lookup"
+            if opts.keys_only or projection:
+                rpcs = 1
+            else:
+                # A keys only query followed by a Get, unless the entity is cached
+                caches = caching.get_enabled_cache_tiers(self.query.model)
+                rpcs = 2
+                post_processing.append(query_log.PYTHON_FILTER)
+        elif isinstance(gae_query, ParallelMultiQuery):
+            strategy = "parallel_multiquery"
+            rpcs = len(queries)
+            post_processing.append(query_log.MULTIQUERY)
+        else:
+            strategy = "query"
+            rpcs = 1
+
+        if self.excluded_pks:
+            post_processing.append(query_log.EXCLUDED_PK_OVERFETCH)
+
+        if self.query.extra_selects:
+            post_processing.append("extra_select")
+
+            if self.query.distinct:
+                post_processing.append("distinct")
+
+        return {
+            "kind": queries[0]._Query__kind,
+            "query_kind": self.query.kind,
+            "strategy": strategy,
+            "branches": [ dict(query) for query in queries ],
+            "ordering": convert_django_ordering_to_gae(self.query.order_by),
+            "keys_only": bool(opts.keys_only),
+            "projection": projection,
+            "distinct": bool(self.query.distinct),
+            "caches": caches,
+            "rpcs": rpcs,
+            "post_processing": post_processing,
+        }
+
+    def cursor(self):
+        """
+            Returns a cursor for the position after the last result read, or None
+            if the query wasn't a single datastore query
+        """
+        if not isinstance(getattr(self, "gae_query", None), Query):
+            return None
+        return self.gae_query.GetCursor()
 
     def __unicode__(self):
         try:
@@ -747,6 +998,8 @@ class FlushCommand(object):
         self.table = table
 
     def execute(self):
+        batching.flush()
+
         table = self.table
         query = datastore.Query(table, keys_only=True)
         while query.Count():
@@ -764,10 +1017,108 @@ class FlushCommand(object):
         clear_context_cache()
 
 @db.non_transactional
-def reserve_id(kind, id_or_name):
+def reserve_ids(keys):
+    """ Tells App Engine that we are using the ids of the keys, in a single RPC """
     from google.appengine.api.datastore import _GetConnection
-    key = datastore.Key.from_path(kind, id_or_name)
-    _GetConnection()._async_reserve_keys(None, [key])
+    if keys:
+        _GetConnection()._async_reserve_keys(None, keys)
+
+
+def reserve_id(kind, id_or_name):
+    reserve_ids([datastore.Key.from_path(kind, id_or_name)])
+
+
+def _batch_keys_by_entity_group(keys, max_entity_groups):
+    """
+        Splits the keys into lists which each contain keys from no more than
+        max_entity_groups entity groups
+    """
+    batches = []
+    groups = set()
+    for key in keys:
+        root = key
+        while root.parent():
+            root = root.parent()
+
+        if root not in groups and len(groups) == max_entity_groups:
+            groups = set()
+        if not groups:
+            batches.append([])
+
+        groups.add(root)
+        batches[-1].append(key)
+
+    return batches
+
+
+def run_concurrently(funcs, max_threads=None, on_result=None):
+    """
+        Calls each of the functions, with up to max_threads running at once, and returns
+        their results in the same order. Each thread has its own datastore connection, so
+        each function can run its own transaction. If any of the functions raised, then once
+        they have all finished the first of the exceptions is re-raised.
+
+        If on_result is passed, it's called with (index, result) in this thread as each of
+        the functions finishes successfully. Anything the functions record in the query log
+        is added to this thread's.
+    """
+    max_threads = max_threads or MAX_CONCURRENT_TRANSACTIONS
+
+    if len(funcs) < 2 or max_threads < 2:
+        results = []
+        for i, func in enumerate(funcs):
+            results.append(func())
+            if on_result:
+                on_result(i, results[-1])
+        return results
+
+    results = [ None ] * len(funcs)
+    errors = [ None ] * len(funcs)
+
+    pending = Queue.Queue()
+    for i, func in enumerate(funcs):
+        pending.put((i, func))
+
+    finished = Queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                i, func = pending.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                result, error = func(), None
+            except Exception:
+                result, error = None, sys.exc_info()
+
+            # The query log is thread local, so the events go back with the result
+            finished.put((i, result, error, query_log.take_thread_events()))
+
+    threads = [ threading.Thread(target=worker) for x in xrange(min(max_threads, len(funcs))) ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        for x in xrange(len(funcs)):
+            i, results[i], errors[i], events = finished.get()
+            query_log.add_events(events)
+
+            if on_result and errors[i] is None:
+                try:
+                    on_result(i, results[i])
+                except Exception:
+                    errors[i] = sys.exc_info()
+    finally:
+        for thread in threads:
+            thread.join()
+
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    return results
 
 
 class InsertCommand(object):
@@ -793,48 +1144,108 @@ class InsertCommand(object):
                 django_instance_to_entity(connection, model, fields, raw, obj)
             )
 
+    def _insert_with_key(self, key, ent):
+        """ Puts the entity in its own transaction, if nothing exists with its key """
+
+        @db.transactional
+        def txn():
+            if key is not None:
+                if utils.key_exists(key):
+                    raise IntegrityError("Tried to INSERT with existing key")
+
+            if not constraints.constraint_checks_enabled(self.model):
+                # Fast path, just insert
+                return datastore.Put(ent)
+
+            markers = constraints.acquire(self.model, ent)
+            try:
+                return datastore.Put(ent)
+            except:
+                # Make sure we delete any created markers before we re-raise
+                constraints.release_markers(markers)
+                raise
+
+        return txn()
+
+    def _can_batch(self):
+        """
+            Returns True if the insert can be queued. Inserts with keys have to check that
+            nothing exists with the key first, and unique markers have to be acquired straight
+            away, so they can't be.
+        """
+        return (
+            not datastore.IsInTransaction() and
+            not (self.has_pk and not has_concrete_parents(self.model)) and
+            not constraints.has_unique_markers(self.model)
+        )
+
     def execute(self):
+        batch = batching.get_batch()
+        if batch is not None:
+            if self._can_batch():
+                return batch.put(self.model, self.entities)
+            batch.flush()
+
         if self.has_pk and not has_concrete_parents(self.model):
-            results = []
             # We are inserting, but we specified an ID, we need to check for existence before we Put()
             # We do it in a loop so each check/put is transactional - because it's an ancestor query it shouldn't
             # cost any entity groups
 
             was_in_transaction = datastore.IsInTransaction()
 
-            for key, ent in zip(self.included_keys, self.entities):
-                @db.transactional
-                def txn():
-                    if key is not None:
-                        if utils.key_exists(key):
-                            raise IntegrityError("Tried to INSERT with existing key")
+            keys = [ key for key in self.included_keys if key is not None ]
+            for key in keys:
+                id_or_name = key.id_or_name()
+                if isinstance(id_or_name, basestring) and id_or_name.startswith("__"):
+                    raise NotSupportedError("Datastore ids cannot start with __. Id was %s" % id_or_name)
+
+            concurrent = not was_in_transaction and len(self.entities) > 1
+            if concurrent and keys:
+                if len(set(keys)) != len(keys):
+                    raise IntegrityError("Tried to INSERT the same key more than once")
+
+                # A single Get finds any existing keys before we write anything, each transaction
+                # still checks its own key in case something is written in the meantime
+                if any(x is not None for x in datastore.Get(keys)):
+                    raise IntegrityError("Tried to INSERT with existing key")
+
+            # Make sure we notify app engine that we are using these IDs
+            # FIXME: Copy ancestor across to the template key
+            reserve_ids(keys)
+
+            if not concurrent:
+                results = []
+                for key, ent in zip(self.included_keys, self.entities):
+                    results.append(self._insert_with_key(key, ent))
+
+                    if not was_in_transaction:
+                        caching.add_entities_to_cache(self.model, [ent], caching.CachingSituation.DATASTORE_GET_PUT)
+                    else:
+                        # This wipes out anything memcache has for the key (e.g. a tombstone)
+                        caching.add_entities_to_cache(self.model, [ent], caching.CachingSituation.DATASTORE_PUT)
+                return results
 
-                    id_or_name = key.id_or_name()
-                    if isinstance(id_or_name, basestring) and id_or_name.startswith("__"):
-                        raise NotSupportedError("Datastore ids cannot start with __. Id was %s" % id_or_name)
+            # Each transaction only touches its own entity group, so they can all run at once. The
+            # caches are thread local, so we fill them once we're back in this thread
+            written = []
 
-                    if not constraints.constraint_checks_enabled(self.model):
-                        # Fast path, just insert
-                        results.append(datastore.Put(ent))
-                    else:
-                        markers = constraints.acquire(self.model, ent)
-                        try:
-                            results.append(datastore.Put(ent))
-                            if not was_in_transaction:
-                                # We can cache if we weren't in a transaction before this little nested one
-                                caching.add_entities_to_cache(self.model, [ent], caching.CachingSituation.DATASTORE_GET_PUT)
-                        except:
-                            # Make sure we delete any created markers before we re-raise
-                            constraints.release_markers(markers)
-                            raise
-
-                # Make sure we notify app engine that we are using this ID
-                # FIXME: Copy ancestor across to the template key
-                reserve_id(key.kind(), key.id_or_name())
-
-                txn()
+            def insert(key, ent):
+                result = self._insert_with_key(key, ent)
+                written.append(ent)
+                return result
 
-            return results
+            inserts = [
+                (lambda key=key, ent=ent: insert(key, ent))
+                for key, ent in zip(self.included_keys, self.entities)
+            ]
+
+            try:
+                return run_concurrently(inserts)
+            finally:
+                # Anything which was written needs caching (or its tombstones wiping out), even if
+                # another insert failed
+                if written:
+                    caching.add_entities_to_cache(self.model, written, caching.CachingSituation.DATASTORE_GET_PUT)
         else:
             if not constraints.constraint_checks_enabled(self.model):
                 # Fast path, just bulk insert
@@ -896,7 +1307,57 @@ class DeleteCommand(object):
         self.model = query.model
         self.select = SelectCommand(connection, query, keys_only=True)
 
+        # The order we find the keys in doesn't matter, and without an ordering
+        # OR queries can be merged using nothing but keys
+        self.select.query.order_by = []
+
+    def _delete_keys_async(self, keys):
+        # Send the deletes in chunks, all at once
+        return [
+            datastore.DeleteAsync(keys[i:i + MAX_KEYS_PER_DELETE])
+            for i in xrange(0, len(keys), MAX_KEYS_PER_DELETE)
+        ]
+
+    def _delete_keys(self, keys):
+        for rpc in self._delete_keys_async(keys):
+            rpc.get_result()
+
+    def _keys_to_delete(self):
+        gae_query = self.select._build_query()
+        if isinstance(gae_query, QueryByKeys) and all(
+            lookup == "__key__ =" for query in gae_query.queries for lookup in query.keys()
+        ):
+            # We were given the keys (e.g. Django deleting a batch of pks), there's no
+            # need to look them up. Deleting a key which doesn't exist does nothing.
+            return [
+                key for key in gae_query.queries_by_key.keys()
+                if key not in self.select.excluded_pks
+            ]
+
+        self.select.execute()
+        return [ x.key() for x in self.select.results ]
+
     def execute(self):
+        batch = batching.get_batch()
+
+        if not constraints.has_unique_markers(self.model):
+            # There are no unique markers to release, so the keys are all we need. Any
+            # identifiers other than the pk which are still in memcache just point at the
+            # pk identifier, which we remove (along with any the context cache knows about)
+            keys = self._keys_to_delete()
+            if not keys:
+                return
+
+            if batch is not None and not datastore.IsInTransaction():
+                batch.delete(self.model, keys)
+                return
+
+            batching.flush()
+            caching.remove_entities_from_cache_by_key(keys)
+            self._delete_keys(keys)
+            return
+
+        batching.flush()
         self.select.execute()
 
         # This is a little bit more inefficient than just doing a keys_only query and
@@ -912,15 +1373,35 @@ class DeleteCommand(object):
         if not queries:
             return
 
+        entities = []
         for entity in QueryByKeys(self.model, queries, []).Run():
             keys.append(entity.key())
+            entities.append(entity)
+
+            # Release the unique markers
+            constraints.release(self.model, entity)
 
-            # Delete constraints if that's enabled
-            if constraints.constraint_checks_enabled(self.model):
-                constraints.release(self.model, entity)
+        caching.remove_entities_from_cache(entities)
+        self._delete_keys(keys)
 
+    def execute_async(self):
+        """
+            Like execute(), but returns a WriteFuture rather than waiting for the deletes.
+            The keys are found straight away. Only for models without unique markers.
+        """
+        assert not constraints.has_unique_markers(self.model)
+
+        batching.flush()
+
+        keys = self._keys_to_delete()
         caching.remove_entities_from_cache_by_key(keys)
-        datastore.Delete(keys)
+
+        def callback(results):
+            # Anything read from the datastore while the deletes were running may have been cached
+            if keys:
+                caching.remove_entities_from_cache_by_key(keys)
+
+        return WriteFuture(self._delete_keys_async(keys), callback=callback)
 
     def lower(self):
         """
@@ -933,6 +1414,7 @@ class UpdateCommand(object):
     def __init__(self, connection, query):
         self.model = query.model
         self.select = SelectCommand(connection, query, keys_only=True)
+        self.select.query.order_by = [] # See DeleteCommand
         self.values = query.values
         self.connection = connection
 
@@ -942,26 +1424,16 @@ class UpdateCommand(object):
         """
         return str(self).lower()
 
-    @db.transactional
-    def _update_entity(self, key):
-        caching.remove_entities_from_cache_by_key([key])
-
-        try:
-            result = datastore.Get(key)
-        except datastore_errors.EntityNotFoundError:
-            # Return false to indicate update failure
-            return False
-
-        if (
-            isinstance(self.select.gae_query, (Query, UniqueQuery)) # ignore QueryByKeys and NoOpQuery
-            and not utils.entity_matches_query(result, self.select.gae_query)
-        ):
+    def _apply_update(self, result):
+        """
+            Updates the entity with the new values, returns False (leaving the entity alone)
+            if it no longer matches the query
+        """
+        if self._matches is not None and not self._matches(result):
             # Due to eventual consistency they query may have returned an entity which no longer
             # matches the query
             return False
 
-        original = copy.deepcopy(result)
-
         instance_kwargs = {field.attname:value for field, param, value in self.values}
 
         # Note: If you replace MockInstance with self.model, you'll find that some delete
@@ -993,35 +1465,133 @@ class UpdateCommand(object):
         if POLYMODEL_CLASS_ATTRIBUTE in result:
             result[POLYMODEL_CLASS_ATTRIBUTE] = list(set(result[POLYMODEL_CLASS_ATTRIBUTE]))
 
+        return True
+
+    def _put_updated(self, originals, results):
+        """ Puts the updated entities, moving their unique markers if necessary """
         if not constraints.constraint_checks_enabled(self.model):
             # The fast path, no constraint checking
-            datastore.Put(result)
-            caching.add_entities_to_cache(self.model, [result], caching.CachingSituation.DATASTORE_PUT)
+            datastore.Put(results)
+            return
+
+        acquired = []
+        to_release = []
+        try:
+            for original, result in zip(originals, results):
+                markers_to_acquire, markers_to_release = constraints.get_markers_for_update(
+                    self.model, original, result
+                )
+
+                # Acquire first, because if that fails then we don't want to alter what's already there
+                constraints.acquire_identifiers(markers_to_acquire, result.key())
+                acquired.extend(markers_to_acquire)
+                to_release.extend(markers_to_release)
+
+            datastore.Put(results)
+        except:
+            constraints.release_identifiers(acquired)
+            raise
         else:
-            to_acquire, to_release = constraints.get_markers_for_update(self.model, original, result)
+            # Now we release the ones we don't want anymore
+            constraints.release_identifiers(to_release)
 
-            # Acquire first, because if that fails then we don't want to alter what's already there
-            constraints.acquire_identifiers(to_acquire, result.key())
-            try:
-                datastore.Put(result)
-                caching.add_entities_to_cache(self.model, [result], caching.CachingSituation.DATASTORE_PUT)
-            except:
-                constraints.release_identifiers(to_acquire)
-                raise
-            else:
-                # Now we release the ones we don't want anymore
-                constraints.release_identifiers(to_release)
+    @db.transactional
+    def _update_entity(self, key):
+        try:
+            result = datastore.Get(key)
+        except datastore_errors.EntityNotFoundError:
+            caching.remove_entities_from_cache_by_key([key])
+
+            # Return false to indicate update failure
+            return False
+
+        # We have the entity, so we know all of its identifiers
+        caching.remove_entities_from_cache([result])
+
+        original = copy.deepcopy(result)
+        if not self._apply_update(result):
+            return False
+
+        self._put_updated([original], [result])
+        caching.add_entities_to_cache(self.model, [result], caching.CachingSituation.DATASTORE_PUT)
 
         # Return true to indicate update success
         return True
 
+    def _update_entities(self, keys):
+        """
+            Updates the entities in a single cross-group transaction, and returns the ones
+            which were updated. This doesn't touch the caches, as it may be run in another thread.
+        """
+
+        @db.transactional(xg=True)
+        def txn():
+            originals = []
+            results = []
+            for result in datastore.Get(keys):
+                if result is None:
+                    continue
+
+                original = copy.deepcopy(result)
+                if self._apply_update(result):
+                    originals.append(original)
+                    results.append(result)
+
+            if results:
+                self._put_updated(originals, results)
+            return results
+
+        return txn()
+
     def execute(self):
+        batching.flush()
         self.select.execute()
 
-        i = 0
-        for result in self.select.results:
-            if self._update_entity(result.key()):
-                # Only increment the count if we successfully updated
-                i += 1
+        self._matches = None
+        if isinstance(self.select.gae_query, (Query, UniqueQuery, ParallelMultiQuery)): # ignore QueryByKeys and NoOpQuery
+            gae_query = self.select.gae_query
+            self._matches = utils.compile_entity_matcher(
+                gae_query._gae_query if isinstance(gae_query, UniqueQuery) else gae_query
+            )
+
+        if datastore.IsInTransaction():
+            # We can't start our own transactions, so everything happens in this one
+            i = 0
+            for result in self.select.results:
+                if self._update_entity(result.key()):
+                    # Only increment the count if we successfully updated
+                    i += 1
+
+            return i
+
+        # Update the entities in cross-group transactions of as many entity groups as
+        # we're allowed, running several transactions at once
+        batches = _batch_keys_by_entity_group(
+            [ result.key() for result in self.select.results ], MAX_ENTITY_GROUPS_PER_TRANSACTION
+        )
+
+        uncached = set()
+
+        def batch_updated(i, results):
+            # The caches are thread local, so this happens back in this thread as each batch
+            # commits, rather than once they all have. Like _update_entity we only invalidate
+            # memcache, another request may already have written a newer version of an entity
+            caching.remove_entities_from_cache_by_key(batches[i])
+            uncached.add(i)
+            if results:
+                caching.add_entities_to_cache(
+                    self.model, results, caching.CachingSituation.DATASTORE_PUT, skip_memcache=True
+                )
+
+        try:
+            updated = run_concurrently(
+                [ (lambda keys=keys: self._update_entities(keys)) for keys in batches ],
+                on_result=batch_updated
+            )
+        finally:
+            # A batch which raised may still have been committed
+            failed = [ key for index, keys in enumerate(batches) if index not in uncached for key in keys ]
+            if failed:
+                caching.remove_entities_from_cache_by_key(failed)
 
-        return i
+        return sum(len(results) for results in updated)
@@ -1,25 +1,130 @@
 import copy
 import collections
+import datetime
+import itertools
+import time
 
-from google.appengine.api import datastore
+from django.conf import settings
+from google.appengine.api import datastore, datastore_types, users
 
-class CopyDict(collections.MutableMapping):
+
+# Limits for each context in the stack, None means unbounded. When a limit is exceeded the least
+# recently used entities are evicted from the context
+CONTEXT_CACHE_MAX_BYTES = getattr(settings, "DJANGAE_CONTEXT_CACHE_MAX_BYTES", None)
+CONTEXT_CACHE_MAX_ENTRIES = getattr(settings, "DJANGAE_CONTEXT_CACHE_MAX_ENTRIES", None)
+
+
+# Property values of these types can't be mutated in place, so they can be shared
+# between a snapshot and every entity thawed from it
+_IMMUTABLE_TYPES = (
+    basestring, int, long, float, bool, type(None),
+    datetime.datetime, datetime.date, datetime.time,
+    datastore_types.Key, datastore_types.GeoPt, users.User
+)
+
+
+class _FrozenList(tuple):
+    """ A list property value, stored as a tuple so that nobody can modify it """
+    pass
+
+
+class _FrozenValue(object):
+    """ Any other (potentially mutable) value, which we have to copy in and out """
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = copy.deepcopy(value)
+
+
+def _freeze(value):
+    if isinstance(value, _IMMUTABLE_TYPES):
+        return value
+    elif isinstance(value, list) and all(isinstance(x, _IMMUTABLE_TYPES) for x in value):
+        return _FrozenList(value)
+    return _FrozenValue(value)
+
+
+def _estimate_size(value):
+    """
+        Returns a rough idea of the number of bytes a property value uses. This doesn't
+        need to be accurate, it just needs to grow with the size of the entity.
+    """
+    if isinstance(value, basestring):
+        return len(value)
+    elif isinstance(value, _FrozenValue):
+        return _estimate_size(value.value)
+    elif isinstance(value, (list, tuple)):
+        return sum(_estimate_size(x) for x in value)
+    return 16
+
+
+def _thaw(value):
+    if isinstance(value, _FrozenList):
+        return list(value)
+    elif isinstance(value, _FrozenValue):
+        return copy.deepcopy(value.value)
+    return value
+
+
+class EntitySnapshot(object):
+    """
+        An immutable copy of an entity. A snapshot is taken once when an entity enters
+        the context cache and from then on it is shared (between identifiers, between
+        stacked contexts, and across copies of the stack).
+
+        Reading hands out a fresh entity which shares all the immutable property values
+        with the snapshot, only list values are copied. This means callers can modify
+        what they are given without affecting the cache, without us having to deepcopy
+        the entity on every access.
+    """
+    __slots__ = ("key", "size", "_entity_class", "_attributes", "_items", "_needs_thawing")
+
+    def __init__(self, entity):
+        self.key = entity.key()
+        self._entity_class = type(entity)
+        self._attributes = entity.__dict__.copy()
+        self._items = tuple((k, _freeze(v)) for k, v in entity.iteritems())
+        self._needs_thawing = any(
+            isinstance(v, (_FrozenList, _FrozenValue)) for k, v in self._items
+        )
+        self.size = sum(len(k) + _estimate_size(v) for k, v in self._items)
+
+    def thaw(self):
+        # We bypass __init__ and the property validation in __setitem__, the
+        # values were validated when the original entity was built
+        entity = self._entity_class.__new__(self._entity_class)
+        entity.__dict__.update(self._attributes)
+
+        if self._needs_thawing:
+            dict.update(entity, ((k, _thaw(v)) for k, v in self._items))
+        else:
+            dict.update(entity, self._items)
+        return entity
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class SnapshotDict(collections.MutableMapping):
     """
         It's important we don't pass references around in and out
-        of the cache, so this just ensures we copy stuff going in, and
-        copy it going out!
+        of the cache. Entities are frozen into an EntitySnapshot on the way in,
+        and a new copy of the entity is thawed from the snapshot on the way out.
     """
     def __init__(self, *args, **kwargs):
         self._store = {}
-        super(CopyDict, self).__init__(*args, **kwargs)
+        super(SnapshotDict, self).__init__(*args, **kwargs)
 
     def __setitem__(self, key, value):
-        value = copy.deepcopy(value)
+        if not isinstance(value, EntitySnapshot):
+            value = EntitySnapshot(value)
         self._store[key] = value
 
     def __getitem__(self, key):
-        value = self._store[key]
-        return copy.deepcopy(value)
+        return self._store[key].thaw()
 
     def __delitem__(self, key):
         del self._store[key]
@@ -30,15 +135,59 @@ class CopyDict(collections.MutableMapping):
     def __len__(self):
         return len(self._store)
 
+    def __contains__(self, key):
+        return key in self._store
+
+    def get_snapshot(self, key):
+        return self._store.get(key)
+
+    def update_snapshots(self, other):
+        """ Copies the snapshots from another SnapshotDict without thawing them """
+        self._store.update(other._store)
+
+
 class Context(object):
+    """
+        A single level of the in-context cache. `cache` maps unique identifiers to
+        entity snapshots, `reverse_cache` maps entity keys to their unique identifiers.
+
+        If a context has a max_bytes or max_entries limit, then entities are evicted
+        in least-recently-used order to stay within it. Entities written inside a
+        transaction are never evicted; the stack needs to know about them to evict
+        them from memcache when the transaction is applied.
+    """
 
-    def __init__(self, stack):
-        self.cache = CopyDict()
-        self.reverse_cache = CopyDict()
+    def __init__(self, stack, max_bytes=None, max_entries=None):
+        self.cache = SnapshotDict()
+        self.reverse_cache = {}
         self._stack = stack
 
+        # Identifiers which we know don't exist -> the time that knowledge expires
+        self.tombstones = {}
+
+        # Keys of process cached entities which were written in this context, whether or not
+        # they are cached here. Their generation is replaced when a transaction is applied
+        self.process_cache_keys = set()
+
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+        # Key -> size of each cached entity, and the subset of them we are allowed to evict
+        # in least-recently-used order
+        self._sizes = {}
+        self._lru = collections.OrderedDict()
+
+        self.size_in_bytes = 0
+        self.evictions = 0
+        self.peak_bytes = 0
+        self.peak_entries = 0
+
+    @property
+    def is_root(self):
+        return not self._stack.stack or self._stack.stack[0] is self
+
     def apply(self, other):
-        self.cache.update(other.cache)
+        self.cache.update_snapshots(other.cache)
 
         # We have to delete things that don't exist in the other
         for k in self.cache.keys():
@@ -52,25 +201,105 @@ class Context(object):
             if k not in other.reverse_cache:
                 del self.reverse_cache[k]
 
+        self._sizes = other._sizes.copy()
+        if self.is_root:
+            # Once we're out of the transaction everything can be evicted. Entities keep the order
+            # they were last used in, and those written in the transaction are the most recently used
+            self._lru = collections.OrderedDict((k, None) for k in other._lru if k in other._sizes)
+            for k in other._sizes:
+                if k not in self._lru:
+                    self._lru[k] = None
+
+            # The stack has evicted uncached keys from memcache by now, so they can be forgotten
+            for k in self.reverse_cache.keys():
+                if k not in self._sizes:
+                    del self.reverse_cache[k]
+        else:
+            self._lru = other._lru.copy()
+
+        self.tombstones = other.tombstones.copy()
+
+        self.size_in_bytes = other.size_in_bytes
+        self._enforce_limits()
+
     def cache_entity(self, identifiers, entity, situation):
+        from .caching import CachingSituation
+
         assert hasattr(identifiers, "__iter__")
 
+        key = entity.key()
+        identifiers = tuple(identifiers)
+
+        # Remove any identifiers from a previous version of the entity that no
+        # longer apply
+        for identifier in self.reverse_cache.get(key, ()):
+            if identifier not in identifiers and identifier in self.cache:
+                del self.cache[identifier]
+        self._forget_size(key)
+
+        # Snapshot the entity once, and store the same snapshot against each identifier
+        snapshot = EntitySnapshot(entity)
+        for identifier in identifiers:
+            self.cache[identifier] = snapshot
+            self.tombstones.pop(identifier, None)
+
+        self.reverse_cache[key] = identifiers
+
+        self._sizes[key] = snapshot.size
+        self.size_in_bytes += snapshot.size
+        if situation == CachingSituation.DATASTORE_GET or self.is_root:
+            self._lru[key] = None
+
+        self._enforce_limits()
+
+    def cache_tombstones(self, identifiers, timeout):
+        expires = time.time() + timeout
         for identifier in identifiers:
-            self.cache[identifier] = copy.deepcopy(entity)
+            if identifier not in self.cache:
+                self.tombstones[identifier] = expires
+
+    def has_tombstone(self, identifier):
+        expires = self.tombstones.get(identifier)
+        if expires is None:
+            return False
 
-        self.reverse_cache[entity.key()] = identifiers
+        if expires < time.time():
+            del self.tombstones[identifier]
+            return False
+        return True
+
+    def uncache_entity(self, key):
+        """
+            Removes the entity from the cache. Inside a transaction this context remembers that
+            it has seen the key (so the stack still evicts it from memcache when the transaction
+            is applied), the root has nothing to apply so it forgets it
+        """
+        for identifier in self.reverse_cache.get(key, ()):
+            if identifier in self.cache:
+                del self.cache[identifier]
+        self._forget_size(key)
+
+        if self.is_root:
+            self.reverse_cache.pop(key, None)
 
     def remove_entity(self, entity_or_key):
         if not isinstance(entity_or_key, datastore.Key):
             entity_or_key = entity_or_key.key()
 
         for identifier in self.reverse_cache[entity_or_key]:
-            del self.cache[identifier]
+            if identifier in self.cache:
+                del self.cache[identifier]
 
         del self.reverse_cache[entity_or_key]
+        self._forget_size(entity_or_key)
 
     def get_entity(self, identifier):
-        return self.cache.get(identifier)
+        snapshot = self.cache.get_snapshot(identifier)
+        if snapshot is None:
+            return None
+
+        self._touch(snapshot.key)
+        return snapshot.thaw()
 
     def get_entity_by_key(self, key):
         try:
@@ -79,6 +308,30 @@ class Context(object):
             return None
         return self.get_entity(identifier)
 
+    def _touch(self, key):
+        if key in self._lru:
+            # Move to the most recently used end
+            del self._lru[key]
+            self._lru[key] = None
+
+    def _forget_size(self, key):
+        self.size_in_bytes -= self._sizes.pop(key, 0)
+        self._lru.pop(key, None)
+
+    def _over_limit(self):
+        if self.max_entries is not None and len(self._sizes) > self.max_entries:
+            return True
+        return self.max_bytes is not None and self.size_in_bytes > self.max_bytes
+
+    def _enforce_limits(self):
+        while self._lru and self._over_limit():
+            key, _ = self._lru.popitem(last=False)
+            self.remove_entity(key)
+            self.evictions += 1
+
+        self.peak_bytes = max(self.peak_bytes, self.size_in_bytes)
+        self.peak_entries = max(self.peak_entries, len(self._sizes))
+
 
 class ContextStack(object):
     """
@@ -86,13 +339,19 @@ class ContextStack(object):
         caches for multi level transactions.
     """
 
-    def __init__(self):
-        self.stack = [ Context(self) ]
+    def __init__(self, max_bytes=None, max_entries=None):
+        self.max_bytes = CONTEXT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.max_entries = CONTEXT_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+
+        self.stack = [ self._new_context() ]
         self.staged = []
 
+    def _new_context(self):
+        return Context(self, max_bytes=self.max_bytes, max_entries=self.max_entries)
+
     def push(self):
         self.stack.append(
-            Context(self) # Empty context
+            self._new_context() # Empty context
         )
 
     def pop(self, apply_staged=False, clear_staged=False, discard=False):
@@ -120,11 +379,15 @@ class ContextStack(object):
             while self.staged:
                 to_apply = self.staged.pop()
                 caching.remove_entities_from_cache_by_key(
-                    to_apply.reverse_cache.keys(), memcache_only=True
+                    list(set(to_apply.reverse_cache.keys()) | to_apply.process_cache_keys), memcache_only=True,
+                    identifiers=itertools.chain(*to_apply.reverse_cache.values())
                 )
 
                 self.top.apply(to_apply)
 
+            # Make sure the cache is consistent once the transaction has been committed
+            caching.wait_for_memcache_writes()
+
         if clear_staged or len(self.stack) == 1:
             self.staged = []
 
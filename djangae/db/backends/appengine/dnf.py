@@ -2,7 +2,6 @@ import copy
 from itertools import  product
 from django.db.models.sql.datastructures import EmptyResultSet
 from djangae.db.backends.appengine.query import WhereNode
-from django.db import NotSupportedError
 
 def preprocess_node(node, negated):
 
@@ -103,6 +102,20 @@ def preprocess_node(node, negated):
 
 
 def normalize_query(query):
+    """
+        Converts the where tree of the query into disjunctive normal form (an OR of
+        AND branches), then removes any branches which can't return anything.
+    """
+    query = normalize_query_structure(query)
+    return prune_normalized_query(query)
+
+
+def normalize_query_structure(query):
+    """
+        Converts the where tree of the query into disjunctive normal form. This only
+        depends on the shape of the tree (and the length of IN lists) rather than the values
+        being filtered on, which is what allows the query plan cache to reuse the result.
+    """
     where = query.where
 
     # If there are no filters then this is already normalized
@@ -185,22 +198,24 @@ def normalize_query(query):
         new_node.children = [ where ]
         query._where = new_node
 
-    all_pks = True
-    for and_branch in query.where.children:
-        if and_branch.is_leaf:
-            children = [ and_branch ]
-        else:
-            children = and_branch.children
+    return query
 
-        for node in children:
-            if node.column == "__key__" and node.operator in ("=", "IN"):
-                break
-        else:
-            all_pks = False
-            break
 
-    if (not all_pks) and len(query.where.children) > 30:
-        raise NotSupportedError("Unable to run query as it required more than 30 subqueries")
+def prune_normalized_query(query):
+    """
+        Given a normalized query, removes duplicate branches and any branches
+        which can't return anything because of the values they filter on.
+    """
+    where = query.where
+
+    # If there are no filters then there's nothing to do
+    if where is None:
+        return query
+
+    # Branches which only differed by their values before the values were bound
+    # may now be the same
+    if len(where.children) > 1:
+        where.children = list(set(where.children))
 
     def remove_empty_in(node):
         """
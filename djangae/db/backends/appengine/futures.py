@@ -0,0 +1,81 @@
+"""
+    Futures for writes which are sent with the datastore's async API, see save_async,
+    bulk_save_async and delete_async in djangae.db.models.
+
+    The bookkeeping for a write (caching, unique markers, signals) happens when its future
+    is resolved. Any futures which haven't been resolved by the end of the request are
+    resolved then, so that always happens.
+"""
+
+import logging
+import sys
+import threading
+
+logger = logging.getLogger("djangae")
+
+_local = threading.local()
+
+
+def _pending():
+    pending = getattr(_local, "pending", None)
+    if pending is None:
+        pending = _local.pending = []
+    return pending
+
+
+class WriteFuture(object):
+    """
+        Wraps the RPCs for a write. get_result() waits for them, then calls callback with
+        their results and returns what it returns. If one of the RPCs failed then errback
+        is called instead, and the exception is re-raised. A future created with no RPCs
+        is already resolved, and returns result.
+    """
+
+    def __init__(self, rpcs=None, callback=None, errback=None, result=None):
+        self._rpcs = rpcs or []
+        self._callback = callback
+        self._errback = errback
+        self._result = result
+        self._exc_info = None
+        self._done = not self._rpcs
+
+        if not self._done:
+            _pending().append(self)
+
+    def done(self):
+        return self._done
+
+    def get_result(self):
+        if not self._done:
+            self._done = True
+
+            pending = _pending()
+            if self in pending:
+                pending.remove(self)
+
+            try:
+                results = [ rpc.get_result() for rpc in self._rpcs ]
+            except Exception:
+                self._exc_info = sys.exc_info()
+                if self._errback:
+                    self._errback()
+            else:
+                try:
+                    self._result = self._callback(results) if self._callback else results
+                except Exception:
+                    self._exc_info = sys.exc_info()
+
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+
+def wait_for_pending(*args, **kwargs):
+    """ Resolves any futures which haven't been waited on, called at the end of each request """
+    pending = _pending()
+    while pending:
+        try:
+            pending[0].get_result()
+        except Exception:
+            logger.exception("Asynchronous datastore write failed")
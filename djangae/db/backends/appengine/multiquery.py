@@ -0,0 +1,240 @@
+"""
+    Our replacement for datastore.MultiQuery, used for queries which normalize to more
+    than one AND branch (OR and IN queries).
+
+    The branches are started in groups of MAX_CONCURRENT_BRANCHES, each branch in a group is
+    started before we read from any of them (Query.Run sends the first batch RPC without waiting
+    for the response) so they run concurrently rather than one after another. The results are
+    then merged with a heap, ordered by a tuple of sort values which is calculated once per
+    entity, and de-duplicated by key.
+
+    The branches can be keys only or projection queries. To merge them we need each result's
+    sort values, so SelectCommand adds any sort columns to the branch projections. We don't
+    need to project columns which have an equality filter in a branch (the datastore won't
+    let us anyway) as we know their value from the filter.
+"""
+
+import heapq
+import time
+
+from google.appengine.api import datastore
+from google.appengine.api.datastore import Query
+
+from djangae.db.backends.appengine import query_log
+
+# The most branches which have their first batch in flight at the same time, a large
+# __in shouldn't send hundreds of RPCs at once
+MAX_CONCURRENT_BRANCHES = 30
+
+
+class _Descending(object):
+    """ Wraps a value so that it sorts in reverse """
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __gt__(self, other):
+        return other.value > self.value
+
+
+def _result_key(result):
+    return result if isinstance(result, datastore.Key) else result.key()
+
+
+def _sort_value(entity, column, direction):
+    value = entity.get(column)
+    if isinstance(value, list):
+        # The datastore sorts on the smallest value of a list property when
+        # ascending, and on the largest value when descending
+        if not value:
+            return None
+        return min(value) if direction == datastore.Query.ASCENDING else max(value)
+    return value
+
+
+def make_ordering_key(ordering):
+    """
+        Returns a function which, given an entity, returns a tuple which sorts in the
+        same order that the datastore would return the entity for the given ordering.
+        Ties are broken by key, as they are by the datastore.
+
+        The ordering can contain (column, direction) tuples, or column names which
+        are treated as ascending. The function accepts keys as well as entities, and
+        an optional dictionary of values to use for columns the result doesn't have.
+    """
+    columns = []
+    for order in ordering:
+        if isinstance(order, basestring):
+            columns.append((order, datastore.Query.ASCENDING))
+        else:
+            columns.append(tuple(order))
+
+    def ordering_key(result, known_values=None):
+        key = _result_key(result)
+
+        values = []
+        for column, direction in columns:
+            if column == "__key__":
+                value = key
+            elif known_values and column in known_values:
+                value = known_values[column]
+            elif result is key:
+                value = None
+            else:
+                value = _sort_value(result, column, direction)
+
+            if direction == datastore.Query.DESCENDING:
+                value = _Descending(value)
+            values.append(value)
+
+        values.append(key)
+        return tuple(values)
+
+    return ordering_key
+
+
+def _equality_values(query):
+    """ Returns a dictionary of the columns which the query filters on with a single equality """
+    values = {}
+    for lookup in query.keys():
+        column, operator = lookup.rsplit(" ", 1)
+        value = query[lookup]
+        if operator == "=" and not isinstance(value, (list, tuple)):
+            values[column] = value
+    return values
+
+
+class ParallelMultiQuery(object):
+    """
+        Runs a list of datastore queries concurrently, and returns the union of
+        their results in the given ordering. If keys_only is True then keys are
+        returned, whatever the branch queries return.
+    """
+
+    def __init__(self, queries, ordering, keys_only=False):
+        self.queries = queries
+        self.ordering = ordering
+        self.keys_only = keys_only
+        self._ordering_key = make_ordering_key(ordering)
+        self._known_values = [ _equality_values(query) for query in queries ]
+
+        self._Query__kind = queries[0]._Query__kind
+
+    def keys_only_query(self):
+        """ Returns an unordered, keys only version of this query """
+        queries = [
+            Query(query._Query__kind, filters=query, keys_only=True) for query in self.queries
+        ]
+        return ParallelMultiQuery(queries, [], keys_only=True)
+
+    def Run(self, limit=None, offset=None, **kwargs):
+        offset = offset or 0
+
+        # Each branch can contribute at most offset + limit results, any more can't be returned
+        to_fetch = None if limit is None else offset + limit
+
+        return self._merge(self._start_branches(self.queries, to_fetch, **kwargs), limit, offset)
+
+    def Count(self, limit=None, offset=None, **kwargs):
+        offset = offset or 0
+        to_fetch = None if limit is None else offset + limit
+
+        # Ordering doesn't affect the count, so we only need the union of the keys. If the
+        # union of the first offset + limit keys from each branch is smaller than that, then
+        # every branch returned all of its results
+        queries = self.keys_only_query().queries
+
+        start = time.time()
+        fetched = 0
+        keys = set()
+        for i in xrange(0, len(queries), MAX_CONCURRENT_BRANCHES):
+            # Start each group of branches before we wait on any of them
+            iterators = [
+                iter(query.Run(limit=to_fetch, **kwargs)) for query in queries[i:i + MAX_CONCURRENT_BRANCHES]
+            ]
+            for iterator in iterators:
+                for key in iterator:
+                    fetched += 1
+                    keys.add(key)
+
+        query_log.record(
+            query_log.MULTIQUERY, self._Query__kind,
+            duration=time.time() - start, result_count=fetched,
+            branches=len(queries), returned=len(keys), count=True
+        )
+
+        count = max(len(keys) - offset, 0)
+        return count if limit is None else min(count, limit)
+
+    def _start_branches(self, queries, limit, **kwargs):
+        """
+            Runs the queries, MAX_CONCURRENT_BRANCHES at a time, and returns a list of
+            (first result, iterator) for each of them. Merging needs the first result of every
+            branch, so we wait for those of each group before starting the next. Later batches
+            are only fetched as the results are read.
+        """
+        heads = []
+        for i in xrange(0, len(queries), MAX_CONCURRENT_BRANCHES):
+            # Start each group of branches before we wait on any of them
+            iterators = [
+                iter(query.Run(limit=limit, **kwargs)) for query in queries[i:i + MAX_CONCURRENT_BRANCHES]
+            ]
+            heads.extend((next(iterator, None), iterator) for iterator in iterators)
+        return heads
+
+    def _merge(self, heads, limit, offset):
+        ordering_key = self._ordering_key
+
+        start = time.time()
+        fetched = 0
+
+        # The branch index is part of each heap entry so that the same entity returned
+        # by two branches never falls through to comparing the entities themselves
+        heap = []
+        for i, (result, iterator) in enumerate(heads):
+            if result is not None:
+                fetched += 1
+                heap.append((ordering_key(result, self._known_values[i]), i, result, iterator))
+        heapq.heapify(heap)
+
+        seen = set()
+        position = 0
+        try:
+            while heap:
+                _, i, result, iterator = heap[0]
+
+                # Projections of list properties return a result per value, the first of
+                # those is the one in the right position
+                key = _result_key(result)
+                if key not in seen:
+                    seen.add(key)
+
+                    if position >= offset:
+                        yield key if self.keys_only else result
+
+                    position += 1
+                    if limit is not None and position >= offset + limit:
+                        return
+
+                result = next(iterator, None)
+                if result is None:
+                    heapq.heappop(heap)
+                else:
+                    fetched += 1
+                    heapq.heapreplace(heap, (ordering_key(result, self._known_values[i]), i, result, iterator))
+        finally:
+            query_log.record(
+                query_log.MULTIQUERY, self._Query__kind,
+                duration=time.time() - start, result_count=fetched,
+                branches=len(heads), returned=max(position - offset, 0)
+            )
@@ -0,0 +1,224 @@
+"""
+    Caches the result of preparing and normalizing queries, so that queries which only
+    differ by the values they filter on only pay for that once.
+
+    After a query has been transformed, the values in its where tree are replaced with
+    numbered slots before it's prepared and normalized. The result is kept as a template,
+    keyed on the structure of the query (model, columns, ordering, the shape of the where
+    tree, the length of any lists...). When a query with the same structure comes along
+    we just bind its values into a copy of the template.
+"""
+
+import collections
+import threading
+
+from django.conf import settings
+
+from djangae.db.backends.appengine.dnf import normalize_query_structure, prune_normalized_query
+from djangae.db.backends.appengine.query import WhereNode
+
+QUERY_PLAN_CACHE_SIZE = getattr(settings, "DJANGAE_QUERY_PLAN_CACHE_SIZE", 500)
+
+
+class _Slot(object):
+    """ Stands in for a value in the where tree """
+    __slots__ = ("index",)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __eq__(self, other):
+        return isinstance(other, _Slot) and self.index == other.index
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((_Slot, self.index))
+
+    def __repr__(self):
+        return "<slot {}>".format(self.index)
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class _SlotList(list):
+    """ Stands in for a list/tuple value, each element is a slot """
+
+    def __init__(self, slots, container):
+        super(_SlotList, self).__init__(slots)
+        self.container = container
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def _leaf_value_shape(node):
+    if node.operator == "ISNULL":
+        # The value changes the structure of the normalized tree
+        return ("isnull", node.value)
+    elif isinstance(node.value, (list, tuple, set, frozenset)):
+        return ("list", type(node.value), len(node.value))
+    return None
+
+
+def _where_signature(node):
+    if node is None:
+        return None
+
+    if node.is_leaf:
+        return (node.column, node.operator, _leaf_value_shape(node))
+
+    return (node.connector, node.negated, tuple(_where_signature(x) for x in node.children))
+
+
+def query_signature(query):
+    return (
+        query.model,
+        query.connection.alias,
+        query.kind,
+        tuple(query.columns) if query.columns is not None else None,
+        query.projection_possible,
+        tuple(query.init_list),
+        query.distinct,
+        tuple(query.order_by),
+        _where_signature(query.where),
+    )
+
+
+def _extract_values(node, values, replace):
+    """
+        Walks the where tree, appending the values to the list we're given. If replace
+        is True then the values in the tree are replaced with slots.
+    """
+    if node is None:
+        return
+
+    if node.is_leaf:
+        if node.operator == "ISNULL":
+            return
+
+        if isinstance(node.value, (list, tuple, set, frozenset)):
+            slots = []
+            for value in node.value:
+                slots.append(_Slot(len(values)))
+                values.append(value)
+
+            if replace:
+                node.value = _SlotList(slots, type(node.value))
+        else:
+            if replace:
+                node.value = _Slot(len(values))
+            values.append(node.value)
+        return
+
+    for child in node.children:
+        _extract_values(child, values, replace)
+
+
+def _bind_value(value, values):
+    if isinstance(value, _Slot):
+        return values[value.index]
+    elif isinstance(value, _SlotList):
+        return value.container(values[x.index] for x in value)
+    return value
+
+
+def _bind_where(node, values):
+    if node is None:
+        return None
+
+    new_node = WhereNode()
+    new_node.__dict__.update(node.__dict__)
+    new_node.value = _bind_value(node.value, values)
+    new_node.children = [ _bind_where(x, values) for x in node.children ]
+    return new_node
+
+
+class QueryPlan(object):
+    """
+        The prepared and normalized form of a query, with slots in place of its values. Binding
+        always builds a new where tree, so the plan itself is never altered once it's created.
+    """
+
+    def __init__(self, query):
+        self.where = query.where
+        self.excluded_pks = frozenset(query.excluded_pks)
+        self.columns = query.columns[:] if query.columns is not None else None
+        self.projection_possible = query.projection_possible
+        self.init_list = query.init_list[:]
+        self.polymodel_filter_added = query.polymodel_filter_added
+
+    def bind(self, query, values):
+        query.where = _bind_where(self.where, values)
+        query.excluded_pks = set(_bind_value(x, values) for x in self.excluded_pks)
+        query.columns = self.columns[:] if self.columns is not None else None
+        query.projection_possible = self.projection_possible
+        query.init_list = self.init_list[:]
+        query.polymodel_filter_added = self.polymodel_filter_added
+        return query
+
+
+class QueryPlanCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._plans = collections.OrderedDict()
+
+    def prepare_and_normalize(self, query):
+        """
+            Equivalent to calling query.prepare() followed by normalize_query(query), but
+            uses a cached plan if a query with the same structure has been seen before.
+        """
+        signature = query_signature(query)
+
+        with self._lock:
+            plan = self._plans.pop(signature, None)
+            if plan is not None:
+                self._plans[signature] = plan # Most recently used
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        values = []
+        if plan is None:
+            _extract_values(query.where, values, replace=True)
+
+            query.prepare()
+            query = normalize_query_structure(query)
+
+            plan = QueryPlan(query)
+            with self._lock:
+                self._plans[signature] = plan
+                while len(self._plans) > self.max_size:
+                    self._plans.popitem(last=False)
+        else:
+            _extract_values(query.where, values, replace=False)
+
+        query = plan.bind(query, values)
+        return prune_normalized_query(query)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._plans),
+                "max_size": self.max_size,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+            self.hits = self.misses = 0
+
+
+query_plan_cache = QueryPlanCache(QUERY_PLAN_CACHE_SIZE)
+
+
+def get_query_plan_cache_stats():
+    return query_plan_cache.stats()
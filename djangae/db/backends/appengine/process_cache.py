@@ -0,0 +1,189 @@
+"""
+    A process-wide entity cache which sits between the context cache and memcache. This is
+    for read-mostly models, which have to opt in:
+
+        class MyModel(models.Model):
+            class Djangae:
+                enable_process_cache = True
+
+    Each kind has a generation token stored in memcache, every entry in the cache is tagged
+    with the generation it was read under. Writing to a kind replaces its generation, which
+    invalidates the entries on every instance. The generation is only read from memcache once
+    per request (per kind), so a write on another instance can take until the next request to
+    be seen.
+
+    The generation is read (and pinned) when we look in the cache, before anything is fetched
+    from memcache or the datastore, and what's fetched is only added if the generation hasn't
+    changed since. A write only replaces the generation once it has been committed and memcache
+    has been invalidated, otherwise another instance could cache what it read in between under
+    the new generation.
+"""
+
+import collections
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from djangae.db.backends.appengine.context import EntitySnapshot
+
+PROCESS_CACHE_MAX_ENTRIES = getattr(settings, "DJANGAE_PROCESS_CACHE_MAX_ENTRIES", 1000)
+
+# Outside of requests (e.g. in a long running task) the generations are re-read this often
+GENERATION_MAX_AGE_SECONDS = 5
+
+_local = threading.local()
+
+
+def process_cache_enabled(model):
+    opts = getattr(model, "Djangae", None)
+    return bool(getattr(opts, "enable_process_cache", False))
+
+
+def _generation_cache_key(kind):
+    return "djangae-generation|{}".format(kind)
+
+
+def _get_generation(kind):
+    generations = getattr(_local, "generations", None)
+    if generations is None:
+        generations = _local.generations = {}
+
+    now = time.time()
+    if kind in generations and generations[kind][1] > now:
+        return generations[kind][0]
+
+    cache_key = _generation_cache_key(kind)
+    generation = cache.get(cache_key)
+    if generation is None:
+        # If memcache has lost the generation, everything we have for the kind is invalid
+        generation = uuid.uuid4().hex
+        if not cache.add(cache_key, generation, timeout=None):
+            generation = cache.get(cache_key) or generation
+
+    generations[kind] = (generation, now + GENERATION_MAX_AGE_SECONDS)
+    return generation
+
+
+def _pin_generation(kind):
+    """ Reads the generation before a lookup, anything fetched after a miss is tagged with it """
+    pinned = getattr(_local, "pinned", None)
+    if pinned is None:
+        pinned = _local.pinned = {}
+
+    generation = pinned[kind] = _get_generation(kind)
+    return generation
+
+
+def _new_generation(kind):
+    generation = uuid.uuid4().hex
+    cache.set(_generation_cache_key(kind), generation, timeout=None)
+
+    generations = getattr(_local, "generations", None)
+    if generations is None:
+        generations = _local.generations = {}
+    generations[kind] = (generation, time.time() + GENERATION_MAX_AGE_SECONDS)
+
+
+def new_generations(kinds):
+    """
+        Invalidates everything cached for the kinds on every instance. Only call this once
+        the write has been committed and memcache has been invalidated.
+    """
+    for kind in kinds:
+        _new_generation(kind)
+
+
+def reset():
+    """ Called at the start and end of each request so that generations are re-read """
+    _local.generations = {}
+    _local.pinned = {}
+
+
+class ProcessCache(object):
+    """
+        A thread-safe, size-bounded LRU cache of entity snapshots. Entities are stored by
+        key, and can be looked up by key or any of their unique identifiers.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict() # key -> (generation, snapshot, identifiers)
+        self._identifiers = {} # identifier -> key
+
+    def get(self, key):
+        kind = key.kind()
+        generation = _pin_generation(kind)
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+
+            if entry[0] != generation:
+                self._forget(key, entry)
+                return None
+
+            # Put it back at the most recently used end
+            self._entries[key] = entry
+            return entry[1].thaw(), entry[2]
+
+    def get_by_identifier(self, identifier, kind):
+        # Pin the generation even if we don't know the identifier, as we're about to fetch it
+        _pin_generation(kind)
+
+        with self._lock:
+            key = self._identifiers.get(identifier)
+
+        if key is None:
+            return None
+        return self.get(key)
+
+    def add(self, entities, identifiers):
+        if not entities:
+            return
+
+        # If the generation has changed since we looked for these (or we never did) then
+        # they may have been read before a write, and are already stale
+        kind = entities[0].key().kind()
+        generation = (getattr(_local, "pinned", None) or {}).get(kind)
+        if generation is None or generation != _get_generation(kind):
+            return
+
+        with self._lock:
+            for entity, ent_identifiers in zip(entities, identifiers):
+                key = entity.key()
+                if key in self._entries:
+                    self._forget(key, self._entries.pop(key))
+
+                self._entries[key] = (generation, EntitySnapshot(entity), tuple(ent_identifiers))
+                for identifier in ent_identifiers:
+                    self._identifiers[identifier] = key
+
+            while len(self._entries) > self.max_entries:
+                self._forget(*self._entries.popitem(last=False))
+
+    def discard(self, keys):
+        """ Removes the keys from this instance, see new_generations for the others """
+        with self._lock:
+            for key in keys:
+                entry = self._entries.pop(key, None)
+                if entry:
+                    self._forget(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._identifiers.clear()
+
+    def _forget(self, key, entry):
+        for identifier in entry[2]:
+            if self._identifiers.get(identifier) == key:
+                del self._identifiers[identifier]
+
+
+entity_cache = ProcessCache(PROCESS_CACHE_MAX_ENTRIES)
@@ -24,7 +24,7 @@ from djangae.db.backends.appengine.indexing import (
     add_special_index,
 )
 
-from djangae.db.backends.appengine import POLYMODEL_CLASS_ATTRIBUTE
+from djangae.db.backends.appengine import POLYMODEL_CLASS_ATTRIBUTE, query_log
 from djangae.utils import on_production
 from djangae.db.utils import (
     get_top_concrete_parent,
@@ -671,6 +671,7 @@ def _extract_ordering_from_query_17(query):
             DJANGAE_LOG.warning if not on_production() else DJANGAE_LOG.debug,
             "The following orderings were ignored as cross-table and random orderings are not supported on the datastore: %s", diff
         )
+        query_log.record(query_log.IGNORED_ORDERING, query.model._meta.db_table, orderings=sorted(diff))
 
     return final
 
@@ -708,6 +709,9 @@ def _extract_ordering_from_query_18(query):
                 DJANGAE_LOG.warning if not on_production() else DJANGAE_LOG.debug,
                 "The following orderings were ignored as cross-table orderings are not supported on the datastore: %s", cross_table_ordering
             )
+            query_log.record(
+                query_log.IGNORED_ORDERING, query.model._meta.db_table, orderings=sorted(cross_table_ordering)
+            )
 
         result = new_result
 
@@ -809,6 +813,7 @@ def _extract_ordering_from_query_18(query):
             DJANGAE_LOG.warning if not on_production() else DJANGAE_LOG.debug,
             "The following orderings were ignored as cross-table and random orderings are not supported on the datastore: %s", diff
         )
+        query_log.record(query_log.IGNORED_ORDERING, query.model._meta.db_table, orderings=sorted(diff))
 
     return final
 
@@ -0,0 +1,184 @@
+"""
+    A log of the places where the backend does work that the datastore can't do for us, or
+    does more work than the query looks like it needs. Things like sorting or filtering
+    results in Python, fetching extra results to make up for excluded pks, running a query
+    for each branch of an OR, or ignoring an ordering.
+
+    Each event is logged to the "djangae.query_log" logger at debug level, and is also
+    collected for the current request along with how long it took and how many results were
+    involved. When the request finishes a summary is logged (at info level locally, debug on
+    production), or you can get hold of it yourself, e.g. for a debug panel:
+
+        from djangae.db.backends.appengine.query_log import get_request_summary
+"""
+
+import collections
+import logging
+import threading
+
+from django.conf import settings
+
+from djangae.utils import on_production
+
+QUERY_LOG_ENABLED = getattr(settings, "DJANGAE_QUERY_LOG_ENABLED", True)
+
+# Only this many events are kept for each request, the summary counts all of them
+QUERY_LOG_MAX_EVENTS = getattr(settings, "DJANGAE_QUERY_LOG_MAX_EVENTS", 100)
+
+logger = logging.getLogger("djangae.query_log")
+
+# The results of a fetch by keys were sorted in Python
+PYTHON_SORT = "python_sort"
+
+# Results were read from the datastore then thrown away because they don't match the query
+PYTHON_FILTER = "python_filter"
+
+# The query excluded pks, so more results were fetched than were asked for
+EXCLUDED_PK_OVERFETCH = "excluded_pk_overfetch"
+
+# A datastore query was run for each branch of an OR/IN query, and the results merged
+MULTIQUERY = "multiquery"
+
+# An ordering which the datastore can't do (cross-table or random) was ignored
+IGNORED_ORDERING = "ignored_ordering"
+
+# A transaction was run for each unique marker acquired or released
+UNIQUE_MARKERS = "unique_markers"
+
+
+QueryEvent = collections.namedtuple(
+    "QueryEvent", "category kind duration result_count details"
+)
+
+_local = threading.local()
+
+
+def _get_state():
+    state = getattr(_local, "state", None)
+    if state is None:
+        state = _local.state = {
+            "events": [],
+            "event_count": 0,
+            "categories": {},
+        }
+    return state
+
+
+def record(category, kind, duration=None, result_count=None, **details):
+    """
+        Records an event for the current request. `kind` is the datastore kind the work was
+        done for, `duration` is in seconds, and any extra keyword arguments are kept in the
+        event's details.
+    """
+    if not QUERY_LOG_ENABLED:
+        return
+
+    event = QueryEvent(category, kind, duration, result_count, details)
+    _add_event(event)
+
+    logger.debug(
+        "%s on %s (%s results, %.1fms) %s",
+        category, kind, result_count, (duration or 0.0) * 1000, details
+    )
+
+
+def _add_event(event):
+    category, kind, duration, result_count, details = event
+
+    state = _get_state()
+    state["event_count"] += 1
+    if len(state["events"]) < QUERY_LOG_MAX_EVENTS:
+        state["events"].append(event)
+
+    totals = state["categories"].get(category)
+    if totals is None:
+        totals = state["categories"][category] = {
+            "count": 0,
+            "duration": 0.0,
+            "result_count": 0,
+            "kinds": set(),
+        }
+
+    totals["count"] += 1
+    totals["duration"] += duration or 0.0
+    totals["result_count"] += result_count or 0
+    totals["kinds"].add(kind)
+
+
+def take_thread_events():
+    """
+        Returns the events recorded by this thread and clears them. Used by threads which do
+        work for a request, so that the thread handling the request can add_events() them.
+    """
+    events = get_request_events()
+    reset()
+    return events
+
+
+def add_events(events):
+    """ Adds events which were recorded in another thread to the current request """
+    if not QUERY_LOG_ENABLED:
+        return
+
+    for event in events:
+        _add_event(event)
+
+
+def get_request_events():
+    """ Returns the events recorded so far in this request, oldest first """
+    return list(_get_state()["events"])
+
+
+def get_request_summary():
+    """
+        Returns the totals for each category of event recorded so far in this request,
+        keyed by category, e.g.
+
+            {
+                "event_count": 3,
+                "categories": {
+                    "python_sort": {"count": 3, "duration": 0.02, "result_count": 150, "kinds": set(["app_model"])}
+                }
+            }
+    """
+    state = _get_state()
+    return {
+        "event_count": state["event_count"],
+        "categories": {
+            category: dict(totals, kinds=set(totals["kinds"]))
+            for category, totals in state["categories"].items()
+        }
+    }
+
+
+def log_request_summary():
+    summary = get_request_summary()
+    if not summary["event_count"]:
+        return
+
+    lines = []
+    for category, totals in sorted(summary["categories"].items()):
+        lines.append(
+            "  {}: {} events, {} results, {:.1f}ms ({})".format(
+                category,
+                totals["count"],
+                totals["result_count"],
+                totals["duration"] * 1000,
+                ", ".join(sorted(totals["kinds"]))
+            )
+        )
+
+    logger.log(
+        logging.INFO if not on_production() else logging.DEBUG,
+        "Inefficient datastore operations in this request:\n%s", "\n".join(lines)
+    )
+
+
+def reset(*args, **kwargs):
+    """ Clears the events for the current request, called when each request starts """
+    _local.state = None
+
+
+def request_finished(*args, **kwargs):
+    log_request_summary()
+    reset()
@@ -0,0 +1,43 @@
+import logging
+
+from djangae.db.backends.appengine import batching
+from djangae.db.transaction import ContextDecorator
+
+DJANGAE_LOG = logging.getLogger("djangae")
+
+
+class BatchWritesDecorator(ContextDecorator):
+    """
+        Decorator and context manager which queues up datastore writes and sends them
+        together, with one Put (and one Delete) RPC per kind, when the block exits or
+        once enough writes have been queued:
+
+            with batch_writes():
+                for thing in things:
+                    thing.save()
+
+        Only inserts which get an automatically allocated id, and deletes, are queued,
+        and only for models without unique constraints. The pks of queued inserts are
+        allocated straight away. Any other write sends the queue before it runs, as does
+        starting a transaction. Queued writes aren't visible to reads until they are sent.
+    """
+
+    @classmethod
+    def _do_enter(cls, state, decorator_args):
+        batching.begin()
+
+    @classmethod
+    def _do_exit(cls, state, decorator_args, exception):
+        if not exception:
+            batching.end()
+            return
+
+        # The writes were made before the exception, so they still happen, but we
+        # don't want an error sending them to hide the original one
+        try:
+            batching.end()
+        except Exception:
+            DJANGAE_LOG.exception("Unable to send queued writes")
+
+
+batch_writes = BatchWritesDecorator
@@ -1,5 +1,6 @@
 import datetime
 import logging
+import time
 
 from django.core.exceptions import NON_FIELD_ERRORS
 
@@ -7,9 +8,10 @@ from google.appengine.ext import db
 from google.appengine.api.datastore import Key, Delete
 from google.appengine.datastore.datastore_rpc import TransactionOptions
 
-from .unique_utils import unique_identifiers_from_entity
+from .unique_utils import unique_identifiers_from_entity, _unique_combinations
 from .utils import key_exists
 from djangae.db.backends.appengine.dbapi import IntegrityError, NotSupportedError
+from djangae.db.backends.appengine import query_log
 from django.conf import settings
 
 DJANGAE_LOG = logging.getLogger("djangae")
@@ -31,6 +33,13 @@ def constraint_checks_enabled(model_or_instance):
     return not getattr(settings, "DJANGAE_DISABLE_CONSTRAINT_CHECKS", False)
 
 
+def has_unique_markers(model):
+    """
+        Returns True if writes to the model need to acquire or release unique markers
+    """
+    return constraint_checks_enabled(model) and bool(_unique_combinations(model, ignore_pk=True))
+
+
 
 class KeyProperty(db.Property):
     """A property that stores a datastore.Key reference to another object.
@@ -79,6 +88,7 @@ def acquire_identifiers(identifiers, entity_key):
         return marker
 
     markers = []
+    start = time.time()
     try:
         for identifier in identifiers:
             markers.append(acquire_marker(identifier))
@@ -87,6 +97,12 @@ def acquire_identifiers(identifiers, entity_key):
         release_markers(markers)
         DJANGAE_LOG.debug("Due to an error, deleted markers %s", markers)
         raise
+    finally:
+        if markers:
+            query_log.record(
+                query_log.UNIQUE_MARKERS, entity_key.kind(),
+                duration=time.time() - start, result_count=len(markers), action="acquire"
+            )
     return markers
 
 
@@ -148,8 +164,15 @@ def release_markers(markers):
     def delete(marker):
         Delete(marker.key())
 
+    start = time.time()
     [delete(x) for x in markers]
 
+    if markers:
+        query_log.record(
+            query_log.UNIQUE_MARKERS, UniqueMarker.kind(),
+            duration=time.time() - start, result_count=len(markers), action="release"
+        )
+
 
 def release_identifiers(identifiers):
 
@@ -200,48 +223,26 @@ class UniquenessMixin(object):
             if len(unique_check) != len(lookup_kwargs):
                 continue
 
-            #######################################################
-            # Deal with long __in lookups by doing multiple queries in that case
-            # This is a bit hacky, but we really have no choice due to App Engine's
-            # 30 multi-query limit. This also means we can't support multiple list fields in
-            # a unique combination
-            #######################################################
-
+            # Two list fields would query on every combination of their values, which
+            # quickly becomes an unreasonable number of subqueries
             if len([x for x in lookup_kwargs if x.endswith("__in") ]) > 1:
                 raise NotSupportedError("You cannot currently have two list fields in a unique combination")
 
-            # Split IN queries into multiple lookups if they are too long
-            lookups = []
-            for k, v in lookup_kwargs.iteritems():
-                if k.endswith("__in") and len(v) > 30:
-                    v = list(v)
-                    while v:
-                        new_lookup = lookup_kwargs.copy()
-                        new_lookup[k] = v[:30]
-                        v = v[30:]
-                        lookups.append(new_lookup)
-                    break
-            else:
-                # Otherwise just use the one lookup
-                lookups = [ lookup_kwargs ]
-
-            for lookup_kwargs in lookups:
-                qs = model_class._default_manager.filter(**lookup_kwargs).values_list("pk", flat=True)
-                model_class_pk = self._get_pk_val(model_class._meta)
-                result = list(qs)
-
-                if not self._state.adding and model_class_pk is not None:
-                    # If we are saving an instance, we ignore it's PK in the result
-                    try:
-                        result.remove(model_class_pk)
-                    except ValueError:
-                        pass
-
-                if result:
-                    if len(unique_check) == 1:
-                        key = unique_check[0]
-                    else:
-                        key = NON_FIELD_ERRORS
-                    errors.setdefault(key, []).append(self.unique_error_message(model_class, unique_check))
-                    break
+            qs = model_class._default_manager.filter(**lookup_kwargs).values_list("pk", flat=True)
+            model_class_pk = self._get_pk_val(model_class._meta)
+            result = list(qs)
+
+            if not self._state.adding and model_class_pk is not None:
+                # If we are saving an instance, we ignore it's PK in the result
+                try:
+                    result.remove(model_class_pk)
+                except ValueError:
+                    pass
+
+            if result:
+                if len(unique_check) == 1:
+                    key = unique_check[0]
+                else:
+                    key = NON_FIELD_ERRORS
+                errors.setdefault(key, []).append(self.unique_error_message(model_class, unique_check))
         return errors
@@ -0,0 +1,21 @@
+from djangae.db.backends.appengine import batching
+
+
+class BatchWritesMiddleware(object):
+    """
+        Batches the datastore writes made during each request, see djangae.db.batching.
+        The queued writes are sent before the response is returned.
+    """
+
+    def process_request(self, request):
+        batching.begin()
+
+    def process_response(self, request, response):
+        if batching.get_batch() is not None:
+            batching.end()
+        return response
+
+    def process_exception(self, request, exception):
+        if batching.get_batch() is not None:
+            batching.end()
+        return None  # Allow default exception handling to take over
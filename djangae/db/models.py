@@ -0,0 +1,372 @@
+"""
+    Datastore specific additions to Django querysets.
+
+    Use DatastoreManager as a model's manager (or DatastoreQuerySet.as_manager()) to get the
+    extra queryset methods. The functions in this module work on any queryset.
+"""
+
+from itertools import chain
+
+import django
+from django.db import connections, models, router
+from django.db.models import signals
+from django.db.models.deletion import Collector
+from django.db.models.sql import DeleteQuery
+from django.db.models.sql.datastructures import EmptyResultSet
+from google.appengine.api import datastore
+from google.appengine.datastore.datastore_query import Cursor
+
+from djangae.db import constraints
+from djangae.db.backends.appengine import batching, caching
+from djangae.db.backends.appengine.futures import WriteFuture
+from djangae.db.utils import django_instance_to_entity, get_concrete_fields, has_concrete_parents
+
+DATASTORE_OPTIONS = frozenset(["batch_size", "prefetch_size", "read_policy", "deadline"])
+
+# The most entities we send in a single Put
+MAX_ENTITIES_PER_PUT = 500
+
+
+class _QueryContextMixin(object):
+    """
+        Django 1.7 queries don't have a context, so on 1.7 the queries we store cursors and
+        datastore options on have this mixed in, to keep the context when they are cloned.
+    """
+    context = None
+
+    def clone(self, klass=None, memo=None, **kwargs):
+        obj = super(_QueryContextMixin, self).clone(klass=klass, memo=memo, **kwargs)
+        if self.context is not None:
+            if not isinstance(obj, _QueryContextMixin):
+                # Cloned to another query class, e.g. by dates()
+                obj.__class__ = _context_query_class(type(obj))
+            obj.context = self.context.copy()
+        return obj
+
+
+_context_query_classes = {}
+
+
+def _context_query_class(klass):
+    """ Returns a subclass of the query class with _QueryContextMixin mixed in """
+    if klass not in _context_query_classes:
+        name = "Context{}".format(klass.__name__)
+        new_class = type(name, (_QueryContextMixin, klass), {"__module__": __name__})
+
+        # Make the class importable, so that queries can still be pickled
+        globals()[name] = _context_query_classes[klass] = new_class
+    return _context_query_classes[klass]
+
+
+def _query_context(query):
+    # Django 1.8 copies the query context when it clones a query (and _QueryContextMixin
+    # does on 1.7), so anything we put in here sticks with the queryset through filter(),
+    # values_list() etc.
+    if django.VERSION < (1, 8) and not isinstance(query, _QueryContextMixin):
+        query.__class__ = _context_query_class(type(query))
+
+    if getattr(query, "context", None) is None:
+        query.context = {}
+    return query.context
+
+
+def _to_cursor(cursor):
+    if cursor is None or isinstance(cursor, Cursor):
+        return cursor
+    return Cursor(urlsafe=cursor)
+
+
+def set_cursors(queryset, start=None, end=None):
+    """
+        Returns a copy of the queryset which starts at the `start` cursor and stops at the `end`
+        cursor. Cursors can be the tokens returned by get_cursor(), or datastore_query.Cursor
+        instances.
+
+        Cursors are only supported on queries which run a single datastore query, so not on
+        OR queries, or those filtering on pk__in.
+    """
+    queryset = queryset.all()
+    context = _query_context(queryset.query)
+    if start is not None:
+        context["datastore_start_cursor"] = _to_cursor(start)
+    if end is not None:
+        context["datastore_end_cursor"] = _to_cursor(end)
+    return queryset
+
+
+def get_cursor(queryset):
+    """
+        Returns a token for the position after the last result read from an evaluated
+        queryset, or None if the query couldn't use cursors. The token is a string, so it
+        can be stored or passed to a task to carry on from the same position later.
+    """
+    cursor = (getattr(queryset.query, "context", None) or {}).get("datastore_cursor")
+    return cursor.urlsafe() if cursor is not None else None
+
+
+def set_datastore_options(queryset, eventual=False, **options):
+    """
+        Returns a copy of the queryset which passes the given options to the datastore RPCs:
+
+        - `batch_size` - The number of results to fetch in each batch after the first
+        - `prefetch_size` - The number of results to fetch in the first batch
+        - `read_policy` - datastore.EVENTUAL_CONSISTENCY or datastore.STRONG_CONSISTENCY
+        - `deadline` - The number of seconds to wait for each RPC
+
+        `eventual=True` is a shortcut for read_policy=datastore.EVENTUAL_CONSISTENCY. Results
+        of eventually consistent reads are never added to the cache.
+    """
+    unknown = set(options) - DATASTORE_OPTIONS
+    if unknown:
+        raise TypeError("Unknown datastore options: {}".format(", ".join(sorted(unknown))))
+
+    if eventual:
+        options["read_policy"] = datastore.EVENTUAL_CONSISTENCY
+
+    queryset = queryset.all()
+    context = _query_context(queryset.query)
+    context["datastore_options"] = dict(context.get("datastore_options") or {}, **options)
+    return queryset
+
+
+def iterate_in_batches(queryset, batch_size=500, start_cursor=None):
+    """
+        Yields (batch, cursor) for each batch of the queryset. Each batch is a separate query
+        which starts from the cursor the previous one finished at, so unlike offsets iterating
+        over a large queryset doesn't get slower (or more expensive) as it goes on. The cursor
+        can be passed back as start_cursor to resume after that batch.
+
+        Queries which can't use cursors are fetched using offsets, and the cursor is None.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be > 0")
+
+    cursor = start_cursor
+    offset = 0
+    while True:
+        if cursor is not None:
+            qs = set_cursors(queryset, start=cursor)[:batch_size]
+        else:
+            qs = queryset.all()[offset:offset + batch_size]
+
+        batch = list(qs)
+        offset += len(batch)
+        cursor = get_cursor(qs)
+
+        if batch:
+            yield batch, cursor
+
+        if len(batch) < batch_size:
+            break
+
+
+def explain(queryset):
+    """
+        Returns a dictionary describing how the queryset would be run on the datastore,
+        without running it (see SelectCommand.explain for what's in it). Querysets which
+        can't return anything have the strategy "empty".
+    """
+    try:
+        select, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+    except EmptyResultSet:
+        return {
+            "kind": queryset.model._meta.db_table,
+            "query_kind": None,
+            "strategy": "empty",
+            "branches": [],
+            "ordering": [],
+            "keys_only": False,
+            "projection": None,
+            "distinct": False,
+            "caches": [],
+            "rpcs": 0,
+            "post_processing": [],
+        }
+    return select.explain()
+
+
+def _can_save_async(model, objs):
+    if datastore.IsInTransaction() or has_concrete_parents(model):
+        return False
+
+    if any(getattr(obj, "_deferred", False) for obj in objs):
+        # save() only writes the fields which were loaded, a Put would wipe out the others
+        return False
+
+    if constraints.has_unique_markers(model):
+        # We can acquire the markers of new instances up front, but to move the markers
+        # of existing ones we'd have to read them first
+        return all(obj._state.adding and obj.pk is None for obj in objs)
+
+    return True
+
+
+def _save_async(model, using, objs, result):
+    if not _can_save_async(model, objs):
+        for obj in objs:
+            obj.save(using=using)
+        return WriteFuture(result=result)
+
+    # Anything queued by batch_writes() has to be written first
+    batching.flush()
+
+    connection = connections[using]
+    fields = get_concrete_fields(model)
+
+    created = []
+    entities = []
+    for obj in objs:
+        signals.pre_save.send(sender=model, instance=obj, raw=False, using=using, update_fields=None)
+        created.append(obj._state.adding)
+        entities.append(django_instance_to_entity(connection, model, fields, False, obj))
+
+    # Whatever is cached for existing entities is about to be stale
+    caching.remove_entities_from_cache_by_key([ x.key() for x in entities if x.key().has_id_or_name() ])
+
+    markers = []
+    if constraints.has_unique_markers(model):
+        # These are all new instances, so acquiring the markers doesn't need the old values
+        markers = constraints.acquire_bulk(model, entities)
+
+    rpcs = [
+        datastore.PutAsync(entities[i:i + MAX_ENTITIES_PER_PUT])
+        for i in xrange(0, len(entities), MAX_ENTITIES_PER_PUT)
+    ]
+
+    def callback(results):
+        # The Put fills in the keys of the entities
+        for obj, entity in zip(objs, entities):
+            obj.pk = entity.key().id_or_name()
+            obj._state.adding = False
+            obj._state.db = using
+
+        for entity, entity_markers in zip(entities, markers):
+            constraints.update_instance_on_markers(entity, entity_markers)
+
+        caching.add_entities_to_cache(model, entities, caching.CachingSituation.DATASTORE_PUT)
+
+        for obj, was_created in zip(objs, created):
+            signals.post_save.send(
+                sender=model, instance=obj, created=was_created, update_fields=None, raw=False, using=using
+            )
+        return result
+
+    def errback():
+        if markers:
+            constraints.release_markers(chain(*markers))
+
+    return WriteFuture(rpcs, callback=callback, errback=errback)
+
+
+def save_async(instance, using=None):
+    """
+        Saves the instance with a Put which is sent straight away, and returns a future.
+        Calling get_result() on the future waits for the Put to finish, then returns the
+        instance with its pk set. See bulk_save_async.
+    """
+    model = type(instance)
+    using = using or router.db_for_write(model, instance=instance)
+    return _save_async(model, using, [ instance ], instance)
+
+
+def bulk_save_async(queryset, objs):
+    """
+        Saves the instances of the queryset's model with Puts which are sent straight
+        away, and returns a future. Calling get_result() on the future waits for the Puts,
+        then returns the instances with their pks set. Caching, unique markers and the
+        post_save signal are dealt with once the Puts have finished.
+
+        Unlike save(), this doesn't check if something already exists with an instance's
+        pk, each instance is written as a whole. Instances can't be written asynchronously
+        in a transaction, if the model has concrete parents, if some of their fields were
+        deferred, or if they already exist and the model has unique constraints. In those
+        cases save() is called on each instance, and the future is already resolved.
+    """
+    objs = list(objs)
+    return _save_async(queryset.model, queryset.db, objs, objs)
+
+
+def delete_async(queryset):
+    """
+        Deletes the objects in the queryset with DeleteAsync, and returns a future which
+        waits for the deletes. The objects to delete are found straight away.
+
+        If Django needs to collect the objects before deleting them (for signals or
+        cascades), if they have unique markers to release, or in a transaction, delete()
+        is used instead and the future is already resolved.
+    """
+    assert queryset.query.can_filter(), "Cannot use 'limit' or 'offset' with delete."
+
+    model = queryset.model
+    using = queryset.db
+    if (
+        datastore.IsInTransaction() or
+        constraints.has_unique_markers(model) or
+        not Collector(using=using).can_fast_delete(queryset)
+    ):
+        queryset.delete()
+        return WriteFuture()
+
+    # This is how Django builds the query for deleting a queryset
+    query = DeleteQuery(model)
+    query.get_initial_alias()
+    queryset.query.get_initial_alias()
+    query.where = queryset.query.where
+
+    try:
+        command, params = query.get_compiler(using).as_sql()
+    except EmptyResultSet:
+        return WriteFuture()
+
+    return command.execute_async()
+
+
+class DatastoreQuerySet(models.QuerySet):
+    def start_cursor(self, cursor):
+        return set_cursors(self, start=cursor)
+
+    def end_cursor(self, cursor):
+        return set_cursors(self, end=cursor)
+
+    def get_cursor(self):
+        return get_cursor(self)
+
+    def datastore_options(self, eventual=False, **options):
+        return set_datastore_options(self, eventual=eventual, **options)
+
+    def iterate_in_batches(self, batch_size=500, start_cursor=None):
+        return iterate_in_batches(self, batch_size=batch_size, start_cursor=start_cursor)
+
+    def explain(self):
+        return explain(self)
+
+    def bulk_save_async(self, objs):
+        return bulk_save_async(self, objs)
+
+    def delete_async(self):
+        return delete_async(self)
+
+    def iterator(self, batch_size=None):
+        """
+            If batch_size is passed, then the results are streamed from the datastore in
+            batches using cursors, rather than in one query.
+        """
+        if batch_size is None:
+            for result in super(DatastoreQuerySet, self).iterator():
+                yield result
+            return
+
+        for batch, cursor in iterate_in_batches(self, batch_size=batch_size):
+            for result in batch:
+                yield result
+
+
+class DatastoreManager(models.Manager.from_queryset(DatastoreQuerySet)):
+    pass
+
+
+class AsyncSaveMixin(object):
+    """ Adds save_async() to a model, see save_async() above """
+
+    def save_async(self, using=None):
+        return save_async(self, using=using)
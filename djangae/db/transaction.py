@@ -12,7 +12,7 @@ from google.appengine.api.datastore import (
 )
 from google.appengine.datastore.datastore_rpc import TransactionOptions
 
-from djangae.db.backends.appengine import caching
+from djangae.db.backends.appengine import batching, caching
 
 
 def in_atomic_block():
@@ -99,6 +99,9 @@ class AtomicDecorator(ContextDecorator):
         independent = decorator_args.get("independent", False)
         xg = decorator_args.get("xg", False)
 
+        # Writes which were queued before the transaction must happen before it
+        batching.flush()
+
         # Reset the state
         state.conn_stack = []
         state.transaction_started = False
@@ -1,5 +1,6 @@
 from hashlib import md5
 from google.appengine.api import datastore
+from djangae.db.backends.appengine.multiquery import ParallelMultiQuery
 
 
 def _unique_combinations(model, ignore_pk=False):
@@ -75,7 +76,7 @@ def query_is_unique(model, query):
         that unique combination. Otherwise return False
     """
 
-    if isinstance(query, datastore.MultiQuery):
+    if isinstance(query, (datastore.MultiQuery, ParallelMultiQuery)):
         # By definition, a multiquery is not unique
         return False
 
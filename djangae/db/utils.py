@@ -1,7 +1,6 @@
 #STANDARD LIB
 from datetime import datetime
 from decimal import Decimal
-from itertools import chain
 
 import warnings
 
@@ -19,6 +18,7 @@ from djangae.utils import memoized
 from djangae.db.backends.appengine.indexing import special_indexes_for_column, REQUIRES_SPECIAL_INDEXES
 from djangae.db.backends.appengine.dbapi import CouldBeSupportedError
 from djangae.db.backends.appengine import POLYMODEL_CLASS_ATTRIBUTE
+from djangae.db.backends.appengine.multiquery import ParallelMultiQuery
 
 def make_timezone_naive(value):
     if value is None:
@@ -292,98 +292,66 @@ def lte(x, y):
     return not gt(x, y)
 
 
-def django_ordering_comparison(ordering, lhs, rhs):
-    if not ordering:
-        return -1  # Really doesn't matter
+MATCH_OPERATORS = {
+    "=": lambda x, y: x == y,
+    "<": lt,
+    ">": gt,
+    "<=": lte,
+    ">=": gte
+}
 
-    ASCENDING = 1
-    DESCENDING = 2
 
-    for order, direction in ordering:
-        if lhs is not None:
-            lhs_value = lhs.key() if order == "__key__" else lhs.get(order)
-        else:
-            lhs_value = None
+def compile_entity_matcher(query):
+    """
+        Returns a function which takes an entity, and returns True if the entity would
+        potentially be returned by the datastore query. The query's filters are only parsed
+        once, so the function is cheap to call for every result.
+    """
+    if isinstance(query, datastore.MultiQuery):
+        raise CouldBeSupportedError("We just need to separate the multiquery "
+                                    "into 'queries' then everything should work")
+    elif isinstance(query, ParallelMultiQuery):
+        # The entity matches if it would be returned by any of the branches
+        matchers = [ compile_entity_matcher(x) for x in query.queries ]
+        return lambda entity: any(matches(entity) for matches in matchers)
 
-        if rhs is not None:
-            rhs_value = rhs.key() if order == "__key__" else rhs.get(order)
-        else:
-            rhs_value = None
+    kind = query._Query__kind
 
-        if direction == ASCENDING and lhs_value != rhs_value:
-            return -1 if lt(lhs_value, rhs_value) else 1
-        elif direction == DESCENDING and lhs_value != rhs_value:
-            return 1 if lt(lhs_value, rhs_value) else -1
+    comparisons = []
+    for lookup in query.keys():
+        column, op = lookup.split(" ")
+        if column == "__key__":
+            continue
 
-    return 0
+        op = MATCH_OPERATORS[op]  # We want this to throw if there's some op we don't know about
 
+        # The query value can be a list of ANDed values
+        value = query[lookup]
+        values = tuple(value) if isinstance(value, (list, tuple)) else (value,)
 
-def entity_matches_query(entity, query):
-    """
-        Return True if the entity would potentially be returned by the datastore
-        query
-    """
-    OPERATORS = {
-        "=": lambda x, y: x == y,
-        "<": lt,
-        ">": gt,
-        "<=": lte,
-        ">=": gte
-    }
+        comparisons.append((column, op, values))
 
-    queries = [query]
-    if isinstance(query, datastore.MultiQuery):
-        raise CouldBeSupportedError("We just need to separate the multiquery "
-                                    "into 'queries' then everything should work")
+    def matches(entity):
+        if entity.kind() != kind:
+            return False
 
-    for query in queries:
-        comparisons = chain(
-            [("_Query__kind", "=", "_Query__kind") ],
-            [tuple(x.split(" ") + [ x ]) for x in query.keys()]
-        )
+        for column, op, values in comparisons:
+            attrs = entity.get(column)
+            if not isinstance(attrs, (list, tuple)):
+                attrs = (attrs,)
 
-        for ent_attr, op, query_attr in comparisons:
-            if ent_attr == "__key__":
-                continue
+            # If any of the values don't match then the query doesn't match
+            for value in values:
+                if not any(op(attr, value) for attr in attrs):
+                    return False
+        return True
+
+    return matches
 
-            op = OPERATORS[op]  # We want this to throw if there's some op we don't know about
-
-            if ent_attr == "_Query__kind":
-                ent_attr = entity.kind()
-            else:
-                ent_attr = entity.get(ent_attr)
-
-            if callable(ent_attr):
-                # entity.kind() is a callable, so we need this to save special casing it in a more
-                # ugly way
-                ent_attr = ent_attr()
-
-            if not isinstance(query_attr, (list, tuple)):
-                query_attrs = [query_attr]
-            else:
-                # The query value can be a list of ANDed values
-                query_attrs = query_attr
-
-            query_attrs = [ getattr(query, x) if x == "_Query__kind" else query.get(x) for x in query_attrs ]
-
-            if not isinstance(ent_attr, (list, tuple)):
-                ent_attr = [ ent_attr ]
-
-            matches = False
-            for query_attr in query_attrs:  # [22, 23]
-                #If any of the values don't match then this query doesn't match
-                if not any([op(attr, query_attr) for attr in ent_attr]):
-                    matches = False
-                    break
-            else:
-                # One of the ent_attrs matches the query_attrs
-                matches = True
-
-            if not matches:
-                # One of the AND values didn't match
-                break
-        else:
-            # If we got through the loop without breaking, then the entity matches
-            return True
 
-    return False
+def entity_matches_query(entity, query):
+    """
+        Return True if the entity would potentially be returned by the datastore
+        query. If you are checking more than one entity, use compile_entity_matcher.
+    """
+    return compile_entity_matcher(query)(entity)
@@ -15,6 +15,7 @@ from djangae.db import unique_utils
 from djangae.db import transaction
 from djangae.db.backends.appengine.context import ContextStack
 from djangae.db.backends.appengine import caching
+from djangae.db.backends.appengine import process_cache
 from djangae.db.caching import disable_cache, clear_context_cache
 
 
@@ -88,6 +89,106 @@ class ContextStackTests(TestCase):
 
         self.assertEqual({"field1": "oneone"}, stack.top.cache["entity"])
 
+    def test_cached_entities_are_copy_on_write(self):
+        stack = ContextStack()
+
+        entity = FakeEntity({"field1": "one", "list_field": [1, 2]})
+
+        stack.top.cache_entity(["a", "b"], entity, caching.CachingSituation.DATASTORE_PUT)
+
+        # Both identifiers should share the same snapshot
+        self.assertIs(stack.top.cache.get_snapshot("a"), stack.top.cache.get_snapshot("b"))
+
+        # Altering the original doesn't affect the cache
+        entity["list_field"].append(3)
+        self.assertEqual([1, 2], stack.top.cache["a"]["list_field"])
+
+        # Altering what we read doesn't affect the cache either
+        cached = stack.top.cache["a"]
+        cached["field1"] = "two"
+        cached["list_field"].append(3)
+
+        self.assertEqual({"field1": "one", "list_field": [1, 2]}, stack.top.cache["b"])
+        self.assertEqual(entity.key(), stack.top.get_entity_by_key(entity.key()).key())
+
+    def test_lru_eviction(self):
+        stack = ContextStack(max_entries=2)
+
+        entity1 = FakeEntity({"field1": "one"})
+        entity2 = FakeEntity({"field1": "two"})
+        entity3 = FakeEntity({"field1": "three"})
+
+        stack.top.cache_entity(["a", "a2"], entity1, caching.CachingSituation.DATASTORE_GET)
+        stack.top.cache_entity(["b"], entity2, caching.CachingSituation.DATASTORE_GET)
+
+        # Touch entity1 so that entity2 is the least recently used
+        stack.top.get_entity("a")
+        stack.top.cache_entity(["c"], entity3, caching.CachingSituation.DATASTORE_GET)
+
+        self.assertItemsEqual(["a", "a2", "c"], stack.top.cache.keys())
+        self.assertFalse(entity2.key() in stack.top.reverse_cache)
+        self.assertEqual(1, stack.top.evictions)
+        self.assertEqual(2, stack.top.peak_entries)
+
+        # Entities written in a transaction aren't evicted until the transaction is applied
+        stack.push()
+        stack.top.cache_entity(["a"], entity1, caching.CachingSituation.DATASTORE_PUT)
+        stack.top.cache_entity(["b"], entity2, caching.CachingSituation.DATASTORE_PUT)
+        stack.top.cache_entity(["c"], entity3, caching.CachingSituation.DATASTORE_PUT)
+        self.assertItemsEqual(["a", "b", "c"], stack.top.cache.keys())
+
+        stack.pop(apply_staged=True, clear_staged=True)
+        self.assertEqual(2, len(stack.top.cache))
+        self.assertEqual(2, len(stack.top.reverse_cache))
+
+    def test_lru_order_is_kept_when_a_transaction_is_applied(self):
+        stack = ContextStack(max_entries=3)
+
+        entity1 = FakeEntity({"field1": "one"})
+        entity2 = FakeEntity({"field1": "two"})
+        entity3 = FakeEntity({"field1": "three"})
+
+        stack.push()
+        stack.top.cache_entity(["a"], entity1, caching.CachingSituation.DATASTORE_GET)
+        stack.top.cache_entity(["b"], entity2, caching.CachingSituation.DATASTORE_GET)
+        stack.top.get_entity("a")
+        stack.top.cache_entity(["c"], entity3, caching.CachingSituation.DATASTORE_PUT)
+        stack.pop(apply_staged=True, clear_staged=True)
+
+        # entity2 was used least recently, and entity3 was written most recently
+        self.assertEqual([entity2.key(), entity1.key(), entity3.key()], stack.top._lru.keys())
+
+        stack.top.cache_entity(["d"], FakeEntity({"field1": "four"}), caching.CachingSituation.DATASTORE_GET)
+        self.assertItemsEqual(["a", "c", "d"], stack.top.cache.keys())
+
+    def test_uncached_keys_are_forgotten_outside_transactions(self):
+        stack = ContextStack()
+
+        entity1 = FakeEntity({"field1": "one"})
+        entity2 = FakeEntity({"field1": "two"})
+
+        stack.top.cache_entity(["a"], entity1, caching.CachingSituation.DATASTORE_GET)
+        stack.top.uncache_entity(entity1.key())
+        self.assertFalse(entity1.key() in stack.top.reverse_cache)
+
+        # The transaction remembers the key until the stack has evicted it from memcache
+        stack.push()
+        stack.top.cache_entity(["b"], entity2, caching.CachingSituation.DATASTORE_PUT)
+        stack.top.uncache_entity(entity2.key())
+        self.assertTrue(entity2.key() in stack.top.reverse_cache)
+
+        stack.pop(apply_staged=True, clear_staged=True)
+        self.assertEqual({}, stack.top.reverse_cache)
+
+    def test_max_bytes(self):
+        stack = ContextStack(max_bytes=100)
+
+        stack.top.cache_entity(["a"], FakeEntity({"field1": "x" * 60}), caching.CachingSituation.DATASTORE_GET)
+        stack.top.cache_entity(["b"], FakeEntity({"field1": "y" * 60}), caching.CachingSituation.DATASTORE_GET)
+
+        self.assertItemsEqual(["b"], stack.top.cache.keys())
+        self.assertTrue(stack.top.size_in_bytes <= 100)
+
 
 
 class CachingTestModel(models.Model):
@@ -130,7 +231,7 @@ class MemcacheCachingTests(TestCase):
 
         instance = CachingTestModel.objects.create(id=222, **entity_data)
         for identifier in identifiers:
-            self.assertEqual(entity_data, cache.get(identifier))
+            self.assertEqual(entity_data, caching._get_entity_from_memcache(identifier))
 
         with transaction.atomic():
             instance.field1 = "Banana"
@@ -140,7 +241,7 @@ class MemcacheCachingTests(TestCase):
         # and that a get then hits the datastore (which then in turn caches)
         with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
             for identifier in identifiers:
-                self.assertIsNone(cache.get(identifier))
+                self.assertIsNone(caching._get_entity_from_memcache(identifier))
 
             self.assertEqual("Banana", CachingTestModel.objects.get(pk=instance.pk).field1)
             self.assertTrue(datastore_get.called)
@@ -157,24 +258,24 @@ class MemcacheCachingTests(TestCase):
         identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(caching._get_entity_from_memcache(identifier))
 
         instance = CachingTestModel.objects.create(id=222, **entity_data)
 
         for identifier in identifiers:
-            self.assertEqual(entity_data, cache.get(identifier))
+            self.assertEqual(entity_data, caching._get_entity_from_memcache(identifier))
 
         instance.delete()
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(caching._get_entity_from_memcache(identifier))
 
         with transaction.atomic():
             instance = CachingTestModel.objects.create(**entity_data)
 
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(caching._get_entity_from_memcache(identifier))
 
     @disable_cache(memcache=False, context=True)
     def test_save_wipes_entity_from_cache_inside_transaction(self):
@@ -187,18 +288,18 @@ class MemcacheCachingTests(TestCase):
         identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(caching._get_entity_from_memcache(identifier))
 
         instance = CachingTestModel.objects.create(id=222, **entity_data)
 
         for identifier in identifiers:
-            self.assertEqual(entity_data, cache.get(identifier))
+            self.assertEqual(entity_data, caching._get_entity_from_memcache(identifier))
 
         with transaction.atomic():
             instance.save()
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(caching._get_entity_from_memcache(identifier))
 
     @disable_cache(memcache=False, context=True)
     def test_transactional_save_wipes_the_cache_only_after_its_result_is_consistently_available(self):
@@ -208,12 +309,12 @@ class MemcacheCachingTests(TestCase):
         identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(caching._get_entity_from_memcache(identifier))
 
         instance = CachingTestModel.objects.create(id=222, **entity_data)
 
         for identifier in identifiers:
-            self.assertEqual("old", cache.get(identifier)["field1"])
+            self.assertEqual("old", caching._get_entity_from_memcache(identifier)["field1"])
 
         @non_transactional
         def non_transactional_read(instance_pk):
@@ -225,7 +326,212 @@ class MemcacheCachingTests(TestCase):
             non_transactional_read(instance.pk)  # could potentially recache the old object
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(caching._get_entity_from_memcache(identifier))
+
+    @disable_cache(memcache=False, context=True)
+    def test_entities_are_stored_once_in_memcache(self):
+        entity_data = {
+            "field1": "Apple",
+            "comb1": 1,
+            "comb2": "Cherry"
+        }
+
+        with sleuth.watch("djangae.db.backends.appengine.caching._memcache_set_many") as set_many:
+            instance = CachingTestModel.objects.create(id=222, **entity_data)
+
+        values = set_many.calls[0].args[0].values()
+        self.assertEqual(1, len([ x for x in values if isinstance(x, datastore.Entity) ]))
+        self.assertEqual(2, len([ x for x in values if isinstance(x, datastore.Key) ]))
+
+        # Lookups on the other unique identifiers follow the pointer
+        identifier = unique_utils.query_is_unique(CachingTestModel, {"field1 =": "Apple"})
+        self.assertEqual(entity_data, caching._get_entity_from_memcache(identifier))
+
+        # If the pointer is stale, it's ignored
+        instance.field1 = "Banana"
+        instance.save()
+        self.assertIsNone(caching._get_entity_from_memcache(identifier))
+
+    @disable_cache(memcache=False, context=True)
+    def test_large_entities_are_compressed_and_chunked(self):
+        instance = CachingTestModel.objects.create(id=222, field1="Apple", comb2="x" * 50000)
+
+        identifier, _ = caching._get_cache_key_and_model_from_datastore_key(
+            datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        )
+
+        # Compressible values are compressed
+        caching.wait_for_memcache_writes()
+        self.assertTrue(cache.get(identifier).startswith(caching._COMPRESSED_ENTITY_PREFIX))
+        self.assertEqual("x" * 50000, caching._get_entity_from_memcache(identifier)["comb2"])
+
+        with sleuth.switch("djangae.db.backends.appengine.caching.MAX_MEMCACHE_VALUE_SIZE", 20):
+            instance.save()
+            caching.wait_for_memcache_writes()
+
+            self.assertTrue(cache.get(identifier).startswith(caching._CHUNKED_PREFIX))
+            with sleuth.watch("django.core.cache.cache.get_many") as get_many:
+                self.assertEqual("x" * 50000, caching._get_entity_from_memcache(identifier)["comb2"])
+            self.assertEqual(1, get_many.call_count)
+
+            # If any chunk goes missing, it's a cache miss
+            token, count = cache.get(identifier)[1:].split(":")
+            cache.delete(caching._chunk_key(identifier, token, 0))
+            self.assertIsNone(caching._get_entity_from_memcache(identifier))
+
+    def test_values_in_an_unknown_format_are_cache_misses(self):
+        instance = CachingTestModel.objects.create(id=222, field1="Apple")
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        identifier, _ = caching._get_cache_key_and_model_from_datastore_key(key)
+
+        # e.g. a pickled entity, written by an older version
+        for value in (datastore.Get(key), "Xsomething", caching._ENTITY_PREFIX + "garbage", caching._CHUNKED_PREFIX + "nonsense"):
+            caching.wait_for_memcache_writes()
+            cache.set(identifier, value)
+            self.assertIsNone(caching._memcache_get(identifier))
+
+            clear_context_cache()
+            self.assertEqual(instance, CachingTestModel.objects.get(pk=222))
+
+    def test_missing_entities_are_cached_briefly(self):
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            self.assertEqual([], list(CachingTestModel.objects.filter(pk=222)))
+            self.assertEqual(1, datastore_get.call_count)
+
+            # Both the context cache and memcache know this doesn't exist
+            self.assertEqual([], list(CachingTestModel.objects.filter(pk=222)))
+            clear_context_cache()
+            self.assertEqual([], list(CachingTestModel.objects.filter(pk=222)))
+            self.assertEqual(1, datastore_get.call_count)
+
+        # Unique lookups find keys with an eventually consistent query, so a miss isn't cached
+        with sleuth.watch("djangae.db.backends.appengine.caching.add_tombstones_to_cache") as add_tombstones:
+            self.assertEqual([], list(CachingTestModel.objects.filter(field1="Apple")))
+            self.assertFalse(add_tombstones.called)
+
+        # Creating the entity replaces the tombstones
+        CachingTestModel.objects.create(id=222, field1="Apple")
+        clear_context_cache()
+        self.assertEqual(1, len(CachingTestModel.objects.filter(pk=222)))
+        self.assertEqual(1, len(CachingTestModel.objects.filter(field1="Apple")))
+
+    def test_tombstones_are_not_written_after_an_invalidated_lease(self):
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        identifier, _ = caching._get_cache_key_and_model_from_datastore_key(key)
+
+        entity, lease = caching.acquire_lease(key)
+        self.assertTrue(lease)
+
+        # The entity is created while we're reading
+        caching.remove_entities_from_cache_by_key([key])
+        caching.add_tombstones_to_cache_by_key([key], lease=lease)
+        caching.wait_for_memcache_writes()
+        self.assertIsNone(cache.get(identifier))
+
+    def test_transactional_save_wipes_tombstones(self):
+        identifier, _ = caching._get_cache_key_and_model_from_datastore_key(
+            datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        )
+
+        list(CachingTestModel.objects.filter(pk=222))
+        self.assertEqual(caching.TOMBSTONE, caching._memcache_get(identifier))
+
+        with transaction.atomic():
+            CachingTestModel.objects.create(id=222, field1="Apple")
+
+        self.assertIsNone(caching._memcache_get(identifier))
+        self.assertEqual("Apple", CachingTestModel.objects.get(pk=222).field1)
+
+    @disable_cache(memcache=False, context=True)
+    def test_cache_refill_leases(self):
+        instance = CachingTestModel.objects.create(id=222, field1="Apple")
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        identifier, _ = caching._get_cache_key_and_model_from_datastore_key(key)
+        cache.clear()
+
+        # Someone else is refilling the cache, but they never finish, so we give up waiting
+        cache.add(caching._lease_cache_key(identifier), "other", 3)
+        with sleuth.switch("djangae.db.backends.appengine.caching.CACHE_LEASE_WAIT_SECONDS", 0.1):
+            with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+                self.assertEqual(instance, CachingTestModel.objects.get(pk=222))
+        self.assertEqual(1, datastore_get.call_count)
+
+        # If the entity is written while we hold the lease, we don't cache what we read
+        cache.clear()
+        entity, lease = caching.acquire_lease(key)
+        self.assertIsNone(entity)
+        self.assertTrue(lease)
+
+        stale = datastore.Get(key)
+        caching.remove_entities_from_cache_by_key([key])
+        caching.add_entities_to_cache(CachingTestModel, [stale], caching.CachingSituation.DATASTORE_GET, lease=lease)
+        self.assertIsNone(caching._memcache_get(identifier))
+
+        # Otherwise the lease is checked and released with a single compare-and-set
+        cache.clear()
+        entity, lease = caching.acquire_lease(key)
+        with sleuth.watch("google.appengine.api.memcache.Client.cas") as cas:
+            caching.add_entities_to_cache(CachingTestModel, [stale], caching.CachingSituation.DATASTORE_GET, lease=lease)
+        self.assertTrue(cas.called)
+        self.assertEqual("Apple", caching._memcache_get(identifier)["field1"])
+        self.assertNotEqual(lease, cache.get(caching._lease_cache_key(identifier)))
+
+        # Releasing a lease which was taken over leaves the new holder's lease alone
+        cache.clear()
+        entity, lease = caching.acquire_lease(key)
+        cache.set(caching._lease_cache_key(identifier), "other", 3)
+        caching.release_lease(key, lease)
+        self.assertEqual("other", cache.get(caching._lease_cache_key(identifier)))
+
+    def test_entities_found_while_waiting_on_a_lease_are_added_to_the_context_cache(self):
+        instance = CachingTestModel.objects.create(id=222, field1="Apple")
+        entity = datastore.Get(datastore.Key.from_path(CachingTestModel._meta.db_table, 222))
+        clear_context_cache()
+        cache.clear()
+
+        # Someone else refilled the cache while we waited
+        with sleuth.switch("djangae.db.backends.appengine.caching.acquire_lease", lambda key: (entity, None)):
+            self.assertEqual(instance, CachingTestModel.objects.get(pk=222))
+
+        cache.clear()
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            self.assertEqual(instance, CachingTestModel.objects.get(pk=222))
+            self.assertFalse(datastore_get.called)
+
+    @disable_cache(memcache=False, context=True)
+    def test_memcache_writes_are_asynchronous(self):
+        with sleuth.watch("google.appengine.api.memcache.Client.set_multi_async") as set_multi_async:
+            with sleuth.watch("django.core.cache.cache.set_many") as set_many:
+                instance = CachingTestModel.objects.create(id=222, field1="Apple")
+
+        self.assertTrue(set_multi_async.called)
+        self.assertFalse(set_many.called)
+
+        # Reads wait for the pending write
+        identifier, _ = caching._get_cache_key_and_model_from_datastore_key(
+            datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+        )
+        self.assertEqual("Apple", caching._memcache_get(identifier)["field1"])
+
+        with sleuth.watch("google.appengine.api.memcache.Client.delete_multi_async") as delete_multi_async:
+            instance.delete()
+
+        self.assertTrue(delete_multi_async.called)
+        caching.wait_for_memcache_writes()
+        self.assertIsNone(caching._memcache_get(identifier))
+
+    @disable_cache(memcache=False, context=True)
+    def test_invalidation_without_the_cached_entity(self):
+        instance = CachingTestModel.objects.create(id=222, field1="Apple")
+        identifier = unique_utils.query_is_unique(CachingTestModel, {"field1 =": "Apple"})
+        key = datastore.Key.from_path(CachingTestModel._meta.db_table, 222)
+
+        # Even if the entity itself has gone from memcache, the pointer doesn't return stale data
+        caching._memcache_delete_many([caching._get_cache_key_and_model_from_datastore_key(key)[0]])
+        self.assertIsNone(caching._get_entity_from_memcache(identifier))
+
+        CachingTestModel.objects.filter(pk=instance.pk).update(field1="Banana")
+        self.assertIsNone(caching._get_entity_from_memcache(identifier))
 
     @disable_cache(memcache=False, context=True)
     def test_consistent_read_updates_memcache_outside_transaction(self):
@@ -238,22 +544,22 @@ class MemcacheCachingTests(TestCase):
         identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(caching._get_entity_from_memcache(identifier))
 
         CachingTestModel.objects.create(id=222, **entity_data)
 
         for identifier in identifiers:
-            self.assertEqual(entity_data, cache.get(identifier))
+            self.assertEqual(entity_data, caching._get_entity_from_memcache(identifier))
 
         cache.clear()
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(caching._get_entity_from_memcache(identifier))
 
         CachingTestModel.objects.get(id=222) # Consistent read
 
         for identifier in identifiers:
-            self.assertEqual(entity_data, cache.get(identifier))
+            self.assertEqual(entity_data, caching._get_entity_from_memcache(identifier))
 
     @disable_cache(memcache=False, context=True)
     def test_eventual_read_doesnt_update_memcache(self):
@@ -266,22 +572,22 @@ class MemcacheCachingTests(TestCase):
         identifiers = unique_utils.unique_identifiers_from_entity(CachingTestModel, FakeEntity(entity_data, id=222))
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(caching._get_entity_from_memcache(identifier))
 
         CachingTestModel.objects.create(id=222, **entity_data)
 
         for identifier in identifiers:
-            self.assertEqual(entity_data, cache.get(identifier))
+            self.assertEqual(entity_data, caching._get_entity_from_memcache(identifier))
 
         cache.clear()
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(caching._get_entity_from_memcache(identifier))
 
         CachingTestModel.objects.all()[0] # Inconsistent read
 
         for identifier in identifiers:
-            self.assertIsNone(cache.get(identifier))
+            self.assertIsNone(caching._get_entity_from_memcache(identifier))
 
     @disable_cache(memcache=False, context=True)
     def test_unique_filter_hits_memcache(self):
@@ -401,12 +707,12 @@ class MemcacheCachingTests(TestCase):
 
     @disable_cache(memcache=False, context=True)
     def test_bulk_cache(self):
-        with sleuth.watch("django.core.cache.cache.set_many") as set_many_1:
+        with sleuth.watch("djangae.db.backends.appengine.caching._memcache_set_many") as set_many_1:
             CachingTestModel.objects.create(field1="Apple", comb1=1, comb2="Cherry")
         self.assertEqual(set_many_1.call_count, 1)
         self.assertEqual(len(set_many_1.calls[0].args[0]), 3)
 
-        with sleuth.watch("django.core.cache.cache.set_many") as set_many_2:
+        with sleuth.watch("djangae.db.backends.appengine.caching._memcache_set_many") as set_many_2:
             CachingTestModel.objects.bulk_create([
                 CachingTestModel(field1="Banana", comb1=2, comb2="Cherry"),
                 CachingTestModel(field1="Orange", comb1=3, comb2="Cherry"),
@@ -415,18 +721,147 @@ class MemcacheCachingTests(TestCase):
         self.assertEqual(len(set_many_2.calls[0].args[0]), 3*2)
 
         pks = list(CachingTestModel.objects.values_list('pk', flat=True))
-        with sleuth.watch("django.core.cache.cache.set_many") as set_many_3:
+
+        # Everything is cached at this point, so clear it out to check a pk__in query repopulates it
+        cache.clear()
+        clear_context_cache()
+
+        with sleuth.watch("djangae.db.backends.appengine.caching._memcache_set_many") as set_many_3:
             list(CachingTestModel.objects.filter(pk__in=pks).all())
         self.assertEqual(set_many_3.call_count, 1)
         self.assertEqual(len(set_many_3.calls[0].args[0]), 3*len(pks))
 
         with sleuth.watch("django.core.cache.cache.get_many") as get_many:
-            with sleuth.watch("django.core.cache.cache.delete_many") as delete_many:
+            with sleuth.watch("djangae.db.backends.appengine.caching._memcache_delete_many") as delete_many:
                 CachingTestModel.objects.all().delete()
 
-        self.assertEqual(get_many.call_count, 1)
+        # Invalidation doesn't need to read anything back from memcache
+        self.assertFalse(get_many.called)
         self.assertEqual(delete_many.call_count, 1)
-        self.assertEqual(len(get_many.calls[0].args[0]), 3)  # Get by pk from cache
+        self.assertEqual(len(delete_many.calls[0].args[0]), 3 * (3 + 1))  # Each identifier, plus the lease
+
+    def test_multiple_key_lookups_use_cache(self):
+        instances = [
+            CachingTestModel.objects.create(field1=x, comb1=i, comb2=x)
+            for i, x in enumerate(["Apple", "Banana", "Cherry"])
+        ]
+        pks = [ x.pk for x in instances ]
+
+        clear_context_cache()
+
+        # Entities come from a single memcache lookup
+        with sleuth.watch("django.core.cache.cache.get_many") as get_many:
+            with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+                results = list(CachingTestModel.objects.filter(pk__in=pks))
+
+        self.assertItemsEqual(pks, [ x.pk for x in results ])
+        self.assertEqual(1, get_many.call_count)
+        self.assertFalse(datastore_get.called)
+
+        # Now they're in the context cache, a missing one is fetched from the datastore
+        cache.clear()
+        clear_context_cache()
+        list(CachingTestModel.objects.filter(pk__in=pks[:2]))
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            results = list(CachingTestModel.objects.filter(pk__in=pks).order_by("pk"))
+
+        self.assertEqual(sorted(pks), [ x.pk for x in results ])
+        self.assertEqual(1, datastore_get.call_count)
+        self.assertEqual(1, len(datastore_get.calls[0].args[0])) # Only the missing key was fetched
+
+
+class ProcessCachedModel(models.Model):
+    field1 = models.CharField(max_length=255, unique=True)
+
+    class Meta:
+        app_label = "djangae"
+
+    class Djangae:
+        enable_process_cache = True
+
+
+class ProcessCachingTests(TestCase):
+    """
+        Models which enable the process cache are cached across requests in the instance,
+        entries are invalidated when the kind's generation in memcache changes.
+    """
+
+    def setUp(self):
+        super(ProcessCachingTests, self).setUp()
+        process_cache.entity_cache.clear()
+
+    def test_reads_are_served_from_process_cache(self):
+        instance = ProcessCachedModel.objects.create(field1="Apple")
+        clear_context_cache()
+
+        ProcessCachedModel.objects.get(pk=instance.pk) # Populates the process cache
+        clear_context_cache()
+
+        with sleuth.watch("django.core.cache.cache.get_many") as get_many:
+            with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+                self.assertEqual("Apple", ProcessCachedModel.objects.get(pk=instance.pk).field1)
+                self.assertEqual("Apple", ProcessCachedModel.objects.get(field1="Apple").field1)
+
+        self.assertFalse(get_many.called)
+        self.assertFalse(datastore_get.called)
+
+    def test_new_generation_invalidates_entries(self):
+        instance = ProcessCachedModel.objects.create(field1="Apple")
+        clear_context_cache()
+        ProcessCachedModel.objects.get(pk=instance.pk)
+
+        # Simulate a write on another instance
+        process_cache._new_generation(ProcessCachedModel._meta.db_table)
+        clear_context_cache()
+
+        with sleuth.watch("django.core.cache.cache.get_many") as get_many:
+            ProcessCachedModel.objects.get(pk=instance.pk)
+        self.assertTrue(get_many.called)
+
+    def test_saving_invalidates_entries(self):
+        instance = ProcessCachedModel.objects.create(field1="Apple")
+        clear_context_cache()
+        ProcessCachedModel.objects.get(pk=instance.pk)
+
+        instance.field1 = "Banana"
+        instance.save()
+        clear_context_cache()
+
+        self.assertEqual("Banana", ProcessCachedModel.objects.get(pk=instance.pk).field1)
+
+    def test_generation_is_replaced_once_the_transaction_is_applied(self):
+        instance = ProcessCachedModel.objects.create(field1="Apple")
+
+        with sleuth.watch("djangae.db.backends.appengine.process_cache._new_generation") as new_generation:
+            with transaction.atomic():
+                instance.field1 = "Banana"
+                instance.save()
+                self.assertFalse(new_generation.called)
+            self.assertTrue(new_generation.called)
+
+    def test_entities_read_before_a_new_generation_are_not_cached(self):
+        instance = ProcessCachedModel.objects.create(field1="Apple")
+        key = datastore.Key.from_path(ProcessCachedModel._meta.db_table, instance.pk)
+
+        # The generation is pinned when we look, before we fetch
+        self.assertIsNone(process_cache.entity_cache.get(key))
+        entity = datastore.Get(key)
+
+        # Another instance writes before we add what we read
+        process_cache._new_generation(ProcessCachedModel._meta.db_table)
+        caching.add_entities_to_cache(ProcessCachedModel, [entity], caching.CachingSituation.DATASTORE_GET)
+        self.assertIsNone(process_cache.entity_cache.get(key))
+
+    @disable_cache(memcache=True, context=False)
+    def test_disabling_memcache_disables_process_cache(self):
+        instance = ProcessCachedModel.objects.create(field1="Apple")
+        ProcessCachedModel.objects.get(pk=instance.pk)
+        clear_context_cache()
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as datastore_get:
+            ProcessCachedModel.objects.get(pk=instance.pk)
+        self.assertTrue(datastore_get.called)
 
 
 class ContextCachingTests(TestCase):
@@ -12,6 +12,7 @@ from django.core.files.uploadhandler import StopFutureHandlers
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.db import DataError, models
+from django.db.models import signals
 from django.db.models.query import Q
 from django.forms import ModelForm
 from django.test import RequestFactory
@@ -19,7 +20,7 @@ from django.utils.safestring import SafeText
 from django.forms.models import modelformset_factory
 from google.appengine.api.datastore_errors import EntityNotFoundError, BadValueError
 from google.appengine.api import datastore
-from google.appengine.ext import deferred
+from google.appengine.ext import db, deferred
 from google.appengine.api import taskqueue
 from django.test.utils import override_settings
 from django.core.exceptions import FieldError
@@ -32,8 +33,12 @@ from django.db import IntegrityError, NotSupportedError
 from djangae.db.constraints import UniqueMarker, UniquenessMixin
 from djangae.db.unique_utils import _unique_combinations, unique_identifiers_from_entity
 from djangae.db.backends.appengine.indexing import add_special_index
-from djangae.db.utils import entity_matches_query, decimal_to_string, normalise_field_value
-from djangae.db.caching import disable_cache
+from djangae.db.backends.appengine.multiquery import ParallelMultiQuery
+from djangae.db.backends.appengine import query_log
+from djangae.db.utils import entity_matches_query, compile_entity_matcher, decimal_to_string, normalise_field_value
+from djangae.db.caching import disable_cache, clear_context_cache
+from djangae.db import batch_writes, transaction
+from djangae.db.models import AsyncSaveMixin, DatastoreManager, save_async
 from djangae.fields import SetField, ListField, RelatedSetField
 from djangae.storage import BlobstoreFileUploadHandler
 from djangae.core import paginator
@@ -270,6 +275,37 @@ class BackendTests(TestCase):
         entity["name"] = [ "Bob", "Fred", "Dave" ]
         self.assertTrue(entity_matches_query(entity, query))  # ListField test
 
+    def test_compiled_entity_matcher(self):
+        query = datastore.Query("test_model")
+        query["name ="] = "Charlie"
+        query["age >"] = 5
+        matches = compile_entity_matcher(query)
+
+        # Changing the query doesn't affect a matcher which has already been compiled
+        query["name ="] = "Fred"
+
+        entity = datastore.Entity("test_model")
+        entity["name"] = "Charlie"
+        entity["age"] = 22
+        self.assertTrue(matches(entity))
+
+        entity["age"] = 3
+        self.assertFalse(matches(entity))
+
+        other = datastore.Entity("other_model")
+        other["name"] = "Charlie"
+        other["age"] = 22
+        self.assertFalse(matches(other))
+
+        # A branched query matches if any of its branches match
+        branch1 = datastore.Query("test_model", {"name =": "Fred"})
+        branch2 = datastore.Query("test_model", {"age >": 20})
+        matches = compile_entity_matcher(ParallelMultiQuery([branch1, branch2], []))
+        self.assertFalse(matches(entity))
+
+        entity["age"] = 21
+        self.assertTrue(matches(entity))
+
     def test_defaults(self):
         fruit = TestFruit.objects.create(name="Apple", color="Red")
         self.assertEqual("Unknown", fruit.origin)
@@ -300,15 +336,14 @@ class BackendTests(TestCase):
                 self.assertEqual(query_anc.calls[0].args[1], datastore.Key.from_path(TestFruit._meta.db_table, "0"))
 
         # Now check projections work with more than 30 things
-        with sleuth.watch('google.appengine.api.datastore.MultiQuery.__init__') as query_init:
+        with sleuth.watch('djangae.db.backends.appengine.multiquery.ParallelMultiQuery.__init__') as query_init:
             with sleuth.watch('google.appengine.api.datastore.Query.Ancestor') as query_anc:
                 keys = [str(x) for x in range(32)]
                 results = list(TestFruit.objects.only("color").filter(pk__in=keys).order_by("name"))
 
-                self.assertEqual(query_init.call_count, 2) # Two multi queries
+                self.assertEqual(query_init.call_count, 1) # All of the ancestor queries run together
                 self.assertEqual(query_anc.call_count, 32) # 32 Ancestor calls
-                self.assertEqual(len(query_init.calls[0].args[1]), 30)
-                self.assertEqual(len(query_init.calls[1].args[1]), 2)
+                self.assertEqual(len(query_init.calls[0].args[1]), 32)
 
                 # Confirm the ordering is correct
                 self.assertEqual(sorted(keys), [ x.pk for x in results ])
@@ -387,6 +422,18 @@ class BackendTests(TestCase):
         self.assertEqual(u'0237812.000', decimal_to_string(decimal.Decimal(237812), 10, 3))
         self.assertEqual(u'-0237812.210', decimal_to_string(decimal.Decimal(-237812.21), 10, 3))
 
+    def test_selects_dont_track_returned_ids(self):
+        for i in xrange(3):
+            TestUser.objects.create(username=str(i), email="{}@example.com".format(i))
+
+        with sleuth.watch("djangae.db.backends.appengine.base.Cursor.execute") as execute:
+            with sleuth.watch("djangae.db.backends.appengine.commands.SelectCommand._build_row_processor") as build:
+                results = list(TestUser.objects.extra(select={"is_one": "username = '1'"}).order_by("username"))
+                self.assertEqual(1, build.call_count) # Once per query, not per row
+
+            self.assertEqual([False, True, False], [x.is_one for x in results])
+            self.assertEqual([], execute.calls[0].args[0].returned_ids)
+
     def test_gae_conversion(self):
         # A PK IN query should result in a single get by key
 
@@ -398,7 +445,7 @@ class BackendTests(TestCase):
             list(TestUser.objects.filter(username="test"))
             self.assertEqual(1, query_mock.call_count)
 
-        with sleuth.switch("djangae.db.backends.appengine.commands.datastore.MultiQuery.Run", lambda *args, **kwargs: []) as query_mock:
+        with sleuth.switch("djangae.db.backends.appengine.commands.ParallelMultiQuery.Run", lambda *args, **kwargs: []) as query_mock:
             list(TestUser.objects.filter(username__in=["test", "cheese"]))
             self.assertEqual(1, query_mock.call_count)
 
@@ -408,7 +455,7 @@ class BackendTests(TestCase):
 
         #FIXME: Issue #80
         with self.assertRaises(NotSupportedError):
-            with sleuth.switch("djangae.db.backends.appengine.commands.datastore.MultiQuery.Run", lambda *args, **kwargs: []) as query_mock:
+            with sleuth.switch("djangae.db.backends.appengine.commands.ParallelMultiQuery.Run", lambda *args, **kwargs: []) as query_mock:
                 list(TestUser.objects.exclude(username__startswith="test"))
                 self.assertEqual(1, query_mock.call_count)
 
@@ -575,8 +622,8 @@ class BackendTests(TestCase):
         self.assertEqual(TestFruit.objects.count(), 4)
 
         # Sorted list. No exception should be raised
-        # (esp KeyError from django_ordering_comparison)
-        with sleuth.watch('djangae.db.backends.appengine.commands.utils.django_ordering_comparison') as compare:
+        # (esp KeyError from comparing the missing values)
+        with sleuth.watch('djangae.db.backends.appengine.multiquery.make_ordering_key') as compare:
             all_names = ['a', 'b', 'c', 'd']
             fruits = list(
                 TestFruit.objects.filter(name__in=all_names).order_by('color')
@@ -1304,19 +1351,18 @@ class EdgeCaseTests(TestCase):
         )
 
     def test_in_query(self):
-        """ Test that the __in filter works, and that it cannot be used with more than 30 values,
-            unless it's used on the PK field.
-        """
+        """ Test that the __in filter works, including with more than 30 values """
         # Check that a basic __in query works
         results = list(TestUser.objects.filter(username__in=['A', 'B']))
         self.assertItemsEqual(results, [self.u1, self.u2])
         # Check that it also works on PKs
         results = list(TestUser.objects.filter(pk__in=[self.u1.pk, self.u2.pk]))
         self.assertItemsEqual(results, [self.u1, self.u2])
-        # Check that using more than 30 items in an __in query not on the pk causes death
+        # Check that more than 30 items in an __in query not on the pk are merged into one result set
         query = TestUser.objects.filter(username__in=list([x for x in letters[:31]]))
-        # This currently raises an error from App Engine, should we raise our own?
-        self.assertRaises(Exception, list, query)
+        self.assertEqual([self.u1, self.u2, self.u3, self.u4, self.u5], list(query.order_by("username")))
+        self.assertEqual([self.u4, self.u3], list(query.order_by("-username")[1:3]))
+        self.assertEqual(5, query.count())
         # Check that it's ok with PKs though
         query = TestUser.objects.filter(pk__in=list(xrange(1, 32)))
         list(query)
@@ -1325,6 +1371,47 @@ class EdgeCaseTests(TestCase):
             pk__in=[self.u1.pk, self.u2.pk, self.u3.pk]).filter(pk__in=[self.u1.pk, self.u2.pk]))
         self.assertItemsEqual(results, [self.u1, self.u2])
 
+    def test_or_queries_are_merged(self):
+        # Overlapping branches, the results shouldn't be duplicated
+        qs = TestUser.objects.filter(Q(email="test@example.com") | Q(username__in=["B", "C", "E"]))
+
+        self.assertEqual([self.u5, self.u3, self.u2, self.u1], list(qs.order_by("-username")))
+        self.assertEqual([self.u1, self.u2, self.u3, self.u5], list(qs.order_by("username")))
+        self.assertEqual([self.u2, self.u3], list(qs.order_by("username")[1:3]))
+        self.assertEqual(4, qs.count())
+
+        # All the branches should be started before any results are read
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as query_run:
+            with sleuth.watch("djangae.db.backends.appengine.multiquery.ParallelMultiQuery._merge") as merge:
+                list(qs)
+                self.assertEqual(4, query_run.call_count)
+                self.assertEqual(4, len(merge.calls[0].args[1]))
+
+        # With more branches than can be in flight at once, they're run in groups
+        with sleuth.switch("djangae.db.backends.appengine.multiquery.MAX_CONCURRENT_BRANCHES", 3):
+            self.assertEqual([self.u5, self.u3, self.u2, self.u1], list(qs.order_by("-username")))
+            self.assertEqual([self.u2, self.u3], list(qs.order_by("username")[1:3]))
+            self.assertEqual(4, qs.count())
+
+    def test_or_queries_only_fetch_keys(self):
+        qs = TestUser.objects.filter(Q(email="test@example.com") | Q(username__in=["B", "C", "E"]))
+
+        with sleuth.watch("google.appengine.api.datastore.Query.__init__") as query_init:
+            self.assertEqual([1, 2, 3, 5], list(qs.order_by("pk").values_list("pk", flat=True)))
+            self.assertTrue(all(x.kwargs["keys_only"] for x in query_init.calls))
+
+        # The sort values come from a projection, or from the equality filter if there is one
+        with sleuth.watch("google.appengine.api.datastore.Query.__init__") as query_init:
+            self.assertEqual([5, 3, 2, 1], list(qs.order_by("-username").values_list("pk", flat=True)))
+            self.assertItemsEqual(
+                [(None, ["username"]), (True, None), (True, None), (True, None)],
+                [(x.kwargs["keys_only"], x.kwargs["projection"]) for x in query_init.calls]
+            )
+
+        with sleuth.watch("google.appengine.api.datastore.Query.__init__") as query_init:
+            self.assertEqual(4, qs.count())
+            self.assertTrue(query_init.calls[-1].kwargs["keys_only"])
+
     def test_self_relations(self):
         obj = SelfRelatedModel.objects.create()
         obj2 = SelfRelatedModel.objects.create(related=obj)
@@ -1575,3 +1662,434 @@ class TestHelperTests(TestCase):
         self.process_task_queues()
 
         self.assertNumTasksEquals(0) #No tasks
+
+
+class CursorModel(models.Model):
+    name = models.CharField(max_length=32)
+    number = models.IntegerField(default=0)
+
+    objects = DatastoreManager()
+
+    class Meta:
+        app_label = "djangae"
+
+
+class CursorTests(TestCase):
+    def setUp(self):
+        super(CursorTests, self).setUp()
+        for i in xrange(10):
+            CursorModel.objects.create(name=str(i), number=i)
+
+    def test_resuming_from_a_cursor(self):
+        qs = CursorModel.objects.order_by("number")
+
+        first = qs[:4]
+        self.assertEqual(range(4), [x.number for x in first])
+
+        cursor = first.get_cursor()
+        self.assertTrue(isinstance(cursor, basestring))
+
+        # Offsets shouldn't be used once we have a cursor
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as query_run:
+            self.assertEqual([4, 5, 6], [x.number for x in qs.start_cursor(cursor)[:3]])
+            self.assertFalse(query_run.calls[0].kwargs["offset"])
+            self.assertTrue(query_run.calls[0].kwargs["start_cursor"])
+
+    def test_cursors_survive_cloning(self):
+        qs = CursorModel.objects.order_by("number")
+        first = qs[:2]
+        list(first)
+
+        resumed = qs.start_cursor(first.get_cursor()).filter(number__gte=0).values_list("number", flat=True)
+        self.assertEqual([2, 3], list(resumed[:2]))
+        self.assertTrue(resumed[:2].all().query.context["datastore_start_cursor"])
+
+    def test_iterate_in_batches(self):
+        qs = CursorModel.objects.order_by("number")
+
+        batches = list(qs.iterate_in_batches(batch_size=4))
+        self.assertEqual(
+            [range(4), range(4, 8), range(8, 10)],
+            [[x.number for x in batch] for batch, cursor in batches]
+        )
+
+        # Resume after the first batch
+        resumed = list(qs.iterate_in_batches(batch_size=4, start_cursor=batches[0][1]))
+        self.assertEqual(range(4, 10), [x.number for batch, cursor in resumed for x in batch])
+
+        self.assertEqual(range(10), [x.number for x in qs.iterator(batch_size=3)])
+
+    def test_cursors_not_supported_on_or_queries(self):
+        qs = CursorModel.objects.order_by("number")
+        first = qs[:1]
+        list(first)
+
+        with self.assertRaises(NotSupportedError):
+            list(qs.filter(name__in=["1", "2"]).start_cursor(first.get_cursor()))
+
+        # Queries which can't use cursors fall back to offsets
+        batches = list(CursorModel.objects.filter(name__in=["1", "2", "3"]).iterate_in_batches(batch_size=2))
+        self.assertEqual([None, None], [cursor for batch, cursor in batches])
+        self.assertEqual(3, sum(len(batch) for batch, cursor in batches))
+
+
+class DatastoreOptionsTests(TestCase):
+    def test_options_are_passed_to_queries(self):
+        CursorModel.objects.create(name="A")
+
+        qs = CursorModel.objects.datastore_options(batch_size=50, prefetch_size=10, deadline=5)
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as query_run:
+            self.assertEqual(["A"], [x.name for x in qs.filter(name="A")])
+            self.assertEqual(50, query_run.calls[0].kwargs["batch_size"])
+            self.assertEqual(10, query_run.calls[0].kwargs["prefetch_size"])
+            self.assertEqual(5, query_run.calls[0].kwargs["deadline"])
+
+        with self.assertRaises(TypeError):
+            CursorModel.objects.datastore_options(bananas=True)
+
+    def test_options_survive_cloning(self):
+        CursorModel.objects.create(name="A")
+
+        qs = CursorModel.objects.datastore_options(deadline=5).filter(name="A").values_list("name", flat=True)
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as query_run:
+            self.assertEqual(["A"], list(qs.all()))
+            self.assertEqual(5, query_run.calls[0].kwargs["deadline"])
+
+    def test_eventual_reads_are_not_cached(self):
+        instance = CursorModel.objects.create(name="A")
+        clear_context_cache()
+        cache.clear()
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as get:
+            with sleuth.watch("djangae.db.backends.appengine.caching.add_entities_to_cache") as add_to_cache:
+                CursorModel.objects.datastore_options(eventual=True).get(pk=instance.pk)
+
+                self.assertEqual(datastore.EVENTUAL_CONSISTENCY, get.calls[0].kwargs["read_policy"])
+                self.assertFalse(add_to_cache.called)
+
+        with sleuth.watch("djangae.db.backends.appengine.caching.add_entities_to_cache") as add_to_cache:
+            CursorModel.objects.get(pk=instance.pk)
+            self.assertTrue(add_to_cache.called)
+
+
+class QueryLogTests(TestCase):
+    def setUp(self):
+        super(QueryLogTests, self).setUp()
+        self.instances = [ CursorModel.objects.create(name=str(i), number=i) for i in xrange(3) ]
+        query_log.reset()
+
+    def test_multiquery_is_logged(self):
+        self.assertEqual(2, len(CursorModel.objects.filter(name__in=["0", "1"])))
+
+        events = [ x for x in query_log.get_request_events() if x.category == query_log.MULTIQUERY ]
+        self.assertEqual(1, len(events))
+        self.assertEqual(CursorModel._meta.db_table, events[0].kind)
+        self.assertEqual(2, events[0].details["branches"])
+        self.assertEqual(2, events[0].result_count)
+
+    def test_python_sorting_and_filtering_are_logged(self):
+        pks = [ x.pk for x in self.instances ]
+        results = CursorModel.objects.filter(pk__in=pks, number__gt=0).order_by("-number")
+        self.assertEqual([2, 1], [ x.number for x in results ])
+
+        summary = query_log.get_request_summary()
+        self.assertEqual(3, summary["categories"][query_log.PYTHON_SORT]["result_count"])
+        self.assertEqual(1, summary["categories"][query_log.PYTHON_FILTER]["result_count"])
+
+        query_log.reset()
+        self.assertEqual(0, query_log.get_request_summary()["event_count"])
+
+
+class ExplainTests(TestCase):
+    def test_explain_strategies(self):
+        with sleuth.watch("google.appengine.api.datastore.Query.Run") as query_run:
+            explanation = CursorModel.objects.filter(name="A").explain()
+            self.assertFalse(query_run.called)
+
+        self.assertEqual("query", explanation["strategy"])
+        self.assertEqual(CursorModel._meta.db_table, explanation["kind"])
+        self.assertEqual([{"name =": "A"}], explanation["branches"])
+        self.assertEqual(1, explanation["rpcs"])
+        self.assertEqual([], explanation["caches"])
+
+        explanation = CursorModel.objects.filter(name__in=["A", "B"]).explain()
+        self.assertEqual("parallel_multiquery", explanation["strategy"])
+        self.assertEqual(2, len(explanation["branches"]))
+        self.assertEqual(2, explanation["rpcs"])
+        self.assertEqual([query_log.MULTIQUERY], explanation["post_processing"])
+
+        explanation = CursorModel.objects.filter(pk__in=[1, 2], name="A").explain()
+        self.assertEqual("get_by_keys", explanation["strategy"])
+        self.assertEqual(1, explanation["rpcs"])
+        self.assertTrue("context" in explanation["caches"])
+        self.assertEqual(
+            [query_log.PYTHON_SORT, query_log.PYTHON_FILTER], explanation["post_processing"]
+        )
+
+        self.assertTrue(CursorModel.objects.values_list("pk", flat=True).explain()["keys_only"])
+
+    def test_explain_empty_query(self):
+        explanation = CursorModel.objects.filter(pk=1).filter(pk=2).explain()
+        self.assertEqual("empty", explanation["strategy"])
+        self.assertEqual(0, explanation["rpcs"])
+
+
+class BulkInsertTests(TestCase):
+    def test_bulk_create_with_keys_checks_and_reserves_in_batches(self):
+        fruits = [ TestFruit(name=name, color="Red") for name in ("Apple", "Cherry", "Strawberry") ]
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as get:
+            with sleuth.watch("djangae.db.backends.appengine.commands.reserve_ids") as reserve_ids:
+                TestFruit.objects.bulk_create(fruits)
+
+                self.assertEqual(1, reserve_ids.call_count)
+                self.assertEqual(3, len(reserve_ids.calls[0].args[0]))
+
+            self.assertEqual(3, len(get.calls[0].args[0]))
+
+        self.assertEqual(3, TestFruit.objects.count())
+        self.assertEqual("Red", TestFruit.objects.get(pk="Cherry").color)
+
+    def test_bulk_create_with_existing_key_writes_nothing(self):
+        TestFruit.objects.create(name="Apple", color="Red")
+
+        with self.assertRaises(IntegrityError):
+            TestFruit.objects.bulk_create([
+                TestFruit(name="Banana", color="Yellow"),
+                TestFruit(name="Apple", color="Green"),
+            ])
+
+        self.assertEqual(["Apple"], [ x.pk for x in TestFruit.objects.all() ])
+        self.assertEqual("Red", TestFruit.objects.get(pk="Apple").color)
+
+        with self.assertRaises(IntegrityError):
+            TestFruit.objects.bulk_create([
+                TestFruit(name="Banana", color="Yellow"),
+                TestFruit(name="Banana", color="Green"),
+            ])
+
+        self.assertEqual(1, TestFruit.objects.count())
+
+
+class BulkUpdateTests(TestCase):
+    def test_update_in_cross_group_batches(self):
+        instances = [ CursorModel.objects.create(name="A", number=i) for i in xrange(30) ]
+        CursorModel.objects.get(pk=instances[0].pk) # Make sure it's in the context cache
+
+        with sleuth.watch("djangae.db.backends.appengine.commands.UpdateCommand._update_entities") as update:
+            self.assertEqual(29, CursorModel.objects.filter(number__gt=0).update(name="B"))
+
+            # 25 entity groups per transaction
+            self.assertEqual(2, update.call_count)
+            self.assertEqual([5, 25], sorted(len(x.args[-1]) for x in update.calls))
+
+        self.assertEqual("A", CursorModel.objects.get(pk=instances[0].pk).name)
+        self.assertEqual("B", CursorModel.objects.get(pk=instances[1].pk).name)
+        self.assertEqual(29, CursorModel.objects.filter(name="B").count())
+
+    def test_committed_update_batches_are_invalidated_when_another_fails(self):
+        from djangae.db.backends.appengine import caching
+        from djangae.db.backends.appengine.commands import UpdateCommand
+
+        instances = [ CursorModel.objects.create(name="A", number=i) for i in xrange(30) ]
+        clear_context_cache()
+        for instance in instances:
+            CursorModel.objects.get(pk=instance.pk) # Make sure they're in the context cache and memcache
+
+        update_entities = UpdateCommand._update_entities
+
+        def fail_small_batch(command, keys):
+            if len(keys) < 25:
+                raise ValueError("Failed")
+            return update_entities(command, keys)
+
+        with sleuth.switch("djangae.db.backends.appengine.commands.UpdateCommand._update_entities", fail_small_batch):
+            with self.assertRaises(ValueError):
+                CursorModel.objects.filter(number__gte=0).update(name="B")
+
+        # The batch which committed isn't left in memcache with its old values, and the
+        # updated entities aren't written back there either
+        caching.wait_for_memcache_writes()
+        keys = [ datastore.Key.from_path(CursorModel._meta.db_table, x.pk) for x in instances ]
+        self.assertEqual({}, caching._get_entities_from_memcache_by_key(keys))
+
+        clear_context_cache()
+        self.assertEqual(25, len([ x for x in instances if CursorModel.objects.get(pk=x.pk).name == "B" ]))
+
+    def test_query_log_events_from_other_threads_are_kept(self):
+        from djangae.db.backends.appengine.commands import run_concurrently
+
+        query_log.reset()
+
+        def record():
+            query_log.record(query_log.UNIQUE_MARKERS, "kind")
+
+        run_concurrently([ record, record, record ])
+        self.assertEqual(3, query_log.get_request_summary()["event_count"])
+
+    def test_update_in_transaction(self):
+        instance = CursorModel.objects.create(name="A")
+
+        with transaction.atomic():
+            self.assertEqual(1, CursorModel.objects.filter(pk=instance.pk).update(name="B"))
+
+        self.assertEqual("B", CursorModel.objects.get(pk=instance.pk).name)
+
+
+class DeleteTests(TestCase):
+    def test_delete_without_unique_constraints_skips_the_get(self):
+        instances = [ CursorModel.objects.create(name="A", number=i) for i in xrange(3) ]
+        CursorModel.objects.get(pk=instances[0].pk) # Make sure it's in the context cache
+
+        with sleuth.watch("google.appengine.api.datastore.Get") as get:
+            with sleuth.watch("google.appengine.api.datastore.DeleteAsync") as delete:
+                CursorModel.objects.filter(name="A").delete()
+                self.assertFalse(get.called)
+                self.assertEqual(3, len(delete.calls[0].args[0]))
+
+        self.assertEqual(0, CursorModel.objects.count())
+        self.assertFalse(CursorModel.objects.filter(pk=instances[0].pk).exists())
+
+        # Deleting by pk doesn't need to read anything at all
+        instances = [ CursorModel.objects.create(name="B", number=i) for i in xrange(3) ]
+        with sleuth.watch("google.appengine.api.datastore.Get") as get:
+            with sleuth.watch("google.appengine.api.datastore.Query.Run") as query_run:
+                CursorModel.objects.filter(pk__in=[ x.pk for x in instances ]).delete()
+                self.assertFalse(get.called)
+                self.assertFalse(query_run.called)
+
+        self.assertEqual(0, CursorModel.objects.count())
+
+    def test_delete_releases_unique_markers(self):
+        instance = UniqueModel.objects.create(unique_field="One")
+
+        with sleuth.watch("djangae.db.constraints.release") as release:
+            UniqueModel.objects.filter(pk=instance.pk).delete()
+            self.assertTrue(release.called)
+
+        UniqueModel.objects.create(unique_field="One")
+
+
+class BatchWritesTests(TestCase):
+    def test_inserts_and_deletes_are_sent_together(self):
+        existing = CursorModel.objects.create(name="Existing")
+
+        with sleuth.watch("google.appengine.api.datastore.PutAsync") as put:
+            with sleuth.watch("google.appengine.api.datastore.DeleteAsync") as delete:
+                with batch_writes():
+                    instances = [ CursorModel.objects.create(name=str(i)) for i in xrange(3) ]
+                    CursorModel.objects.filter(pk=existing.pk).delete()
+
+                    # The pks are allocated straight away, but nothing has been written yet
+                    self.assertTrue(all(x.pk for x in instances))
+                    self.assertEqual(3, len(set(x.pk for x in instances)))
+                    self.assertFalse(put.called)
+                    self.assertFalse(delete.called)
+
+                self.assertEqual(1, put.call_count)
+                self.assertEqual(3, len(put.calls[0].args[0]))
+                self.assertEqual(1, delete.call_count)
+
+        self.assertItemsEqual(
+            [ x.pk for x in instances ], CursorModel.objects.values_list("pk", flat=True)
+        )
+        self.assertEqual("1", CursorModel.objects.get(pk=instances[1].pk).name)
+
+    def test_writes_which_cant_be_queued_send_the_queue_first(self):
+        with batch_writes():
+            instance = CursorModel.objects.create(name="A")
+
+            # Unique markers have to be acquired straight away
+            UniqueModel.objects.create(unique_field="One")
+            self.assertTrue(CursorModel.objects.filter(pk=instance.pk).exists())
+            self.assertTrue(UniqueModel.objects.filter(unique_field="One").exists())
+
+            other = CursorModel.objects.create(name="B")
+            with transaction.atomic():
+                self.assertEqual("B", CursorModel.objects.get(pk=other.pk).name)
+
+    def test_queued_writes_are_sent_outside_of_transactions(self):
+        existing = CursorModel.objects.create(name="Existing")
+
+        @db.transactional
+        def update_and_roll_back():
+            # Updates can't be queued, so this sends the queue inside the transaction
+            CursorModel.objects.filter(pk=existing.pk).update(name="Updated")
+            raise ValueError("Roll back")
+
+        with batch_writes():
+            instance = CursorModel.objects.create(name="A")
+            self.assertRaises(ValueError, update_and_roll_back)
+
+        # The queued insert wasn't part of the transaction, so it wasn't rolled back with it
+        self.assertTrue(CursorModel.objects.filter(pk=instance.pk).exists())
+        self.assertEqual("Existing", CursorModel.objects.get(pk=existing.pk).name)
+
+
+class AsyncModel(AsyncSaveMixin, models.Model):
+    name = models.CharField(max_length=32)
+
+    objects = DatastoreManager()
+
+    class Meta:
+        app_label = "djangae"
+
+
+class AsyncWriteTests(TestCase):
+    def test_save_async(self):
+        instance = AsyncModel(name="A")
+        future = instance.save_async()
+        self.assertEqual(instance, future.get_result())
+        self.assertTrue(instance.pk)
+        self.assertFalse(instance._state.adding)
+
+        self.assertEqual("A", AsyncModel.objects.get(pk=instance.pk).name)
+
+        # Saving again updates the existing entity, and the cache
+        instance.name = "B"
+        instance.save_async().get_result()
+        self.assertEqual("B", AsyncModel.objects.get(pk=instance.pk).name)
+        self.assertEqual(1, AsyncModel.objects.count())
+
+    def test_bulk_save_async_sends_signals_when_resolved(self):
+        saved = []
+
+        def receiver(sender, instance, created, **kwargs):
+            saved.append((instance.name, created))
+
+        signals.post_save.connect(receiver, sender=AsyncModel)
+        try:
+            with sleuth.watch("google.appengine.api.datastore.PutAsync") as put:
+                future = AsyncModel.objects.bulk_save_async([ AsyncModel(name=str(i)) for i in xrange(3) ])
+                self.assertEqual(1, put.call_count)
+                self.assertEqual([], saved)
+
+            instances = future.get_result()
+        finally:
+            signals.post_save.disconnect(receiver, sender=AsyncModel)
+
+        self.assertEqual([("0", True), ("1", True), ("2", True)], saved)
+        self.assertItemsEqual(
+            [ x.pk for x in instances ], AsyncModel.objects.values_list("pk", flat=True)
+        )
+
+    def test_delete_async(self):
+        instances = [ AsyncModel.objects.create(name=str(i)) for i in xrange(3) ]
+
+        with sleuth.watch("google.appengine.api.datastore.DeleteAsync") as delete:
+            future = AsyncModel.objects.filter(pk__in=[ x.pk for x in instances[:2] ]).delete_async()
+            self.assertTrue(delete.called)
+
+        future.get_result()
+        self.assertEqual([instances[2].pk], list(AsyncModel.objects.values_list("pk", flat=True)))
+
+    def test_updates_to_unique_models_are_saved_straight_away(self):
+        instance = UniqueModel.objects.create(unique_field="One")
+        instance.unique_field = "Two"
+
+        future = save_async(instance)
+        self.assertTrue(future.done())
+        self.assertEqual("Two", UniqueModel.objects.get(pk=instance.pk).unique_field)
+
+        # The marker for the old value was released
+        UniqueModel.objects.create(unique_field="One")
@@ -473,4 +473,55 @@ class QueryNormalizationTests(TestCase):
                 query.where.children[1].children[0].value,
                 query.where.children[2].children[0].value,
             }
-        )
\ No newline at end of file
+        )
+
+from djangae.db.backends.appengine.plan_cache import query_plan_cache
+
+
+class QueryPlanCacheTests(TestCase):
+
+    def setUp(self):
+        super(QueryPlanCacheTests, self).setUp()
+        query_plan_cache.clear()
+
+    def _normalize(self, qs):
+        return query_plan_cache.prepare_and_normalize(
+            transform_query(connections['default'], qs.query)
+        )
+
+    def test_plans_are_reused_for_different_values(self):
+        from .test_connector import TestUser
+
+        query = self._normalize(TestUser.objects.filter(username="A", email__in=["a", "b"]))
+        self.assertEqual(1, query_plan_cache.stats()["misses"])
+
+        query = self._normalize(TestUser.objects.filter(username="B", email__in=["c", "d"]))
+        self.assertEqual(1, query_plan_cache.stats()["hits"])
+
+        self.assertEqual(2, len(query.where.children))
+        self.assertEqual(
+            {("B", "c"), ("B", "d")},
+            {(x.children[0].value, x.children[1].value) for x in query.where.children}
+        )
+
+        # A different number of IN values is a different plan
+        self._normalize(TestUser.objects.filter(username="B", email__in=["c", "d", "e"]))
+        self.assertEqual(2, query_plan_cache.stats()["misses"])
+
+    def test_empty_results_still_raised(self):
+        from .test_connector import TestUser
+
+        # The plan is built with slots, so the conflicting keys are only seen once bound
+        self._normalize(TestUser.objects.filter(pk=1).filter(pk=1))
+        with self.assertRaises(EmptyResultSet):
+            self._normalize(TestUser.objects.filter(pk=1).filter(pk=2))
+
+    def test_queries_return_correct_results(self):
+        from .test_connector import TestUser
+
+        TestUser.objects.create(username="A", email="a@example.com")
+        TestUser.objects.create(username="B", email="b@example.com")
+
+        self.assertEqual(["A"], [x.username for x in TestUser.objects.filter(username="A")])
+        self.assertEqual(["B"], [x.username for x in TestUser.objects.filter(username="B")])
+        self.assertTrue(query_plan_cache.stats()["hits"])
@@ -107,19 +107,15 @@ def find_project_root():
 
 
 def get_in_batches(queryset, batch_size=10):
-    """ prefetches the queryset in batches """
-    start = 0
+    """ prefetches the queryset in batches, using datastore cursors where the query allows it """
+    from djangae.db.models import iterate_in_batches
+
     if batch_size < 1:
         raise Exception("batch_size must be > 0")
-    end = batch_size
-    while True:
-        batch = [x for x in queryset[start:end]]
+
+    for batch, cursor in iterate_in_batches(queryset, batch_size=batch_size):
         for y in batch:
             yield y
-        if len(batch) < batch_size:
-            break
-        start += batch_size
-        end += batch_size
 
 
 def retry_until_successful(func, *args, **kwargs):